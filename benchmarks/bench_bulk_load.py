@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Compares the rows per second ingested by `create_table` against the generic
+loading it used before (executemany over per row lists on an autocommit
+connection, followed by commit), for narrow and wide tables.
+
+    python benchmarks/bench_bulk_load.py [rows]
+"""
+import sqlite3
+import sys
+import time
+
+from stubs import FakeRunner
+
+from redash_reql.query_runner import create_table
+
+
+def generic_load(conn, table, results):
+    columns = ', '.join(
+        '"{}"'.format(c['name'].replace('"', '""'))
+        for c in results['columns'])
+    conn.execute(u'CREATE TABLE {0} ({1})'.format(table, columns))
+
+    dml = u'INSERT INTO {table} ({columns}) VALUES ({values})'.format(
+        table=table,
+        columns=columns,
+        values=', '.join(['?'] * len(results['columns'])))
+    conn.executemany(dml, [
+        [row.get(column['name']) for column in results['columns']]
+        for row in results['rows']])
+    conn.commit()
+
+
+def bulk_load(conn, table, results):
+    create_table(conn, table, results)
+
+
+def bulk_load_key(conn, table, results):
+    create_table(conn, table, results, key='c0')
+
+
+MODES = [('generic', generic_load), ('bulk', bulk_load), ('without rowid', bulk_load_key)]
+
+
+def run(load, results, path=':memory:'):
+    conn = sqlite3.connect(path, isolation_level=None)
+    start = time.time()
+    load(conn, 'query_1', results)
+    elapsed = time.time() - start
+    conn.close()
+    return elapsed
+
+
+def main(count=200000):
+    print('{0:<8} {1:<14} {2:>12} {3:>10}'.format('width', 'mode', 'rows/s', 'speedup'))
+    for width in (2, 10, 50):
+        results = FakeRunner(count, width).results()
+        baseline = None
+        for name, load in MODES:
+            elapsed = min(run(load, results) for _ in range(3))
+            baseline = baseline or elapsed
+            print('{0:<8} {1:<14} {2:>12,.0f} {3:>9.2f}x'.format(
+                width, name, count / elapsed, baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
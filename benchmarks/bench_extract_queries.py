@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""
+Measures `extract_queries` on long ReQL queries with a cold and a warm
+parse cache.
+
+    python benchmarks/bench_extract_queries.py [joins] [repeat]
+"""
+import sys
+import timeit
+
+from redash_reql.query_runner import extract_queries, extract_queries_cache
+
+
+def long_query(joins):
+    lines = ['SELECT q0.id, COUNT(*) AS total', 'FROM query_1 AS q0']
+    for i in range(1, joins):
+        lines.append(
+            'LEFT JOIN query_{0} AS q{0} ON q{0}.id = q0.id AND q{0}.value > {0}'.format(i + 1))
+    lines.append("WHERE q0.name NOT LIKE '%query_0%' -- not a reference")
+    lines.append('GROUP BY q0.id ORDER BY total DESC LIMIT 100')
+    return '\n'.join(lines)
+
+
+def main(joins=50, repeat=20):
+    query = long_query(joins)
+
+    def cold():
+        extract_queries_cache.clear()
+        extract_queries(query)
+
+    def warm():
+        extract_queries(query)
+
+    cold_time = min(timeit.repeat(cold, number=1, repeat=repeat))
+    extract_queries(query)
+    warm_time = min(timeit.repeat(warm, number=1, repeat=repeat))
+
+    print('query length: {0} chars, {1} references'.format(len(query), joins))
+    print('cold (parse):  {0:10.3f} ms'.format(cold_time * 1000))
+    print('warm (cached): {0:10.3f} ms'.format(warm_time * 1000))
+    print('speedup:       {0:10.1f}x'.format(cold_time / warm_time))
+    print('cache stats:   {0}'.format(extract_queries_cache.stats()))
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
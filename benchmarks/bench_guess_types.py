@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Compares inferring the output column types cell by cell with `_guess_type`
+against the column oriented `ColumnTypeGuesser`.
+
+    python benchmarks/bench_guess_types.py [rows]
+"""
+import random
+import sys
+import time
+
+from redash_reql.query_runner import (
+    FETCH_BATCH_SIZE, ColumnTypeGuesser, TYPE_STRING, _guess_type)
+
+
+def make_rows(count):
+    rnd = random.Random(42)
+    rows = []
+    for i in range(count):
+        rows.append((
+            i,
+            rnd.random() * 1000,
+            u'2018-{0:02d}-{1:02d}T10:{2:02d}:00'.format(
+                rnd.randint(1, 12), rnd.randint(1, 28), rnd.randint(0, 59)),
+            u'{0}/{1}/2018'.format(rnd.randint(1, 12), rnd.randint(1, 28)),
+            rnd.choice([u'true', u'false', u'True']),
+            u'user {0}'.format(rnd.randint(1, 100)),
+            rnd.choice([u'foo', u'bar', u'baz', u'2018-01-01']),
+        ))
+    return rows
+
+
+def guess_per_cell(rows):
+    types = [None] * len(rows[0])
+    for row in rows:
+        for j, col in enumerate(row):
+            guess = _guess_type(col)
+            if types[j] is None:
+                types[j] = guess
+            elif types[j] != guess:
+                types[j] = TYPE_STRING
+    return types
+
+
+def guess_per_column(rows):
+    guesser = ColumnTypeGuesser(len(rows[0]))
+    for i in range(0, len(rows), FETCH_BATCH_SIZE):
+        guesser.update(rows[i:i + FETCH_BATCH_SIZE])
+    return guesser.types
+
+
+def main(count=100000):
+    rows = make_rows(count)
+
+    t = time.time()
+    expected = guess_per_cell(rows)
+    cell_time = time.time() - t
+
+    t = time.time()
+    types = guess_per_column(rows)
+    column_time = time.time() - t
+
+    assert types == expected, (types, expected)
+
+    print('rows: {0}, types: {1}'.format(count, types))
+    print('per cell:   {0:10.3f} s'.format(cell_time))
+    print('per column: {0:10.3f} s'.format(column_time))
+    print('speedup:    {0:10.1f}x'.format(cell_time / column_time))
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
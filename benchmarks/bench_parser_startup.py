@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+Measures the startup cost of the ReQL parser as seen by a fresh worker
+process: importing the module and running the first parse, when the LALR
+tables are generated from the grammar, loaded from the disk cache or
+loaded from a generated module.
+
+    python benchmarks/bench_parser_startup.py [repeat]
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+
+CHILD = r'''
+import json, sys, time
+t0 = time.time()
+from redash_reql.parser import ReqlParser
+module = None
+if sys.argv[1] == 'module':
+    import imp
+    module = imp.load_source('parser_gen', sys.argv[2])
+t1 = time.time()
+parser = ReqlParser(module=module, cache_dir=False if sys.argv[1] == 'build' else None)
+parser.parse('SELECT a, b FROM query_1 JOIN query_2 USING (a) WHERE b > 1')
+t2 = time.time()
+print(json.dumps({'import': t1 - t0, 'first_parse': t2 - t1}))
+'''
+
+
+def run_child(mode, env, *args):
+    out = subprocess.check_output(
+        [sys.executable, '-c', CHILD, mode] + list(args), env=env)
+    return json.loads(out.decode('utf8').strip().splitlines()[-1])
+
+
+def best(mode, env, repeat, *args):
+    runs = [run_child(mode, env, *args) for _ in range(repeat)]
+    return min(runs, key=lambda r: r['import'] + r['first_parse'])
+
+
+def main(repeat=5):
+    tmpdir = tempfile.mkdtemp()
+    env = dict(os.environ, REDASH_REQL_PARSER_CACHE=os.path.join(tmpdir, 'cache'))
+    try:
+        gen = os.path.join(tmpdir, 'parser_gen.py')
+        with open(gen, 'w') as fd:
+            subprocess.check_call(
+                [sys.executable, '-m', 'redash_reql.build_parser'], stdout=fd, env=env)
+
+        results = [
+            ('grammar', best('build', env, repeat)),
+            ('disk cache', best('cache', env, repeat)),
+            ('generated module', best('module', env, repeat, gen)),
+        ]
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print('{0:<18} {1:>12} {2:>14}'.format('tables from', 'import ms', 'first parse ms'))
+    for name, r in results:
+        print('{0:<18} {1:>12.1f} {2:>14.1f}'.format(
+            name, r['import'] * 1000, r['first_parse'] * 1000))
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
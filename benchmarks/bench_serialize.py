@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Compares the peak memory and time of serializing a query output by building
+the list of row dicts (as run_query used to) against `serialize_results`.
+Each mode runs on its own process, reporting the growth of its peak RSS.
+
+    python benchmarks/bench_serialize.py [rows]
+"""
+import json
+import resource
+import sqlite3
+import subprocess
+import sys
+import time
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def make_cursor(count):
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE t (id INTEGER, name TEXT, value REAL, created DATETIME)')
+    conn.executemany('INSERT INTO t VALUES (?, ?, ?, ?)', (
+        (i, u'name {0}'.format(i % 1000), i * 0.5, u'2018-01-01T10:00:00')
+        for i in range(count)))
+    return conn, conn.execute('SELECT * FROM t')
+
+
+def run_dicts(cursor, columns):
+    from redash.utils import JSONEncoder
+    from redash_reql.query_runner import ColumnTypeGuesser
+
+    names = [c['name'] for c in columns]
+    guesser = ColumnTypeGuesser(len(columns))
+    rows = []
+    for row in cursor:
+        guesser.update([row])
+        rows.append(dict(zip(names, row)))
+    for column, guess in zip(columns, guesser.types):
+        column['type'] = guess
+    return json.dumps({'columns': columns, 'rows': rows}, cls=JSONEncoder)
+
+
+def run_stream(cursor, columns):
+    from redash_reql.query_runner import serialize_results
+    return serialize_results(cursor, columns)
+
+
+def child(mode, count):
+    conn, cursor = make_cursor(count)
+    columns = [{'name': d[0], 'friendly_name': d[0], 'type': None}
+               for d in cursor.description]
+
+    base = peak_rss_mb()
+    t = time.time()
+    data = (run_dicts if mode == 'dicts' else run_stream)(cursor, columns)
+    elapsed = time.time() - t
+
+    print(json.dumps({
+        'time': elapsed, 'peak_mb': peak_rss_mb() - base, 'size_mb': len(data) / 1048576.0}))
+
+
+def main(count=1000000):
+    print('rows: {0}'.format(count))
+    print('{0:<8} {1:>10} {2:>14} {3:>12}'.format('mode', 'time s', 'peak +RSS MB', 'output MB'))
+    for mode in ('dicts', 'stream'):
+        out = subprocess.check_output(
+            [sys.executable, __file__, '--child', mode, str(count)])
+        r = json.loads(out.decode('utf8').strip().splitlines()[-1])
+        print('{0:<8} {1:>10.2f} {2:>14.1f} {3:>12.1f}'.format(
+            mode, r['time'], r['peak_mb'], r['size_mb']))
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        child(sys.argv[2], int(sys.argv[3]))
+    else:
+        main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,88 @@
+"""
+Stand-ins for the Redash models and upstream query runners, so ReQL queries
+can run end to end without a Redash server or its database. The models are
+the SQLite backed ones used by the tests.
+
+    stubs.install({1: stubs.StubQuery(1, rows=1000)})
+    ReqlQueryRunner({'memory': None}).run_query('SELECT * FROM query_1', stubs.StubUser())
+"""
+import json
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+import redash_reql.query_runner as query_runner
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests'))
+import stub_models  # noqa: E402
+sys.path.pop(0)
+
+
+class StubUser(object):
+    org_id = 1
+    group_ids = [1]
+    permissions = ['admin']
+
+
+class FakeRunner(object):
+    """ Upstream runner generating `rows` rows of `width` columns, with
+        integer, float, string and datetime values cycling over them.
+    """
+
+    def __init__(self, rows, width=4, seed=42):
+        self.rows = rows
+        self.width = width
+        self.seed = seed
+
+    def results(self):
+        rnd = random.Random(self.seed)
+        start = datetime(2018, 1, 1)
+        kinds = ['integer', 'float', 'string', 'datetime']
+        columns = [
+            {'name': 'c{0}'.format(i), 'type': kinds[i % len(kinds)]}
+            for i in range(self.width)]
+        makers = [
+            lambda i: i,
+            lambda i: rnd.random() * 1000,
+            lambda i: u'value {0}'.format(i % 1000),
+            lambda i: (start + timedelta(minutes=i)).isoformat(),
+        ]
+        rows = [
+            dict((c['name'], makers[j % len(makers)](i)) for j, c in enumerate(columns))
+            for i in range(self.rows)]
+        return {'columns': columns, 'rows': rows}
+
+    def run_query(self, query_text, user):
+        return json.dumps(self.results()), None
+
+
+class StubQuery(object):
+    """ Upstream query producing `rows` rows of `width` columns """
+
+    def __init__(self, id, rows=1000, width=4):
+        self.id = id
+        self.text = 'stub {0}'.format(id)
+        self.runner = FakeRunner(rows, width, seed=id)
+
+
+def install(queries, cached=()):
+    """ Replaces the Redash models used by the query runner with the SQLite
+        backed ones from the tests, creating a data source for each of the
+        queries and storing results for those in `cached`.
+
+        Returns a function that restores the models.
+    """
+    stub_models.reset()
+    for id, query in queries.items():
+        stub_models.add_data_source(id, query.runner)
+        stub_models.add_query(id, id, query.text)
+        if id in cached:
+            stub_models.add_result(id, id, query.text, query.runner.run_query(query.text, None)[0])
+
+    saved = query_runner.models
+    query_runner.models = stub_models
+
+    def restore():
+        query_runner.models = saved
+    return restore
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+"""
+Benchmark suite for the parser, the ingestion of upstream results and the
+end to end execution of ReQL queries. Runs without a Redash server by means
+of the stubs in `stubs.py`.
+
+Results are saved as JSON so they can be compared between commits:
+
+    python benchmarks/suite.py --output before.json
+    git checkout other-branch
+    python benchmarks/suite.py --output after.json --compare before.json
+
+Use `--quick` for a smaller run and `--only` to select some benchmarks.
+"""
+import argparse
+import gc
+import io
+import json
+import os
+import platform
+import sqlite3
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from datetime import datetime, timedelta
+
+import stubs
+from bench_extract_queries import long_query
+
+from redash_reql import columnar, query_runner
+from redash_reql.interchange import EncodedResults, ResultStore, encode
+from redash_reql.parser import ReqlParser
+from redash_reql.query_runner import (
+    ReqlQueryRunner, create_table, extract_queries, extract_queries_cache,
+    read_results, serialize_results)
+
+
+TESTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests')
+FIXTURES = ['fixtures.sqlite', 'fixtures.reql']
+
+
+def measure(func, repeat=3):
+    """ Best wall time of several runs, in seconds """
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def load_fixtures():
+    # Same splitting as the tests: statements end with `;` at the line end
+    queries = []
+    for fname in FIXTURES:
+        accum = []
+        with io.open(os.path.join(TESTS, fname), encoding='utf8') as fd:
+            for line in fd:
+                line = line.rstrip()
+                accum.append(line)
+                if line.endswith(';') and not line.startswith('--'):
+                    queries.append('\n'.join(accum))
+                    accum = []
+    return queries
+
+
+def bench_parse_fixtures(quick):
+    parser = ReqlParser(cache_dir=False)
+    parser.lark  # the parser tables are not part of the measure
+    queries = load_fixtures()
+
+    def run():
+        for query in queries:
+            try:
+                parser.parse(query)
+            except Exception:
+                pass
+
+    yield 'parse_fixtures', {'queries': len(queries)}, measure(run)
+
+
+def bench_extract_queries(quick):
+    for joins in ((10, 50) if quick else (10, 50, 200)):
+        query = long_query(joins)
+
+        def run():
+            extract_queries_cache.clear()
+            extract_queries(query)
+
+        yield 'extract_queries', {'joins': joins, 'chars': len(query)}, measure(run)
+
+
+def bench_create_table(quick):
+    sizes = (10000,) if quick else (10000, 100000, 1000000)
+    widths = (2, 10) if quick else (2, 10, 50)
+    for rows in sizes:
+        for width in widths:
+            data = json.dumps(stubs.FakeRunner(rows, width).results())
+
+            def run(data=data):
+                conn = sqlite3.connect(':memory:', isolation_level=None)
+                create_table(conn, 'query_1', data)
+                conn.close()
+
+            elapsed = measure(run, repeat=1 if rows * width >= 10000000 else 3)
+            yield 'create_table', {'rows': rows, 'width': width}, elapsed
+            # Free the results before building the next ones
+            del data, run
+
+
+def bench_guess_types(quick):
+    # Computed columns have no declared type, all of them are guessed
+    rows = 20000 if quick else 200000
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE t (a, b, c, d)')
+    start = datetime(2018, 1, 1)
+    conn.executemany('INSERT INTO t VALUES (?, ?, ?, ?)', (
+        (i, u'{0}'.format(i * 0.5), (start + timedelta(minutes=i)).isoformat(),
+         u'{0}/{1}/2018'.format(i % 12 + 1, i % 28 + 1))
+        for i in range(rows)))
+
+    def run():
+        cursor = conn.execute("SELECT a + 0, b || '', c || '', d || '' FROM t")
+        columns = [{'name': d[0], 'type': None} for d in cursor.description]
+        serialize_results(cursor, columns)
+
+    yield 'guess_types', {'rows': rows}, measure(run)
+
+
+def bench_run_query(quick):
+    rows = 10000 if quick else 100000
+    queries = dict((i, stubs.StubQuery(i, rows=rows, width=6)) for i in (1, 2, 3))
+    restore = stubs.install(queries, cached=(1, 2, 3))
+    try:
+        runner = ReqlQueryRunner({'memory': None})
+        user = stubs.StubUser()
+        sql = '''
+            SELECT q1.c2, COUNT(*), SUM(q2.c1), MAX(q3.c3)
+            FROM query_1 q1
+            JOIN query_2 q2 ON q2.c0 = q1.c0
+            JOIN query_3 q3 ON q3.c0 = q2.c0
+            WHERE q1.c0 % 2 = 0
+            GROUP BY q1.c2
+        '''
+
+        def run():
+            data, error = runner.run_query(sql, user)
+            assert error is None, error
+
+        yield 'run_query', {'rows': rows, 'queries': 3}, measure(run)
+    finally:
+        restore()
+
+
+def bench_engines(quick):
+    # Just the final statement over the tables already created
+    rows = 100000 if quick else 1000000
+    conn = sqlite3.connect(':memory:', isolation_level=None)
+    create_table(conn, 'query_1', json.dumps(stubs.FakeRunner(rows, 6).results()))
+    create_table(conn, 'query_2', json.dumps(stubs.FakeRunner(rows // 10, 2).results()))
+    parse = ReqlParser().parse
+    queries = [
+        # Only exact sums of REAL values run on the columnar engine
+        ('aggregate', '''
+            SELECT c2, COUNT(*), SUM(c0), AVG(c4), MIN(c1), MAX(c5) FROM query_1
+            WHERE c1 > 100 GROUP BY c2 ORDER BY 2 DESC LIMIT 10'''),
+        ('join', '''
+            SELECT q1.c2, COUNT(*), MIN(q2.c1) FROM query_1 q1
+            JOIN query_2 q2 ON q2.c0 = q1.c0 GROUP BY q1.c2'''),
+    ]
+
+    for name, sql in queries:
+        yield 'engine', {'engine': 'sqlite', 'query': name, 'rows': rows}, measure(
+            lambda: conn.execute(sql).fetchall())
+        if not columnar.available():
+            continue
+
+        # Loading the columns from the tables or reusing them
+        for cached in (False, True):
+            def run():
+                if not cached:
+                    columnar.column_cache.clear()
+                cursor = columnar.execute(conn, sql, parse, {'query_1': 1, 'query_2': 2})
+                assert cursor is not None
+                cursor.fetchmany(rows)
+
+            yield 'engine', {'engine': 'columnar', 'query': name, 'rows': rows,
+                             'cached': cached}, measure(run)
+
+
+def bench_interchange(quick):
+    # Upstream results as JSON text and in binary, decoded and loaded
+    sizes = (10000,) if quick else (10000, 100000, 1000000)
+    path = tempfile.mkdtemp()
+    saved = query_runner.result_store
+    try:
+        for rows in sizes:
+            results = stubs.FakeRunner(rows, 6).results()
+            names = [c['name'] for c in results['columns']]
+            text = json.dumps(results)
+            data = encode(results['columns'], [
+                tuple(row[name] for name in names) for row in results['rows']])
+            del results
+
+            store = ResultStore(len(data), path=path)
+            store.put(text, data)
+            formats = [
+                ('json', len(text.encode('utf8')), ResultStore(0),
+                 lambda: sum(1 for _ in read_results(text)[1])),
+                ('binary', len(data), store,
+                 lambda: sum(1 for _ in EncodedResults(data).rows())),
+            ]
+            for name, size, store, decode in formats:
+                params = {'format': name, 'rows': rows, 'bytes': size}
+                yield 'interchange_decode', params, measure(decode)
+
+                def run():
+                    conn = sqlite3.connect(':memory:', isolation_level=None)
+                    create_table(conn, 'query_1', text)
+                    conn.close()
+
+                query_runner.result_store = store
+                yield 'interchange_load', params, measure(run)
+                query_runner.result_store = saved
+    finally:
+        query_runner.result_store = saved
+        shutil.rmtree(path)
+
+
+BENCHMARKS = [
+    ('parse_fixtures', bench_parse_fixtures),
+    ('extract_queries', bench_extract_queries),
+    ('create_table', bench_create_table),
+    ('guess_types', bench_guess_types),
+    ('run_query', bench_run_query),
+    ('engines', bench_engines),
+    ('interchange', bench_interchange),
+]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.STDOUT).decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def key(result):
+    return '{0} {1}'.format(result['name'], json.dumps(result['params'], sort_keys=True))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--quick', action='store_true', help='smaller inputs')
+    parser.add_argument('--only', action='append', choices=[n for n, _ in BENCHMARKS])
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--compare', help='JSON results of a previous run')
+    args = parser.parse_args(argv)
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as fd:
+            previous = dict((key(r), r) for r in json.load(fd)['results'])
+
+    results = []
+    for name, bench in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        for bench_name, params, elapsed in bench(args.quick):
+            result = {'name': bench_name, 'params': params, 'time': elapsed}
+            results.append(result)
+
+            line = '{0:<60} {1:10.3f} ms'.format(key(result), elapsed * 1000)
+            if key(result) in previous:
+                line += '  {0:+7.1%}'.format(elapsed / previous[key(result)]['time'] - 1)
+            print(line)
+            sys.stdout.flush()
+
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump({
+                'revision': git_revision(),
+                'python': platform.python_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'date': datetime.utcnow().isoformat(),
+                'quick': args.quick,
+                'results': results,
+            }, fd, indent=2)
+
+
+if __name__ == '__main__':
+    main()
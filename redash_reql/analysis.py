@@ -0,0 +1,260 @@
+"""
+Helpers to inspect the raw AST produced by `ReqlParser`.
+"""
+
+# Nodes starting a new scope for table aliases
+SCOPE_NODES = ('select',)
+
+EQUALITY_OPS = ('=', '==')
+
+
+def is_tree(node, data=None):
+    return hasattr(node, 'data') and (data is None or node.data == data)
+
+
+def ident_value(node):
+    """ Obtains the name for an `ident` node, without its quoting """
+    token = node.children[0]
+    value = token.value
+    if token.type == 'DQUOTED':
+        value = value[1:-1].replace('""', '"')
+    elif value.startswith('[') and value.endswith(']'):
+        value = value[1:-1]
+    return value
+
+
+def literal_value(node):
+    """ Obtains the python value for a literal node or token """
+    if is_tree(node, 'ident'):
+        return ident_value(node)
+    if is_tree(node, 'literal_string'):
+        return node.children[0].value[1:-1].replace("''", "'")
+    if is_tree(node, 'literal_number'):
+        value = node.children[0].value
+        if value.lower().startswith('0x'):
+            return int(value, 16)
+        try:
+            return int(value)
+        except ValueError:
+            return float(value)
+    if is_tree(node):
+        raise ValueError('Unsupported literal {0}'.format(node.data))
+    if node.type == 'NULL':
+        return None
+    return node.value
+
+
+def node_span(node):
+    """ Obtains the (start, end) offsets of a node in the parsed text """
+    tokens = list(node.scan_values(lambda v: hasattr(v, 'pos_in_stream')))
+    return (
+        min(t.pos_in_stream for t in tokens),
+        max(t.pos_in_stream + len(t.value) for t in tokens))
+
+
+def column_ref(node):
+    """ Obtains a (qualifier, column) tuple if the node references a column,
+        qualifier being None for unqualified references.
+    """
+    if is_tree(node, 'ident'):
+        return None, ident_value(node)
+
+    if is_tree(node, 'ident_scoped'):
+        parts = node.children
+        if len(parts) >= 2 and all(is_tree(x, 'ident') for x in parts[-2:]):
+            return ident_value(parts[-2]), ident_value(parts[-1])
+
+    return None
+
+
+def iter_scope(node):
+    """ Iterates over the subtrees of a node without entering nested
+        scopes (i.e. subqueries).
+    """
+    stack = [c for c in reversed(node.children) if is_tree(c)]
+    while stack:
+        child = stack.pop()
+        yield child
+        if child.data not in SCOPE_NODES:
+            stack.extend(c for c in reversed(child.children) if is_tree(c))
+
+
+def scope_tables(select, names):
+    """ Maps the aliases and names (lowercased) to the referenced tables,
+        for the tables matching `names` in the FROM of a select.
+    """
+    tables = {}
+    for node in iter_scope(select):
+        if node.data != 'table_ref' or not node.children:
+            continue
+
+        first = node.children[0]
+        if not is_tree(first, 'ident'):
+            continue
+
+        name = ident_value(first)
+        if name.lower() not in names:
+            continue
+
+        tables[name.lower()] = names[name.lower()]
+        for child in node.children[1:]:
+            if is_tree(child, 'alias') and is_tree(child.children[0], 'ident'):
+                tables[ident_value(child.children[0]).lower()] = names[name.lower()]
+
+    return tables
+
+
+def _resolve(ref, scopes):
+    qualifier, column = ref
+    for tables in reversed(scopes):
+        if qualifier is None:
+            if tables:
+                return [(t, column) for t in set(tables.values())]
+        elif qualifier.lower() in tables:
+            return [(tables[qualifier.lower()], column)]
+    return []
+
+
+def _is_equality(node):
+    if not is_tree(node, 'expr_binary') or len(node.children) != 3:
+        return False
+    op = node.children[1]
+    return is_tree(op, 'op_binary') and \
+        [c.value for c in op.children] in [[x] for x in EQUALITY_OPS]
+
+
+def find_index_columns(ast, names):
+    """ Finds the columns of the tables in `names` used in equality
+        predicates of joins (ON and USING) and filters (WHERE).
+
+        Returns a dict mapping each table name to a set of columns.
+    """
+    names = dict((n.lower(), n) for n in names)
+    found = {}
+
+    def add(refs):
+        for table, column in refs:
+            found.setdefault(table, set()).add(column)
+
+    def visit(select, scopes):
+        scopes = scopes + [scope_tables(select, names)]
+
+        for node in iter_scope(select):
+            if node.data == 'select':
+                visit(node, scopes)
+            elif node.data == 'join_constraint' and node.children[0].type == 'USING':
+                columns = node.children[1]
+                idents = columns.children if is_tree(columns, 'compound_ident') else [columns]
+                for ident in idents:
+                    add(_resolve((None, ident_value(ident)), scopes))
+            elif node.data in ('join_constraint', 'where'):
+                for expr in iter_scope(node):
+                    if _is_equality(expr):
+                        for operand in (expr.children[0], expr.children[2]):
+                            ref = column_ref(operand)
+                            if ref:
+                                add(_resolve(ref, scopes))
+
+    _visit_roots(ast, lambda select: visit(select, []))
+    return found
+
+
+def _visit_roots(node, callback):
+    """ Calls the callback for the outermost select nodes """
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        if current.data == 'select':
+            callback(current)
+            continue
+        stack.extend(c for c in reversed(current.children) if is_tree(c))
+
+
+def _is_asterisk(node):
+    return not is_tree(node) and node.type == 'ASTERISK'
+
+
+def _resolve_all(ref, scopes):
+    """ Like _resolve but unqualified columns might belong to any table in
+        the enclosing scopes.
+    """
+    qualifier, column = ref
+    if qualifier is not None:
+        return _resolve(ref, scopes)
+
+    tables = set()
+    for scope in scopes:
+        tables.update(scope.values())
+    return [(t, column) for t in tables]
+
+
+def find_used_columns(ast, names):
+    """ Finds the columns of the tables in `names` referenced by the query.
+
+        Returns a dict mapping each table name to a set of lowercased column
+        names, or to None when all of them might be needed (i.e. `*`,
+        NATURAL joins or references we can't resolve).
+    """
+    names = dict((n.lower(), n) for n in names)
+    found = {}
+
+    def use(refs):
+        for table, column in refs:
+            if found.get(table, ()) is not None:
+                found.setdefault(table, set()).add(column.lower())
+
+    def use_all(tables):
+        for table in tables:
+            found[table] = None
+
+    def visit(select, scopes):
+        tables = scope_tables(select, names)
+        scopes = scopes + [tables]
+        for table in tables.values():
+            if found.get(table, ()) is not None:
+                found.setdefault(table, set())
+
+        for child in select.children:
+            walk(child, scopes)
+
+    def walk(node, scopes):
+        if not is_tree(node) or node.data == 'alias':
+            return
+
+        children = node.children
+        if node.data == 'table_ref':
+            # Only the arguments of table valued functions, i.e. json_each(t.x)
+            children = [c for c in children if is_tree(c, 'compound_expr')]
+        elif node.data == 'select':
+            return visit(node, scopes)
+        elif node.data == 'op_join':
+            if any(getattr(t, 'type', None) == 'NATURAL' for t in children):
+                use_all(scopes[-1].values())
+            return
+        elif node.data == 'column':
+            if _is_asterisk(children[0]):
+                return use_all(scopes[-1].values())
+            # Skip the column alias
+            children = children[:1]
+        elif node.data == 'ident_scoped' and _is_asterisk(children[-1]):
+            qualifier = ident_value(children[-2])
+            return use_all(t for t, _ in _resolve((qualifier, None), scopes))
+        elif node.data in ('ident', 'ident_scoped'):
+            ref = column_ref(node)
+            if ref:
+                use(_resolve_all(ref, scopes))
+            return
+        elif node.data == 'expr_call':
+            # Skip the function name
+            children = children[1:]
+        elif node.data == 'expr_collate':
+            children = children[:1]
+
+        for child in children:
+            walk(child, scopes)
+
+    _visit_roots(ast, lambda select: visit(select, []))
+
+    for name in names.values():
+        found.setdefault(name, None)
+    return found
@@ -0,0 +1,35 @@
+"""
+Generates a python module with the parser tables for the ReQL grammar, so
+they don't have to be computed at runtime:
+
+    python -m redash_reql.build_parser > redash_reql/parser_gen.py
+
+When present, `redash_reql.parser_gen` is used by the default parser.
+"""
+import base64
+import sys
+
+try:
+    from redash_reql.parser import GRAMMAR_HASH, build_lark, dump_lark
+except ImportError:
+    from parser import GRAMMAR_HASH, build_lark, dump_lark
+
+
+def build_parser(fd=None):
+    """ Writes the module to `fd` (stdout by default). There is a single
+        grammar, modeled on sqlite with the ReQL constructs.
+    """
+    fd = fd or sys.stdout
+    data = base64.b64encode(dump_lark(build_lark())).decode('ascii')
+
+    fd.write(u'# Generated by redash_reql.build_parser, do not edit!\n')
+    fd.write(u'GRAMMAR_HASH = {0!r}\n'.format(str(GRAMMAR_HASH)))
+    fd.write(u'PARSER_DATA = (\n')
+    for i in range(0, len(data), 76):
+        fd.write(u"    '{0}'\n".format(data[i:i + 76]))
+    fd.write(u')\n')
+    fd.flush()
+
+
+if __name__ == '__main__':
+    build_parser()
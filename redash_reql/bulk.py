@@ -0,0 +1,120 @@
+"""
+Bulk loading of rows into sqlite tables.
+"""
+import itertools
+import time
+
+from contextlib import contextmanager
+from operator import itemgetter
+
+from redash_reql.timings import Timings
+
+
+# Number of rows handed to sqlite on each insert
+BATCH_SIZE = 5000
+
+# Page cache in KiB while loading, so large tables don't thrash it
+LOAD_CACHE_SIZE = 64 * 1024
+
+# Settings applied while loading and restored afterwards. The rollback
+# journal is kept so a failed load can be undone.
+LOAD_PRAGMAS = (
+    ('synchronous', 0),
+    ('cache_size', -LOAD_CACHE_SIZE),
+)
+
+
+@contextmanager
+def load_pragmas(conn):
+    """ Tunes the connection for loading, restoring its settings after """
+    saved = []
+    for name, value in LOAD_PRAGMAS:
+        current, = conn.execute('PRAGMA {0}'.format(name)).fetchone()
+        # Never shrink a cache configured bigger (negative values are KiB)
+        if name == 'cache_size' and _cache_bytes(current) >= _cache_bytes(value):
+            continue
+        saved.append((name, current))
+        conn.execute('PRAGMA {0} = {1:d}'.format(name, value))
+    try:
+        yield
+    finally:
+        for name, value in reversed(saved):
+            conn.execute('PRAGMA {0} = {1:d}'.format(name, value))
+
+
+def _cache_bytes(value, page_size=4096):
+    return -value * 1024 if value < 0 else value * page_size
+
+
+def row_getter(names):
+    """ Builds a function turning a row dict into a tuple with the values
+        of the given keys, None for the missing ones.
+    """
+    if len(names) == 1:
+        name, = names
+        return lambda row: (row.get(name),)
+
+    getter = itemgetter(*names)
+
+    def get(row):
+        try:
+            return getter(row)
+        except KeyError:
+            return tuple(row.get(name) for name in names)
+    return get
+
+
+def create_ddl(table, definitions, key=None):
+    """ DDL for a table with the given column definitions, when a `key`
+        column is given it's the primary key of a WITHOUT ROWID table.
+    """
+    if key is None:
+        return u'CREATE TABLE {0} ({1})'.format(table, ', '.join(definitions))
+    return u'CREATE TABLE {0} ({1}, PRIMARY KEY ({2})) WITHOUT ROWID'.format(
+        table, ', '.join(definitions), key)
+
+
+def rollback(conn):
+    """ Rolls back the transaction, unless sqlite already did it because of
+        the error (i.e. a full database)
+    """
+    # There is no in_transaction on Python 2, the rollback may fail there
+    if getattr(conn, 'in_transaction', True):
+        conn.execute('ROLLBACK')
+
+
+def bulk_insert(conn, table, columns, rows, timings=None):
+    """ Inserts the tuples from `rows` into the quoted `columns` of a table
+        in fixed size batches inside a single transaction, so memory is
+        bounded by the batch size instead of the number of rows. The
+        connection must be in autocommit mode.
+
+        The insert statement is prepared once and reused for every batch.
+        Returns the number of rows inserted.
+    """
+    timings = timings or Timings()
+    dml = u'INSERT INTO {table} ({columns}) VALUES ({values})'.format(
+        table=table,
+        columns=', '.join(columns),
+        values=', '.join(['?'] * len(columns)))
+
+    count = 0
+    with load_pragmas(conn):
+        conn.execute('BEGIN')
+        try:
+            while True:
+                start = time.time()
+                batch = list(itertools.islice(rows, BATCH_SIZE))
+                decoded = time.time()
+                timings.add_time('decode', decoded - start)
+                if not batch:
+                    break
+                conn.executemany(dml, batch)
+                timings.add_time('insert', time.time() - decoded)
+                count += len(batch)
+        except:
+            rollback(conn)
+            raise
+        conn.execute('COMMIT')
+
+    return count
@@ -0,0 +1,123 @@
+import os
+import threading
+
+from collections import OrderedDict
+
+
+def size_from_env(name, default, unit=1):
+    """ Size of a process wide cache from an environment variable, or the
+        default, multiplied by `unit` (i.e. 1024 * 1024 for megabytes).
+    """
+    value = os.environ.get(name)
+    return int(float(value if value else default) * unit)
+
+
+def private_dir(path):
+    """ Creates the directory if needed, returns whether only the current
+        user can write to it, so the files found there can be trusted.
+    """
+    try:
+        if not os.path.isdir(path):
+            os.makedirs(path, 0o700)
+        st = os.stat(path)
+    except OSError:
+        return False
+
+    return st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+
+class LRUCache(object):
+    """ Thread safe mapping bounded to `size`, the least recently used
+        entries are evicted first. Keeps hit/miss counters for reporting.
+
+        Each entry counts as 1 towards the size unless a `weight` is given
+        when setting it. The `on_evict` callback receives the key and value
+        of the entries removed to make room or replaced.
+    """
+
+    def __init__(self, size, on_evict=None):
+        self.size = size
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.on_evict = on_evict
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def keys(self):
+        with self._lock:
+            return list(self._data.keys())
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, weight = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self._data[key] = (value, weight)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, weight=1):
+        with self._lock:
+            self._remove(key)
+            if weight > self.size:
+                self._evicted(key, value)
+                return
+            self._data[key] = (value, weight)
+            self.weight += weight
+            self._evict()
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                value, weight = self._data.pop(key)
+            except KeyError:
+                return default
+            self.weight -= weight
+            return value
+
+    def resize(self, size):
+        with self._lock:
+            self.size = size
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            while self._data:
+                key, (value, weight) = self._data.popitem(last=False)
+                self.weight -= weight
+                self._evicted(key, value)
+            self.hits = self.misses = 0
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'entries': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def _remove(self, key):
+        if key in self._data:
+            value, weight = self._data.pop(key)
+            self.weight -= weight
+            self._evicted(key, value)
+
+    def _evict(self):
+        while self._data and self.weight > max(self.size, 0):
+            key, (value, weight) = self._data.popitem(last=False)
+            self.weight -= weight
+            self._evicted(key, value)
+
+    def _evicted(self, key, value):
+        if self.on_evict is not None:
+            self.on_evict(key, value)
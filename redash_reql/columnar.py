@@ -0,0 +1,755 @@
+"""
+Columnar execution with NumPy of the simple analytic queries, those over a
+single table or an inner equi-join of two, with WHERE, GROUP BY, the COUNT,
+SUM, AVG, MIN and MAX aggregates, ORDER BY and LIMIT.
+
+The tables are the ones materialized in the table cache, the referenced
+columns are loaded from them as arrays and kept in `column_cache`, so the
+runs reading the same upstream results don't load them again. Loading them
+through the sqlite rows costs way more than running the query there, so
+other tables are left to sqlite, as is anything outside the
+supported subset, including columns mixing types or comparisons relying on
+sqlite's type affinity, raises `Unsupported` so the query runs on sqlite.
+
+SUM and AVG of REAL values are only supported when they are exact, in any
+order of the additions. Otherwise the result depends on the order and the
+way sqlite adds them, so those queries run on sqlite.
+"""
+import logging
+import re
+
+from lark.exceptions import LarkError
+
+from redash_reql.analysis import (
+    column_ref, ident_value, is_tree, literal_value, node_span)
+from redash_reql.cache import LRUCache, size_from_env
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    _INT_TYPES = (int, long)
+except NameError:
+    _INT_TYPES = (int,)
+
+
+logger = logging.getLogger(__name__)
+
+# Default size in megabytes for the loaded columns cache, it can be set for
+# the process with REDASH_REQL_COLUMN_CACHE_SIZE.
+DEFAULT_COLUMN_CACHE_SIZE = 256
+
+# Estimated bytes taken by each text value, besides the array slot
+TEXT_VALUE_SIZE = 64
+
+AGGREGATES = ('count', 'sum', 'avg', 'min', 'max')
+
+_COMPARISONS = {
+    '=': 'equal', '==': 'equal', '!=': 'not_equal', '<>': 'not_equal',
+    '<': 'less', '<=': 'less_equal', '>': 'greater', '>=': 'greater_equal',
+}
+
+_NUMERIC = ('int', 'real')
+
+# Duplicated names of a subquery output get a suffix
+_renamed_re = re.compile(r'^(.+):\d+$')
+
+
+class Unsupported(Exception):
+    pass
+
+
+def available():
+    return np is not None
+
+
+class Column(object):
+    """ Values of a column as an array of `kind` (int, real, text or null)
+        along with a mask of the NULL ones, which hold a filler value.
+
+        The `ranks` of the values, computed once when grouping or sorting
+        by the column, preserve their order as integers which are way
+        faster to handle than text.
+    """
+
+    def __init__(self, kind, values, nulls, ranks=None):
+        self.kind = kind
+        self.values = values
+        self.nulls = nulls
+        self.ranks = ranks
+
+    def __len__(self):
+        return len(self.nulls)
+
+    def weight(self):
+        weight = self.values.nbytes + self.nulls.nbytes
+        if self.kind == 'text':
+            weight += len(self) * TEXT_VALUE_SIZE
+        return weight
+
+    def take(self, idx):
+        if self.kind == 'text':
+            # Ranking the whole column once beats doing it for every subset
+            _codes(self)
+        return Column(self.kind, self.values[idx], self.nulls[idx],
+                      None if self.ranks is None else self.ranks[idx])
+
+    def tolist(self):
+        values = self.values.tolist()
+        for i in np.flatnonzero(self.nulls).tolist():
+            values[i] = None
+        return values
+
+
+def to_column(values):
+    """ Builds a Column from a sequence of sqlite values """
+    values = list(values)
+    nulls = np.fromiter((v is None for v in values), bool, len(values))
+    types = set(type(v) for v in values if v is not None)
+
+    if not types:
+        return Column('null', np.zeros(len(values)), nulls)
+
+    if nulls.any():
+        filler = u'' if types == set([type(u'')]) else 0
+        values = [filler if v is None else v for v in values]
+
+    if all(issubclass(t, _INT_TYPES) and t is not bool for t in types):
+        return Column('int', np.array(values, dtype=np.int64), nulls)
+    if types == set([float]):
+        return Column('real', np.array(values, dtype=np.float64), nulls)
+    if types == set([type(u'')]):
+        return Column('text', np.array(values, dtype=object), nulls)
+
+    raise Unsupported('Column mixing {0}'.format(', '.join(sorted(t.__name__ for t in types))))
+
+
+class ResultCursor(object):
+    """ Cursor like access to the output rows, for `serialize_results` """
+
+    def __init__(self, description, rows):
+        self.description = description
+        self._rows = rows
+        self._pos = 0
+
+    def fetchmany(self, size):
+        batch = self._rows[self._pos:self._pos + size]
+        self._pos += len(batch)
+        return batch
+
+
+# Loaded columns of the materialized tables shared by all the runs in the
+# process, by the key of the table and the column name.
+column_cache = LRUCache(size_from_env(
+    'REDASH_REQL_COLUMN_CACHE_SIZE', DEFAULT_COLUMN_CACHE_SIZE, 1024 * 1024))
+
+
+def execute(conn, query, parse, keys=None):
+    """ Runs the query with NumPy when it's in the supported subset,
+        returning a cursor over its output or None to run it on sqlite.
+
+        The `keys` identify the immutable contents of the tables by their
+        lowercased name, only the tables with one are supported.
+    """
+    if np is None:
+        return None
+
+    try:
+        ast = parse(query)
+    except LarkError:
+        return None
+
+    try:
+        plan = Plan(conn, ast, query, keys)
+        rows = plan.run()
+    except Unsupported as ex:
+        logger.debug('Running the query on sqlite: %s', ex)
+        return None
+
+    # Let sqlite name the output columns, it doesn't run the query for it
+    cursor = conn.execute(u'SELECT * FROM ({0}) LIMIT 0'.format(query.strip().rstrip(';')))
+    names = [d[0] for d in cursor.description]
+    if any(_renamed_re.match(n) and _renamed_re.match(n).group(1) in names for n in names):
+        logger.debug('Running the query on sqlite: duplicated output names')
+        return None
+    return ResultCursor(cursor.description, rows)
+
+
+def _tokens(node):
+    return [t.value.upper() for t in node.children if not is_tree(t)]
+
+
+def _trees(node):
+    return [c for c in node.children if is_tree(c)]
+
+
+class Plan(object):
+    """ A query in the supported subset, resolved against the tables """
+
+    def __init__(self, conn, ast, text, keys=None):
+        self.conn = conn
+        self.text = text
+        self.keys = keys or {}
+
+        stmt = ast
+        if not is_tree(stmt, 'stmt'):
+            raise Unsupported('Multiple statements')
+        select_stmt = stmt.children[0]
+        if not is_tree(select_stmt, 'select_stmt'):
+            raise Unsupported('Not a SELECT')
+
+        select = select_stmt.children[0]
+        if not is_tree(select, 'select'):
+            raise Unsupported('Compound SELECT or WITH')
+
+        clauses = dict((c.data, c) for c in _trees(select) if c.data != 'column')
+        for node in _trees(select_stmt)[1:]:
+            clauses[node.data] = node
+        if 'select_mod' in clauses and _tokens(clauses['select_mod']) != ['ALL']:
+            raise Unsupported('DISTINCT')
+        if 'having' in clauses:
+            raise Unsupported('HAVING')
+        if 'from' not in clauses:
+            raise Unsupported('No FROM')
+
+        self.tables = []
+        self.join = None
+        # Every column referenced, the only ones loaded
+        self.refs = set()
+        self._compile_from(clauses['from'].children[-1])
+
+        self.where = None
+        if 'where' in clauses:
+            self.where = self._compile_predicate(clauses['where'].children[-1])
+
+        self.group = []
+        if 'group' in clauses:
+            for node in clauses['group'].children[-1].children:
+                ref = self._column(node)
+                if ref is None:
+                    raise Unsupported('GROUP BY expression')
+                self.group.append(ref)
+
+        self.items, self.aliases = [], []
+        for column in select.children:
+            if is_tree(column, 'column'):
+                self._compile_column(column)
+
+        self.aggregated = bool(self.group) or any(i[0] == 'agg' for i in self.items)
+        for item in self.items:
+            self._check_item(item)
+
+        self.order = []
+        if 'order' in clauses:
+            for term in _trees(clauses['order']):
+                self.order.append((self._compile_order(term.children[0]), 'DESC' in _tokens(term)))
+
+        self.limit = self.offset = None
+        if 'limit' in clauses:
+            nodes = clauses['limit'].children[1:]
+            values = [self._integer(n) for n in nodes]
+            # The separator is anonymous, with a comma the offset goes first
+            if len(nodes) > 1 and text[node_span(nodes[0])[1]:].lstrip().startswith(','):
+                values.reverse()
+            self.limit = values[0]
+            self.offset = values[1] if len(values) > 1 else None
+            if min(values) < 0:
+                raise Unsupported('Negative LIMIT or OFFSET')
+
+    def _compile_from(self, node):
+        if is_tree(node, 'table_ref'):
+            self._add_table(node)
+            return
+
+        if not is_tree(node, 'join') or len(node.children) != 4:
+            raise Unsupported('Join of more than two tables')
+
+        left, op, right, constraint = node.children
+        if _tokens(op) not in (['JOIN'], ['INNER', 'JOIN']):
+            raise Unsupported('Join other than INNER')
+        self._add_table(left)
+        self._add_table(right)
+
+        if not is_tree(constraint, 'join_constraint') or _tokens(constraint) != ['ON']:
+            raise Unsupported('Join without ON')
+        expr = constraint.children[-1]
+        if not is_tree(expr, 'expr_binary') or len(expr.children) != 3 \
+                or _tokens(expr.children[1]) not in (['='], ['==']):
+            raise Unsupported('Join not on an equality')
+        keys = [self._column(expr.children[0]), self._column(expr.children[2])]
+        if None in keys or keys[0][0] == keys[1][0]:
+            raise Unsupported('Join not between columns of both tables')
+        self.join = tuple(sorted(keys))
+
+    def _add_table(self, node):
+        if not is_tree(node, 'table_ref') or not is_tree(node.children[0], 'ident'):
+            raise Unsupported('Table reference')
+        if len(node.children) > 1 and not is_tree(node.children[-1], 'alias'):
+            raise Unsupported('Table function')
+
+        name = ident_value(node.children[0])
+        if name.lower() not in self.keys:
+            raise Unsupported('Table {0} is not materialized'.format(name))
+        alias = name
+        if is_tree(node.children[-1], 'alias'):
+            alias_node = node.children[-1].children[0]
+            if not is_tree(alias_node, 'ident') or len(node.children[-1].children) > 1:
+                raise Unsupported('Table alias')
+            alias = ident_value(alias_node)
+
+        columns = [row[1] for row in self.conn.execute(
+            u'PRAGMA table_info("{0}")'.format(name.replace('"', '""')))]
+        if not columns:
+            raise Unsupported('Unknown table {0}'.format(name))
+        self.tables.append((name, alias.lower(), columns))
+
+    def _column(self, node):
+        """ Resolves a column reference to a (table index, name) tuple,
+            None if the node is not one.
+        """
+        ref = column_ref(node)
+        if ref is None:
+            return None
+        qualifier, name = ref
+
+        found = []
+        for i, (_, alias, columns) in enumerate(self.tables):
+            if qualifier is not None and qualifier.lower() != alias:
+                continue
+            found.extend((i, c) for c in columns if c.lower() == name.lower())
+        if len(found) != 1:
+            raise Unsupported('Unknown or ambiguous column {0}'.format(name))
+        self.refs.add(found[0])
+        return found[0]
+
+    def _compile_column(self, node):
+        if not is_tree(node.children[0]) and node.children[0].type == 'ASTERISK':
+            for i, (_, _, columns) in enumerate(self.tables):
+                for name in columns:
+                    self.refs.add((i, name))
+                    self.items.append(('column', (i, name)))
+                    self.aliases.append(name.lower())
+            return
+
+        self.items.append(self._compile_item(node.children[0]))
+        alias = None
+        if len(node.children) > 1:
+            alias = literal_value(node.children[-1]).lower()
+        self.aliases.append(alias)
+
+    def _compile_item(self, node):
+        ref = self._column(node)
+        if ref is not None:
+            return ('column', ref)
+
+        if is_tree(node, 'expr_call'):
+            name = ident_value(node.children[0]).lower() \
+                if is_tree(node.children[0], 'ident') else None
+            if name not in AGGREGATES or len(node.children) != 2:
+                raise Unsupported('Function call')
+
+            arg = node.children[1]
+            if not is_tree(arg) and arg.type == 'ASTERISK' and name == 'count':
+                return ('agg', name, None)
+            if is_tree(arg, 'expr_parens'):
+                raise Unsupported('DISTINCT or multiple arguments')
+            ref = self._column(arg)
+            if ref is None:
+                raise Unsupported('Aggregate of an expression')
+            return ('agg', name, ref)
+
+        return ('literal', self._literal(node))
+
+    def _check_item(self, item):
+        if not self.aggregated or item[0] != 'column':
+            return
+        if item[1] not in self.group:
+            raise Unsupported('Bare column in an aggregate query')
+
+    def _compile_order(self, node):
+        if is_tree(node, 'literal_number'):
+            position = literal_value(node)
+            if not isinstance(position, _INT_TYPES) or not 0 < position <= len(self.items):
+                raise Unsupported('ORDER BY position')
+            return ('output', position - 1)
+
+        # Output aliases take precedence over the table columns
+        if is_tree(node, 'ident') and ident_value(node).lower() in self.aliases:
+            return ('output', self.aliases.index(ident_value(node).lower()))
+
+        item = self._compile_item(node)
+        if item[0] == 'literal':
+            raise Unsupported('ORDER BY expression')
+        self._check_item(item)
+        if item[0] == 'agg' and not self.aggregated:
+            raise Unsupported('ORDER BY aggregate')
+        return item
+
+    def _literal(self, node):
+        if is_tree(node, 'literal_number') or is_tree(node, 'literal_string'):
+            return literal_value(node)
+        if not is_tree(node) and node.type == 'NULL':
+            return None
+
+        # The sign tokens are anonymous so find them in the text
+        if is_tree(node, 'expr_unary') and is_tree(node.children[-1], 'literal_number'):
+            value = literal_value(node.children[-1])
+            start = node_span(node.children[-1])[0]
+            ops = self.text[:start].rstrip()
+            for _ in node.children[:-1]:
+                if not ops or ops[-1] not in '+-':
+                    raise Unsupported('Unary operator')
+                if ops[-1] == '-':
+                    value = -value
+                ops = ops[:-1].rstrip()
+            return value
+
+        raise Unsupported('Expression {0}'.format(node.data if is_tree(node) else node.type))
+
+    def _integer(self, node):
+        value = self._literal(node)
+        if not isinstance(value, _INT_TYPES):
+            raise Unsupported('Not an integer')
+        return value
+
+    # Predicates evaluate to a pair of (true, false) masks, rows in neither
+    # of them are unknown as per SQL's three-valued logic.
+
+    def _compile_predicate(self, node):
+        if is_tree(node, 'expr_or') or is_tree(node, 'expr_and'):
+            operands = [self._compile_predicate(c) for c in _trees(node)]
+            if len(operands) != len(node.children) // 2 + 1:
+                raise Unsupported('Operand of {0}'.format(node.data))
+            return lambda frame: _combine(node.data == 'expr_and', [o(frame) for o in operands])
+
+        if is_tree(node, 'expr_not'):
+            operand = self._compile_predicate(node.children[-1])
+            negate = (len(node.children) - 1) % 2
+
+            def evaluate_not(frame):
+                true, false = operand(frame)
+                return (false, true) if negate else (true, false)
+            return evaluate_not
+
+        if is_tree(node, 'expr_binary') and len(node.children) == 3:
+            op = ' '.join(_tokens(node.children[1]))
+            if op not in _COMPARISONS and op not in ('IS', 'IS NOT'):
+                raise Unsupported('Operator {0}'.format(op))
+            left, right = self._compile_value(node.children[0]), self._compile_value(node.children[2])
+            return lambda frame: _compare(op, left(frame), right(frame))
+
+        if is_tree(node, 'expr_null'):
+            operand = self._compile_value(node.children[0])
+            op = 'IS' if _tokens(node) in (['IS', 'NULL'], ['ISNULL']) else 'IS NOT'
+            return lambda frame: _compare(op, operand(frame), _constant(None))
+
+        if is_tree(node, 'expr_between'):
+            tokens = _tokens(node)
+            operand, low, high = [
+                self._compile_value(c) for c in node.children
+                if is_tree(c) or c.type not in ('NOT', 'BETWEEN', 'AND')]
+
+            def evaluate_between(frame):
+                value = operand(frame)
+                result = _combine(True, [
+                    _compare('>=', value, low(frame)), _compare('<=', value, high(frame))])
+                return result[::-1] if 'NOT' in tokens else result
+            return evaluate_between
+
+        if is_tree(node, 'expr_in'):
+            return self._compile_in(node)
+
+        raise Unsupported('Predicate {0}'.format(node.data if is_tree(node) else node.type))
+
+    def _compile_in(self, node):
+        negate = 'NOT' in _tokens(node)
+        operand, values = self._compile_value(node.children[0]), node.children[-1]
+        if is_tree(values, 'expr_parens'):
+            if _tokens(values):
+                raise Unsupported('IN (DISTINCT ...)')
+            values = [c.children[0] for c in values.children]
+        elif is_tree(values, 'subquery'):
+            raise Unsupported('IN subquery')
+        else:
+            values = [values]
+
+        values = [self._literal(v) for v in values]
+        if None in values:
+            raise Unsupported('IN with NULL')
+        kinds = set(_constant(v).kind for v in values)
+
+        def evaluate_in(frame):
+            column = operand(frame)
+            if column.kind != 'null' and not _comparable(column.kind, kinds):
+                raise Unsupported('IN list of other types')
+            found = np.isin(column.values, values) if column.kind != 'null' \
+                else np.zeros(len(column), bool)
+            true, false = found & ~column.nulls, ~found & ~column.nulls
+            return (false, true) if negate else (true, false)
+        return evaluate_in
+
+    def _compile_value(self, node):
+        ref = self._column(node)
+        if ref is not None:
+            return lambda frame: frame[ref]
+        constant = _constant(self._literal(node))
+        return lambda frame: constant
+
+    # Execution
+
+    def run(self):
+        frame, count = self._load()
+
+        if self.where is not None:
+            true, _ = self.where(frame)
+            idx = np.flatnonzero(np.broadcast_to(true, (count,)))
+            frame = dict((ref, column.take(idx)) for ref, column in frame.items())
+            count = len(idx)
+
+        if self.aggregated:
+            groups, group_count, first = _groups([frame[ref] for ref in self.group], count)
+            outputs = [self._aggregate(item, frame, groups, group_count, first)
+                       for item in self.items]
+            keys = [(self._aggregate(item, frame, groups, group_count, first)
+                     if item[0] != 'output' else outputs[item[1]], desc)
+                    for item, desc in self.order]
+            count = group_count
+        else:
+            outputs = [self._project(item, frame, count) for item in self.items]
+            keys = [(self._project(item, frame, count)
+                     if item[0] != 'output' else outputs[item[1]], desc)
+                    for item, desc in self.order]
+
+        idx = _sort(keys, count) if keys else np.arange(count)
+        start = self.offset or 0
+        idx = idx[start:start + self.limit if self.limit is not None else None]
+        return list(zip(*[column.take(idx).tolist() for column in outputs])) \
+            if outputs else []
+
+    def _load(self):
+        loaded = []
+        for i, (name, _, _) in enumerate(self.tables):
+            table = u'"{0}"'.format(name.replace('"', '""'))
+            names = sorted(c for t, c in self.refs if t == i)
+            if not names:
+                count, = self.conn.execute(u'SELECT COUNT(*) FROM {0}'.format(table)).fetchone()
+                loaded.append(({}, count))
+                continue
+
+            key = self.keys[name.lower()]
+            columns = {}
+            for n in names:
+                column = column_cache.get((key, n))
+                if column is not None:
+                    columns[n] = column
+            missing = [n for n in names if n not in columns]
+
+            if missing:
+                rows = self.conn.execute(u'SELECT {0} FROM {1}'.format(
+                    ', '.join(u'"{0}"'.format(n.replace('"', '""')) for n in missing),
+                    table)).fetchall()
+                values = list(zip(*rows)) or [()] * len(missing)
+                for n, v in zip(missing, values):
+                    columns[n] = to_column(v)
+                    column_cache.set((key, n), columns[n], weight=columns[n].weight())
+
+            loaded.append((
+                dict(((i, n), c) for n, c in columns.items()), len(columns[names[0]])))
+
+        if self.join is None:
+            return loaded[0]
+
+        (left, left_count), (right, right_count) = loaded
+        left_idx, right_idx = _equi_join(left[self.join[0]], right[self.join[1]])
+        frame = dict((ref, column.take(left_idx)) for ref, column in left.items())
+        frame.update((ref, column.take(right_idx)) for ref, column in right.items())
+        return frame, len(left_idx)
+
+    def _project(self, item, frame, count):
+        if item[0] == 'column':
+            return frame[item[1]]
+        if item[0] == 'literal':
+            return to_column([item[1]] * count)
+        raise Unsupported('Aggregate without grouping')
+
+    def _aggregate(self, item, frame, groups, count, first):
+        if item[0] == 'column':
+            return frame[item[1]].take(first)
+        if item[0] == 'literal':
+            return to_column([item[1]] * count)
+        return to_column(_aggregate(item[1], frame.get(item[2]), groups, count))
+
+
+def _constant(value):
+    if value is None:
+        return Column('null', 0, np.bool_(True))
+    if isinstance(value, float):
+        return Column('real', value, np.bool_(False))
+    if isinstance(value, _INT_TYPES):
+        return Column('int', value, np.bool_(False))
+    return Column('text', value, np.bool_(False))
+
+
+def _comparable(kind, kinds):
+    return all(k in _NUMERIC if kind in _NUMERIC else k == kind for k in kinds)
+
+
+def _compare(op, left, right):
+    nulls = left.nulls | right.nulls
+    if 'null' not in (left.kind, right.kind) and not _comparable(left.kind, [right.kind]):
+        # sqlite would apply the affinity of the column to the other side
+        raise Unsupported('Comparison of {0} with {1}'.format(left.kind, right.kind))
+    if set([left.kind, right.kind]) == set(_NUMERIC) and not (
+            _below_2_53(left) and _below_2_53(right)):
+        # numpy compares them as floats, sqlite exactly
+        raise Unsupported('Comparison of big INTEGER and REAL values')
+
+    if op in ('IS', 'IS NOT'):
+        both = left.nulls & right.nulls
+        if 'null' in (left.kind, right.kind):
+            true = both
+        else:
+            true = (np.equal(left.values, right.values) & ~nulls) | both
+        return (true, ~true) if op == 'IS' else (~true, true)
+
+    if 'null' in (left.kind, right.kind):
+        unknown = nulls & False
+        return unknown, unknown
+
+    result = getattr(np, _COMPARISONS[op])(left.values, right.values).astype(bool)
+    return result & ~nulls, ~result & ~nulls
+
+
+def _below_2_53(column):
+    values = np.abs(np.asarray(column.values, dtype=np.float64))
+    return not values.size or float(values.max()) < 2.0 ** 53
+
+
+def _combine(conjunction, operands):
+    true, false = operands[0]
+    for other_true, other_false in operands[1:]:
+        if conjunction:
+            true, false = true & other_true, false | other_false
+        else:
+            true, false = true | other_true, false & other_false
+    return true, false
+
+
+def _codes(column):
+    """ Ranks of the values, -1 for NULL """
+    if column.ranks is None:
+        if column.kind == 'null':
+            return np.full(len(column), -1, dtype=np.int64)
+        _, codes = np.unique(column.values, return_inverse=True)
+        codes = codes.reshape(-1).astype(np.int64)
+        codes[column.nulls] = -1
+        column.ranks = codes
+    return column.ranks
+
+
+def _groups(columns, count):
+    """ Assigns each row its group, sorted by the key columns as sqlite
+        does. Returns the groups, their number and the first row of each.
+    """
+    if not columns:
+        return np.zeros(count, dtype=np.intp), 1, np.zeros(1, dtype=np.intp)
+
+    codes = [_codes(c) for c in columns]
+    if len(codes) == 1:
+        unique, groups = np.unique(codes[0], return_inverse=True)
+    else:
+        unique, groups = np.unique(np.stack(codes, axis=1), axis=0, return_inverse=True)
+    groups = groups.reshape(-1)
+
+    order = np.argsort(groups, kind='stable')
+    starts = np.flatnonzero(np.r_[True, groups[order][1:] != groups[order][:-1]]) \
+        if count else np.zeros(0, dtype=np.intp)
+    return groups, len(unique), order[starts]
+
+
+def _aggregate(func, column, groups, count):
+    if func == 'count':
+        if column is not None:
+            groups = groups[~column.nulls]
+        return np.bincount(groups, minlength=count).tolist()
+
+    result = [None] * count
+    valid = ~column.nulls
+    if column.kind == 'null' or not valid.any():
+        return result
+    if func in ('sum', 'avg') and column.kind not in _NUMERIC:
+        raise Unsupported('{0} of {1}'.format(func, column.kind))
+
+    values, groups = column.values[valid], groups[valid]
+    order = np.argsort(groups, kind='stable')
+    values, groups = values[order], groups[order]
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+
+    if func in ('sum', 'avg'):
+        # sqlite fails on integer overflow, numpy would wrap around
+        if column.kind == 'int' and float(np.abs(values.astype(np.float64)).max()) \
+                * len(values) >= 2.0 ** 63:
+            raise Unsupported('Possible integer overflow')
+        if column.kind == 'real' and not _exactly_summable(values):
+            raise Unsupported('Inexact sum of REAL values')
+        totals = np.add.reduceat(values, starts)
+        if func == 'avg':
+            totals = totals.astype(np.float64) / np.diff(np.r_[starts, len(values)])
+    elif func == 'min':
+        totals = np.minimum.reduceat(values, starts)
+    else:
+        totals = np.maximum.reduceat(values, starts)
+
+    for group, total in zip(groups[starts].tolist(), totals.tolist()):
+        result[group] = total
+    return result
+
+
+def _exactly_summable(values):
+    """ Whether the floats add up to the same sum in any order, that is
+        when they are multiples of a power of two small enough for every
+        partial sum to be exact.
+    """
+    values = values[values != 0]
+    if not len(values):
+        return True
+    if not np.isfinite(values).all():
+        return False
+
+    mantissas, exponents = np.frexp(values)
+    digits = (np.abs(mantissas) * 2.0 ** 53).astype(np.int64)
+    # Trailing zero bits of the 53 bits of each mantissa
+    zeros = np.frexp((digits & -digits).astype(np.float64))[1] - 1
+    bits = int((53 - exponents - zeros).max())
+    return float(np.abs(values).sum()) < 2.0 ** (52 - bits)
+
+
+def _sort(keys, count):
+    # NULLs sort first, so last when descending
+    codes = [-_codes(column) if desc else _codes(column) for column, desc in keys]
+    return np.lexsort(codes[::-1]) if count else np.arange(0)
+
+
+def _equi_join(left, right):
+    """ Obtains the pairs of matching rows as a couple of index arrays """
+    if 'null' in (left.kind, right.kind):
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+    if not _comparable(left.kind, [right.kind]):
+        raise Unsupported('Join of {0} with {1}'.format(left.kind, right.kind))
+
+    right_rows = np.flatnonzero(~right.nulls)
+    order = right_rows[np.argsort(right.values[right_rows], kind='stable')]
+    keys = right.values[order]
+
+    left_rows = np.flatnonzero(~left.nulls)
+    low = np.searchsorted(keys, left.values[left_rows], side='left')
+    high = np.searchsorted(keys, left.values[left_rows], side='right')
+    counts = high - low
+
+    left_idx = np.repeat(left_rows, counts)
+    # Position of each match within its range of the sorted keys
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    right_idx = order[np.repeat(low, counts) + offsets]
+    return left_idx, right_idx
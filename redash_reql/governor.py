@@ -0,0 +1,62 @@
+"""
+Limits on the execution of a run. A deadline and a cancellation flag are
+checked by sqlite through its progress handler, so long statements are
+interrupted, and between the steps of the run done in Python.
+"""
+import threading
+import time
+
+
+# Virtual machine instructions sqlite runs between checks
+PROGRESS_STEPS = 10000
+
+# Interval in seconds to check while waiting for the upstream queries
+POLL_INTERVAL = 0.1
+
+
+class QueryInterrupted(Exception):
+    pass
+
+
+class Governor(object):
+    """ Tracks whether a run must stop, because it was cancelled or it
+        took longer than `timeout` seconds (None for no limit).
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.deadline = time.time() + timeout if timeout else None
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def interrupted(self):
+        """ The reason to stop the run, None while it can go on """
+        if self._cancelled.is_set():
+            return u'Query cancelled by user.'
+        if self.deadline is not None and time.time() > self.deadline:
+            return u'Query exceeded the maximum execution time of {0:g} seconds.'.format(
+                self.timeout)
+        return None
+
+    def check(self):
+        """ Raises QueryInterrupted if the run must stop """
+        reason = self.interrupted()
+        if reason is not None:
+            raise QueryInterrupted(reason)
+
+    def watch(self, conn):
+        """ Makes the statements of the connection fail with an "interrupted"
+            OperationalError once the run must stop.
+        """
+        conn.set_progress_handler(self._progress, PROGRESS_STEPS)
+
+    def _progress(self):
+        try:
+            return 0 if self.interrupted() is None else 1
+        except KeyboardInterrupt:
+            # Signals are delivered while sqlite runs the handler, which
+            # would just abort the statement, so remember them.
+            self.cancel()
+            return 1
@@ -0,0 +1,401 @@
+"""
+Compact binary encoding of query results, an alternative to their JSON text
+for ReQL queries reading the output of other ReQL queries.
+
+Values are stored column by column after a small JSON header: integers and
+floats as typed arrays (plus a null mask if needed), strings as codes into a
+dictionary of the distinct values and anything else as a JSON array. Typed
+arrays are read in place through `memoryview` casts, so loading a result
+doesn't parse any text but the dictionaries.
+
+Redash only stores query results as JSON text, so the encodings are kept
+aside in a `ResultStore` keyed by the hash of that text. Readers fall back
+to the JSON whenever there is no encoding for it.
+
+Rows can be added to a `ResultsEncoder` batch by batch as they are produced,
+only their encoding is kept.
+"""
+import array
+import hashlib
+import io
+import itertools
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+from redash_reql.cache import LRUCache, private_dir
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'RQLB\x01'
+
+# Blocks start at multiples of the widest item so casts read aligned memory
+ALIGNMENT = 8
+
+# Extension of the encoded files in the store directory
+EXTENSION = '.rqlb'
+
+# Hashes of the texts remembered by the version of the result they hold
+DIGESTS_SIZE = 1024
+
+_HEADER_SIZE = struct.Struct('<I')
+_CODE = 'I' if array.array('I').itemsize == 4 else 'L'
+_TYPED = {'int64': 'q', 'float64': 'd'}
+_text_type = type(u'')
+_none_type = type(None)
+
+try:
+    from itertools import izip as _zip
+except ImportError:
+    _zip = zip
+
+
+def _kind(types):
+    types = set(types)
+    types.discard(_none_type)
+    if not types:
+        return None
+    if types <= set([_text_type]):
+        return 'text'
+    if types <= set([int, type(2 ** 64)]):
+        return 'int64'
+    if types == set([float]):
+        return 'float64'
+    return 'json'
+
+
+class _ColumnEncoder(object):
+    """ Values of a column added batch by batch, kept in the encoding for
+        the kinds of values seen so far and converted when another kind
+        shows up, so it never holds them as Python objects.
+    """
+
+    def __init__(self, encoder):
+        self.encoder = encoder
+        # None until there are values other than nulls
+        self.kind = None
+        self.count = 0
+        # Only for typed arrays
+        self.nulls = None
+        self.has_nulls = False
+
+    def add(self, values):
+        kind = _kind(map(type, values))
+        if kind is not None and self.kind not in (None, kind):
+            kind = 'json'
+        if kind is not None and kind != self.kind:
+            self._convert(kind)
+
+        if self.kind is not None:
+            try:
+                self._append(values)
+            except OverflowError:
+                self._convert('json')
+                self._append(values)
+        self.count += len(values)
+
+    def _convert(self, kind):
+        values = self._values()
+        self.kind = kind
+        if kind in _TYPED:
+            self.data = array.array(_TYPED[kind])
+            self.nulls = array.array('B')
+        elif kind == 'text':
+            # Code 0 is reserved for nulls
+            self.codes = {None: 0}
+            self.strings = []
+            self.data = array.array(_CODE)
+        else:
+            self.data = []
+
+        try:
+            self._append(values)
+        except OverflowError:
+            self.kind = 'json'
+            self.data = []
+            self.nulls = None
+            self._append(values)
+
+    def _append(self, values):
+        if self.kind in _TYPED:
+            nulls = array.array('B', [value is None for value in values])
+            has_nulls = any(nulls)
+            # Built apart so a failure doesn't leave part of the values
+            self.data.extend(array.array(_TYPED[self.kind], [
+                0 if value is None else value for value in values] if has_nulls else values))
+            self.nulls.extend(nulls)
+            self.has_nulls = self.has_nulls or has_nulls
+        elif self.kind == 'text':
+            codes = self.codes
+            for value in values:
+                if value not in codes:
+                    codes[value] = len(codes)
+                    self.strings.append(value)
+            self.data.extend(array.array(_CODE, [codes[value] for value in values]))
+        elif values:
+            # Encoded array items, without the brackets
+            self.data.append(self.encoder.encode(list(values))[1:-1])
+
+    def _values(self):
+        if self.kind is None:
+            return [None] * self.count
+        if self.kind == 'text':
+            dictionary = [None] + self.strings
+            return [dictionary[code] for code in self.data]
+        values = self.data.tolist()
+        if self.has_nulls:
+            for i in itertools.compress(range(self.count), self.nulls):
+                values[i] = None
+        return values
+
+    def finish(self):
+        """ The kind, header fields and data blocks of the column values """
+        if self.kind is None:
+            return 'text', {}, [array.array(_CODE, [0] * self.count), b'[]']
+        if self.kind in _TYPED:
+            if self.has_nulls:
+                return self.kind, {'nulls': True}, [self.data, self.nulls]
+            return self.kind, {}, [self.data]
+        if self.kind == 'text':
+            dictionary = json.dumps(self.strings, ensure_ascii=False).encode('utf8')
+            return self.kind, {}, [self.data, dictionary]
+        return self.kind, {}, [u'[{0}]'.format(u', '.join(self.data)).encode('utf8')]
+
+
+def _block(data):
+    if isinstance(data, array.array):
+        # Bytes of the array to join without copying them first, Python 2
+        # memoryviews can't be cast
+        return memoryview(data).cast('B') if hasattr(memoryview, 'cast') else data.tostring()
+    return data
+
+
+class ResultsEncoder(object):
+    """ Encodes rows (sequences of values in the order of the Redash
+        columns) as they are added in batches, so they don't need to be
+        kept until the end. Values that aren't integers, floats or strings
+        are encoded as JSON with `encoder`.
+    """
+
+    def __init__(self, width, encoder=None):
+        encoder = encoder or json.JSONEncoder()
+        self.count = 0
+        self._columns = [_ColumnEncoder(encoder) for _ in range(width)]
+
+    def add(self, rows):
+        rows = rows if isinstance(rows, list) else list(rows)
+        for index, column in enumerate(self._columns):
+            column.add([row[index] for row in rows])
+        self.count += len(rows)
+
+    def finish(self, columns):
+        """ The encoding of the rows added with the given Redash columns """
+        layout = []
+        blocks = []
+        offset = 0
+        for column in self._columns:
+            kind, fields, data = column.finish()
+            entry = dict(fields, kind=kind, blocks=[])
+            for block in data:
+                block = _block(block)
+                padding = -len(block) % ALIGNMENT
+                entry['blocks'].append([offset, len(block)])
+                blocks.extend([block, b'\0' * padding])
+                offset += len(block) + padding
+            layout.append(entry)
+
+        header = json.dumps({
+            'columns': columns,
+            'rows': self.count,
+            'byteorder': sys.byteorder,
+            'layout': layout,
+        }).encode('utf8')
+        header += b' ' * (-(len(MAGIC) + _HEADER_SIZE.size + len(header)) % ALIGNMENT)
+        return b''.join([MAGIC, _HEADER_SIZE.pack(len(header)), header] + blocks)
+
+
+def encode(columns, rows, encoder=None):
+    """ Encodes the rows (sequences of values in the order of the Redash
+        `columns`) with their columns. Values that aren't integers, floats
+        or strings are encoded as JSON with `encoder`.
+    """
+    results = ResultsEncoder(len(columns), encoder)
+    results.add(rows)
+    return results.finish(columns)
+
+
+def _cast(view, code):
+    try:
+        return view.cast(code)
+    except AttributeError:
+        # Python 2 memoryviews can't be cast, copy them instead
+        values = array.array(code)
+        values.fromstring(view.tobytes())
+        return values
+
+
+class EncodedResults(object):
+    """ Query results decoded from a buffer (bytes, mmap...) holding their
+        binary encoding. Raises ValueError if it's not a valid encoding for
+        this platform.
+    """
+
+    def __init__(self, buf):
+        view = memoryview(buf)
+        start = len(MAGIC) + _HEADER_SIZE.size
+        if view[:len(MAGIC)].tobytes() != MAGIC:
+            raise ValueError('Not a binary encoding of query results')
+        size, = _HEADER_SIZE.unpack(view[len(MAGIC):start].tobytes())
+        header = json.loads(view[start:start + size].tobytes().decode('utf8'))
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError('Binary results encoded with a different byte order')
+
+        self.columns = header['columns']
+        self.count = header['rows']
+        self._layout = header['layout']
+        self._view = view[start + size:]
+
+    def _blocks(self, index):
+        return [self._view[offset:offset + size]
+                for offset, size in self._layout[index]['blocks']]
+
+    def values(self, index):
+        """ A sequence with the values of a column """
+        entry = self._layout[index]
+        blocks = self._blocks(index)
+        kind = entry['kind']
+
+        if kind in _TYPED:
+            values = _cast(blocks[0], _TYPED[kind])
+            if not entry.get('nulls'):
+                return values
+            values = values.tolist()
+            for i in itertools.compress(range(self.count), blocks[1]):
+                values[i] = None
+            return values
+
+        if kind == 'text':
+            dictionary = [None] + json.loads(blocks[1].tobytes().decode('utf8'))
+            return map(dictionary.__getitem__, _cast(blocks[0], _CODE))
+
+        return json.loads(blocks[0].tobytes().decode('utf8'))
+
+    def rows(self, indexes=None):
+        """ Iterator over the rows as tuples with the values of the columns
+            at the given indexes, all of them by default.
+        """
+        if indexes is None:
+            indexes = range(len(self.columns))
+        if not indexes:
+            return itertools.repeat((), self.count)
+        return _zip(*[self.values(i) for i in indexes])
+
+
+class ResultStore(object):
+    """ Binary encodings of query results by the hash of their JSON text,
+        stored as files in a private directory so every process of the
+        host can use them. Bounded to `size` bytes by removing the least
+        recently used files, 0 disables it.
+
+        Readers can give a `version` identifying the stored result the text
+        comes from, so its hash is only computed the first time.
+    """
+
+    def __init__(self, size=0, path=None):
+        self.size = size
+        self.path = path or os.path.join(
+            tempfile.gettempdir(), 'redash_reql-results-{0}'.format(os.getuid()))
+        self._digests = LRUCache(DIGESTS_SIZE)
+
+    def resize(self, size):
+        shrunk = 0 < size < self.size
+        self.size = size
+        if shrunk:
+            self._trim()
+
+    def _fname(self, text, version=None):
+        digest = None if version is None else self._digests.get(version)
+        if digest is None:
+            if isinstance(text, _text_type):
+                text = text.encode('utf8')
+            digest = hashlib.sha1(text).hexdigest()
+            if version is not None:
+                self._digests.set(version, digest)
+        return os.path.join(self.path, digest + EXTENSION)
+
+    def get(self, text, version=None):
+        """ The encoded results for the JSON text, None if there are none """
+        if self.size <= 0 or not private_dir(self.path):
+            return None
+
+        fname = self._fname(text, version)
+        try:
+            with io.open(fname, 'rb') as fd:
+                buf = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            os.utime(fname, None)
+        except (IOError, OSError, ValueError):
+            return None
+
+        try:
+            memoryview(buf)
+        except TypeError:
+            # Python 2 mmaps don't expose buffers
+            buf = buf[:]
+
+        try:
+            return EncodedResults(buf)
+        except ValueError:
+            logger.warning('Ignoring invalid binary results in %s', fname, exc_info=True)
+            return None
+
+    def put(self, text, data):
+        """ Stores the encoded results for the JSON text, returns whether
+            they fit and were stored.
+        """
+        if self.size <= 0 or len(data) > self.size:
+            return False
+        if not private_dir(self.path):
+            logger.warning('Not storing binary results, %s is not a private directory',
+                           self.path)
+            return False
+
+        try:
+            fd, tmpname = tempfile.mkstemp(dir=self.path)
+            with io.open(fd, 'wb') as fobj:
+                fobj.write(data)
+            os.rename(tmpname, self._fname(text))
+        except (IOError, OSError):
+            logger.warning('Unable to store binary results in %s', self.path, exc_info=True)
+            return False
+
+        self._trim()
+        return True
+
+    def _trim(self):
+        try:
+            names = [n for n in os.listdir(self.path) if n.endswith(EXTENSION)]
+        except OSError:
+            return
+
+        entries = []
+        for name in names:
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.size:
+                break
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
@@ -1,5 +1,24 @@
+import base64
+import hashlib
+import io
+import logging
+import os
+import pickle
 import sys
+import tempfile
+import threading
+
+import lark
 from lark import Lark, Visitor, Tree
+from lark.parsers.lalr_analysis import Shift, Reduce
+
+try:
+    from redash_reql.cache import private_dir
+except ImportError:
+    from cache import private_dir
+
+
+logger = logging.getLogger(__name__)
 
 
 SQL_GRAMMAR = r'''
@@ -13,8 +32,13 @@ SQL_GRAMMAR = r'''
                             | ";"*
 
     stmt                    : select_stmt
+                            | create_table_stmt
+                            | create_index_stmt
                             | reql_set_stmt
 
+    create_table_stmt       : CREATE (TEMP | TEMPORARY) TABLE [ IF NOT EXISTS ] ident AS select_stmt
+    create_index_stmt       : CREATE UNIQUE? INDEX [ IF NOT EXISTS ] ident ON ident "(" compound_ident ")"
+
 
     compound_expr           : expr ("," expr)*
     ?expr                   : expr_or
@@ -60,7 +84,7 @@ SQL_GRAMMAR = r'''
 
     type_ref                : CNAME [ "(" literal_number [ "," literal_number ] ")" ]
 
-    op_binary               : "||" | "*" | "/" | "%" | "+" | "-"
+    !op_binary              : "||" | "*" | "/" | "%" | "+" | "-"
                             | "<<" | ">>" | "&" | "|" | "<" | "<="
                             | ">" | ">=" | "=" | "==" | "!=" | "<>"
                             | IS | IS NOT
@@ -95,7 +119,7 @@ SQL_GRAMMAR = r'''
 
     table_ref               : ident_scoped [ AS? alias ]
                             | ident_scoped "(" compound_expr? ")" [ AS? alias ]
-                            | reql_expr
+                            | reql_expr [ AS? alias ]
 
     cte                     : alias [ "(" compound_ident ")" ] AS "(" select_stmt ")"
                             | alias [ "(" compound_ident ")" ] AS reql_expr             -> reql_cte
@@ -141,8 +165,10 @@ SQL_GRAMMAR = r'''
 
     select_stmt             : with? compound_select order? limit?
 
+    // Access style [quotes], but not the ReQL params right after a source name,
+    // i.e. query[1], unless the name is a keyword, i.e. AS[x y]
     ident                   : CNAME | DQUOTED
-                            | /\[([^\]].+?)\]/    // Access style [quotes]
+                            | /(?:(?<![\w\]])|(?<=\bAS)|(?<=\bBY)|(?<=\bON)|(?<=\bOR)|(?<=\bAND)|(?<=\bNOT)|(?<=\bFROM)|(?<=\bJOIN)|(?<=\bWHEN)|(?<=\bTHEN)|(?<=\bELSE)|(?<=\bWHERE)|(?<=\bSELECT)|(?<=\bHAVING)|(?<=\bDISTINCT))\[([^\]].+?)\]/i
 
 
     //
@@ -151,7 +177,7 @@ SQL_GRAMMAR = r'''
     /////////////////////////////////////////////////////////
 
     reql_expr       : CNAME reql_params reql_mapper*
-    reql_params     : "[" [ reql_param (","? reql_param)* ] "]" | reql_block
+    !reql_params    : "[" [ reql_param (","? reql_param)* ] "]" | reql_block
     ?reql_param     : reql_pair | ident | literal | parameter
     reql_pair       : CNAME ":" (ident | literal | parameter | reql_block)
     reql_block      : /\[:([\s\S]*?):\]/   -> reql_block
@@ -159,7 +185,7 @@ SQL_GRAMMAR = r'''
                     | /\[<([\s\S]*?)>\]/   -> reql_block_folded
     reql_mapper     : "::" CNAME reql_params?
 
-    reql_set_stmt   : "SET"i CNAME "=" (literal | CNAME)
+    !reql_set_stmt  : "SET"i CNAME "=" (literal | CNAME | "-" literal_number)
 
 
     %import common.CNAME
@@ -192,6 +218,7 @@ SQL_GRAMMAR = r'''
     CASE                    : "CASE"i
     CAST                    : "CAST"i
     COLLATE                 : "COLLATE"i
+    CREATE                  : "CREATE"i
     CROSS                   : "CROSS"i
     CURRENT_DATE            : "CURRENT_DATE"i
     CURRENT_TIME            : "CURRENT_TIME"i
@@ -207,8 +234,10 @@ SQL_GRAMMAR = r'''
     GLOB                    : "GLOB"i
     GROUP                   : "GROUP"i
     HAVING                  : "HAVING"i
+    IF                      : "IF"i
     IGNORE                  : "IGNORE"i
     IN                      : "IN"i
+    INDEX                   : "INDEX"i
     INDEXED                 : "INDEXED"i
     INNER                   : "INNER"i
     INTERSECT               : "INTERSECT"i
@@ -230,8 +259,12 @@ SQL_GRAMMAR = r'''
     RECURSIVE               : "RECURSIVE"i
     REGEXP                  : "REGEXP"i
     SELECT                  : "SELECT"i
+    TABLE                   : "TABLE"i
+    TEMP                    : "TEMP"i
+    TEMPORARY               : "TEMPORARY"i
     THEN                    : "THEN"i
     UNION                   : "UNION"i
+    UNIQUE                  : "UNIQUE"i
     USING                   : "USING"i
     VALUES                  : "VALUES"i
     WHEN                    : "WHEN"i
@@ -240,15 +273,150 @@ SQL_GRAMMAR = r'''
 '''
 
 
-class ReqlParser(object):
+# Identifies the generated parser tables, they are only valid for the exact
+# same grammar, lark version and python version.
+GRAMMAR_HASH = hashlib.sha1('\n'.join([
+    SQL_GRAMMAR, lark.__version__, '{0}.{1}'.format(*sys.version_info[:2])
+    ]).encode('utf8')).hexdigest()
+
+
+# The LALR parse table compares its actions by identity, so these singletons
+# must be restored as references instead of being copied by pickle.
+_PERSISTENT_IDS = {'Shift': Shift, 'Reduce': Reduce}
+
+
+class _LarkPickler(pickle.Pickler):
+
+    def persistent_id(self, obj):
+        for pid, value in _PERSISTENT_IDS.items():
+            if obj is value:
+                return pid
+        return None
+
+
+class _LarkUnpickler(pickle.Unpickler):
+
+    def persistent_load(self, pid):
+        return _PERSISTENT_IDS[pid]
+
+
+def build_lark(transformer=None, postlex=None):
+    return Lark(
+        SQL_GRAMMAR, start='start', parser='lalr',
+        transformer=transformer, postlex=postlex)
 
-    def __init__(self, transformer=None, postlex=None):
-        self.lark = Lark(
-            SQL_GRAMMAR, start='start', parser='lalr',
-            transformer=transformer, postlex=postlex)
+
+def dump_lark(lark_inst):
+    fd = io.BytesIO()
+    _LarkPickler(fd, 2).dump(lark_inst)
+    return fd.getvalue()
+
+
+def load_lark(data):
+    lark_inst = _LarkUnpickler(io.BytesIO(data)).load()
+    if not isinstance(lark_inst, Lark):
+        raise ValueError('Not pickled parser tables: {0!r}'.format(type(lark_inst)))
+    return lark_inst
+
+
+def load_lark_module(module):
+    """ Loads the parser from a module generated with `build_parser` """
+    if module.GRAMMAR_HASH != GRAMMAR_HASH:
+        raise ValueError('Generated parser module {0} is outdated'.format(
+            module.__name__))
+    return load_lark(base64.b64decode(module.PARSER_DATA))
+
+
+def generated_module():
+    """ Obtains the parser module generated at build time if available """
+    try:
+        from redash_reql import parser_gen
+    except ImportError:
+        return None
+
+    if parser_gen.GRAMMAR_HASH != GRAMMAR_HASH:
+        logger.warning('Ignoring outdated generated parser %s', parser_gen.__file__)
+        return None
+
+    return parser_gen
+
+
+def default_cache_dir():
+    path = os.environ.get('REDASH_REQL_PARSER_CACHE')
+    if path is None:
+        path = os.path.join(
+            tempfile.gettempdir(), 'redash_reql-{0}'.format(os.getuid()))
+    return path
+
+
+class ReqlParser(object):
+    """ Parses ReQL queries, the LALR tables are only generated the first
+        time it's used and, unless a custom transformer or postlex is given,
+        they are stored in `cache_dir` to be reused by other processes.
+
+        The module generated at build time with `build_parser`, either as
+        `redash_reql.parser_gen` or explicitly given, takes precedence over
+        the cache. Use `cache_dir=False` to disable the disk cache.
+    """
+
+    def __init__(self, transformer=None, postlex=None, module=None, cache_dir=None):
+        self.transformer = transformer
+        self.postlex = postlex
+        self.module = module
+        self.cache_dir = default_cache_dir() if cache_dir is None else cache_dir
+        self._lark = None
+        self._lock = threading.Lock()
+
+    @property
+    def lark(self):
+        if self._lark is None:
+            with self._lock:
+                if self._lark is None:
+                    self._lark = self._load()
+        return self._lark
 
     def parse(self, code, transformer=None):
         tree = self.lark.parse(code)
         if transformer:
             transformer.transform(tree)
         return tree
+
+    def _load(self):
+        if self.module is not None:
+            return load_lark_module(self.module)
+
+        if self.transformer or self.postlex:
+            return build_lark(self.transformer, self.postlex)
+
+        module = generated_module()
+        if module is not None:
+            return load_lark_module(module)
+
+        if not self.cache_dir:
+            return build_lark()
+
+        fname = os.path.join(self.cache_dir, 'parser-{0}.pickle'.format(GRAMMAR_HASH))
+        # Unpickling a file planted by another user would run arbitrary code
+        if private_dir(self.cache_dir):
+            try:
+                with open(fname, 'rb') as fd:
+                    return load_lark(fd.read())
+            except (IOError, OSError):
+                pass
+            except Exception:
+                logger.warning('Ignoring corrupted parser cache %s', fname, exc_info=True)
+
+        lark_inst = build_lark()
+        if private_dir(self.cache_dir):
+            self._store(fname, dump_lark(lark_inst))
+        return lark_inst
+
+    def _store(self, fname, data):
+        try:
+            fd, tmpname = tempfile.mkstemp(dir=self.cache_dir)
+            with os.fdopen(fd, 'wb') as fobj:
+                fobj.write(data)
+            os.rename(tmpname, fname)
+            logger.info('Stored parser tables in %s', fname)
+        except (IOError, OSError):
+            logger.warning('Unable to store parser tables in %s', fname, exc_info=True)
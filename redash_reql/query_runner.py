@@ -1,26 +1,123 @@
+import hashlib
+import itertools
 import json
 import logging
 import numbers
 import re
 import sqlite3
-
-from collections import namedtuple
+import os
+import tempfile
+import threading
+import time
+
+from contextlib import contextmanager
+from datetime import datetime
+from collections import OrderedDict, namedtuple
 from dateutil import parser
 
-from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy import and_, func
+from sqlalchemy.orm import defer, joinedload
 
 from redash import models
 from redash.permissions import has_access, not_view_only
-from redash.query_runner import (TYPE_BOOLEAN, TYPE_DATETIME, TYPE_FLOAT,
-                                 TYPE_INTEGER, TYPE_STRING, BaseQueryRunner,
-                                 register)
-from redash.utils import JSONEncoder
-
+from redash.query_runner import (TYPE_BOOLEAN, TYPE_DATETIME,
+                                 TYPE_FLOAT, TYPE_INTEGER, TYPE_STRING,
+                                 BaseQueryRunner, register)
+from redash.utils import JSONEncoder, gen_query_hash
+
+from redash_reql.analysis import find_index_columns, find_used_columns
+from redash_reql import columnar
+from redash_reql.bulk import bulk_insert, create_ddl, rollback, row_getter
+from redash_reql.cache import LRUCache, size_from_env
+from redash_reql.governor import POLL_INTERVAL, Governor, QueryInterrupted
+from redash_reql.interchange import ResultStore, ResultsEncoder
 from redash_reql.parser import ReqlParser, Visitor, Tree
+from redash_reql.settings import SettingError, find_settings
+from redash_reql import single_flight as flights
+from redash_reql.sources import evaluate_source, find_sources, rewrite_query, source_table
+from redash_reql.table_cache import TABLE_NAME, TableCache, protect_attached
+from redash_reql.timings import Timings, profiled, report
+
+try:
+    from Queue import Empty, Queue
+except ImportError:
+    from queue import Empty, Queue
+
+try:
+    import flask
+except ImportError:
+    flask = None
 
 
 logger = logging.getLogger(__name__)
 
+# Default number of upstream queries fetched at the same time
+DEFAULT_CONCURRENCY = 4
+# Name of the threads fetching them
+FETCH_THREAD_NAME = 'reql-fetch'
+
+# The caches and the coordination of upstream runs are shared by every data
+# source of the process, so they are set up from the environment instead of
+# the data source options:
+#
+#   REDASH_REQL_PARSE_CACHE_SIZE    distinct query texts with their references
+#   REDASH_REQL_TABLE_CACHE_SIZE    materialized results (in MB)
+#   REDASH_REQL_RESULT_CACHE_SIZE   query outputs (in MB)
+#   REDASH_REQL_BINARY_RESULTS_SIZE binary encodings of the outputs (in MB)
+#   REDASH_REQL_BINARY_RESULTS_DIR  directory for the binary encodings
+#   REDASH_REQL_DEDUP_BACKEND       coordination of concurrent runs of the same
+#                                   upstream query (file, local or none)
+#   REDASH_REQL_DEDUP_TIMEOUT       seconds to wait for a concurrent run
+
+# Default number of distinct query texts with their references cached
+DEFAULT_PARSE_CACHE_SIZE = 256
+
+# Default size in megabytes for the materialized tables cache (disabled)
+DEFAULT_TABLE_CACHE_SIZE = 0
+
+# Default size in megabytes for the query outputs cache (disabled)
+DEFAULT_RESULT_CACHE_SIZE = 0
+
+# Default size in megabytes for the binary encodings of the outputs (disabled)
+DEFAULT_RESULT_STORE_SIZE = 0
+
+MEGABYTE = 1024 * 1024
+
+# Databases that can be attached to a connection (SQLITE_MAX_ATTACHED)
+MAX_ATTACHED = 10
+
+# Number of rows fetched at once from the query results
+FETCH_BATCH_SIZE = 5000
+
+# Engines running the final statement, the columnar one needs NumPy and
+# falls back to sqlite for the queries it doesn't support.
+ENGINES = ('sqlite', 'columnar')
+
+# Default coordination of concurrent upstream runs across worker processes
+DEFAULT_DEDUP_BACKEND = 'file'
+
+# Default size in megabytes of the upstream results above which the database
+# is kept in a temporary file instead of memory (0 disables it)
+DEFAULT_SPILL_THRESHOLD = 256
+
+# Page cache and memory mapped size in bytes for the temporary file databases
+SPILL_CACHE_SIZE = 64 * 1024 * 1024
+SPILL_MMAP_SIZE = 1024 * 1024 * 1024
+
+# Declared sqlite types for the Redash column types, they give the columns
+# a numeric affinity and allow to know the type of the output columns. The
+# rest are left without a type, so without an affinity converting values:
+# Redash labels as string any column with a null or an empty string, and
+# TEXT would turn its numbers into strings, while the date ones would turn
+# numeric looking strings into numbers.
+SQLITE_TYPES = {
+    TYPE_INTEGER: 'INTEGER',
+    TYPE_FLOAT: 'REAL',
+}
+REDASH_TYPES = dict((v, k) for k, v in SQLITE_TYPES.items())
+
+QUERY_REF_RE = re.compile(r'^query_(\d+)(_refresh)?$', re.I)
+
 
 class ReqlVisitor(Visitor):
     """ Search among the table refrences in the query to find those
@@ -47,7 +144,7 @@ class ReqlVisitor(Visitor):
         if t_name.type == 'DQUOTED':
             value = value[1:-1].replace('""', '"')
 
-        m = re.match(r'^query_(\d+)(_refresh)?$', value, re.I)
+        m = QUERY_REF_RE.match(value)
         if m:
             query_id = int(m.group(1))
             self.queries.append(
@@ -84,54 +181,359 @@ def _guess_type(value):
 
     return TYPE_STRING
 
-# Create a shared instance of the parser, since it's expensive to generate
-# it from the grammar at runtime. It should be thread safe though.
-reql_parser = ReqlParser()
 
-def extract_queries(query):
-    ast = reql_parser.parse(query)
+_string_types = (str, type(u''))
+
+# Well formed ISO-8601 dates and datetimes, which dateutil always accepts
+# as long as the fields are in range.
+_iso_datetime_re = re.compile(r'''
+    ^(\d{4})-(\d{2})-(\d{2})
+    (?:[T\ ](\d{2}):(\d{2})(?::(\d{2})(?:\.\d{1,6})?)?
+       (?:Z|[+-](\d{2}):?(\d{2}))?
+    )?$
+    ''', re.X)
+
+# Distinct values remembered per column when falling back to dateutil
+DATE_CACHE_SIZE = 1024
 
-    visitor = ReqlVisitor()
-    visitor.visit(ast)
 
-    return visitor.queries
+def _is_iso_datetime(value):
+    m = _iso_datetime_re.match(value)
+    if not m:
+        return False
 
+    year, month, day, hour, minute, second, tz_hour, tz_minute = [
+        int(x) if x else 0 for x in m.groups()]
+    if tz_hour > 23 or tz_minute > 59:
+        return False
 
-def _load_query(user, q):
     try:
-        query = models.Query.get_by_id(q.id)
-    except NoResultFound:
-        query = None
+        datetime(year, month, day, hour, minute, second)
+    except ValueError:
+        return False
+    return True
 
-    location = '(at line {} column {})'.format(q.line, q.column)
 
-    if not query or user.org_id != query.org_id:
-        raise PermissionError(u"Query id {} not found. {}".format(query_id, location))
+def _guess_datetime(value, cache):
+    cacheable = isinstance(value, _string_types)
+    if cacheable:
+        if _is_iso_datetime(value):
+            return TYPE_DATETIME
 
-    if not has_access(query.data_source.groups, user, not_view_only):
-        raise PermissionError(u"You are not allowed to execute queries on {} data source (used for query id {}). {}".format(
-            query.data_source.name, query.id, location))
+        guess = cache.get(value)
+        if guess is not None:
+            return guess
 
-    return query
+    try:
+        parser.parse(value)
+        guess = TYPE_DATETIME
+    except (ValueError, OverflowError):
+        guess = TYPE_STRING
 
+    if cacheable and len(cache) < DATE_CACHE_SIZE:
+        cache[value] = guess
 
-def create_tables_from_queries(user, conn, queries):
-    # Sort first the ones to refresh in case there are some dupes
-    queries = sorted(queries, key=lambda x: x.id * (-1 if x.refresh else 1))
+    return guess
 
-    done = set()
-    for q in queries:
-        if q.name in done:
+
+def _guess_column_type(current, values, date_cache):
+    """ Folds `_guess_type` over the values of a column, starting from the
+        `current` type. Costly checks are skipped when no outcome of them
+        could keep the column from degrading to TYPE_STRING.
+    """
+    for value in values:
+        if value == '' or value is None:
+            return TYPE_STRING
+
+        if isinstance(value, numbers.Integral):
+            guess = TYPE_INTEGER
+        elif isinstance(value, float):
+            guess = TYPE_FLOAT
+        elif current not in (None, TYPE_BOOLEAN, TYPE_DATETIME):
+            return TYPE_STRING
+        elif unicode(value).lower() in ('true', 'false'):
+            guess = TYPE_BOOLEAN
+        elif current == TYPE_BOOLEAN:
+            return TYPE_STRING
+        else:
+            guess = _guess_datetime(value, date_cache)
+
+        if current is None:
+            current = guess
+        elif current != guess:
+            return TYPE_STRING
+
+    return current
+
+
+class ColumnTypeGuesser(object):
+    """ Infers the type of the columns in a result set, giving the same
+        outcome as applying `_guess_type` to every cell. Rows are consumed
+        in batches, checking one column at a time, and columns are no
+        longer checked once they have degraded to TYPE_STRING.
+
+        Columns whose type is `known` beforehand are never checked.
+    """
+
+    def __init__(self, count, known=None):
+        self.types = list(known) if known else [None] * count
+        self._active = [j for j in range(count) if self.types[j] is None]
+        self._date_caches = [{} for _ in range(count)]
+
+    def update(self, rows):
+        if not rows or not self._active:
+            return
+
+        for j in self._active:
+            self.types[j] = _guess_column_type(
+                self.types[j], (row[j] for row in rows), self._date_caches[j])
+
+        self._active = [j for j in self._active if self.types[j] != TYPE_STRING]
+
+
+# Create a shared instance of the parser, since it's expensive to generate
+# it from the grammar at runtime. It's only loaded when first used and it
+# should be thread safe though.
+reql_parser = ReqlParser()
+
+# Dashboards refresh the same queries over and over, so remember the
+# references found on each query text to avoid parsing it again.
+extract_queries_cache = LRUCache(size_from_env(
+    'REDASH_REQL_PARSE_CACHE_SIZE', DEFAULT_PARSE_CACHE_SIZE))
+
+# Upstream results materialized as sqlite databases shared by all the runs
+# in the process, sized by REDASH_REQL_TABLE_CACHE_SIZE (in MB).
+table_cache = TableCache(size_from_env(
+    'REDASH_REQL_TABLE_CACHE_SIZE', DEFAULT_TABLE_CACHE_SIZE, MEGABYTE))
+
+# Outputs of the queries by their fingerprint, so runs reading the same
+# upstream results as a previous one return its output right away.
+result_cache = LRUCache(size_from_env(
+    'REDASH_REQL_RESULT_CACHE_SIZE', DEFAULT_RESULT_CACHE_SIZE, MEGABYTE))
+
+# Outputs encoded in binary by their JSON text, so queries reading them load
+# their columns instead of decoding the text.
+result_store = ResultStore(
+    size_from_env('REDASH_REQL_BINARY_RESULTS_SIZE', DEFAULT_RESULT_STORE_SIZE, MEGABYTE),
+    path=os.environ.get('REDASH_REQL_BINARY_RESULTS_DIR'))
+
+# Concurrent runs refreshing the same upstream query wait for one of them
+single_flight = flights.create(
+    os.environ.get('REDASH_REQL_DEDUP_BACKEND') or DEFAULT_DEDUP_BACKEND,
+    float(os.environ.get('REDASH_REQL_DEDUP_TIMEOUT') or flights.DEFAULT_TIMEOUT))
+
+
+# Lexical tokens relevant for finding candidate query references, anything
+# inside comments or string literals is skipped.
+_scan_re = re.compile(r'''
+      --[^\n]*
+    | /\*[\s\S]*?(?:\*/|$)
+    | '(?:[^']|'')*'?
+    | "(?P<dquoted>(?:[^"]|"")*)"?
+    | (?P<cname>[A-Za-z_][A-Za-z0-9_]*)
+    ''', re.X)
+
+# Quick check to avoid even tokenizing queries without references
+_scan_hint_re = re.compile(r'query_\d', re.I)
+
+
+def scan_queries(query):
+    """ Finds the names of the identifiers that look like query references
+        without parsing the query. It might report identifiers that are not
+        table references but never misses one found by `ReqlVisitor`.
+    """
+    names = set()
+    if not _scan_hint_re.search(query):
+        return names
+
+    for m in _scan_re.finditer(query):
+        if m.group('cname') is not None:
+            value = m.group('cname')
+        elif m.group('dquoted') is not None:
+            value = m.group('dquoted').replace('""', '"')
+        else:
             continue
 
-        query = _load_query(user, q)
+        if QUERY_REF_RE.match(value):
+            names.add(value)
+
+    return names
+
+
+# Possible ReQL source expressions, `name[...]`, or SET statements
+_parse_hint_re = re.compile(r'\w\s*\[|\bSET\b', re.I)
+
+QueryAnalysis = namedtuple('QueryAnalysis', 'queries indexes columns sources settings sql')
+
+
+def analyze_query(query, validate=False):
+    """ Parses the query to obtain the query references, the columns of
+        them worth indexing and the columns actually used, as well as the
+        ReQL sources and SET statements, with the query rewritten to use the
+        source tables and without those statements. Unless `validate` is
+        given the query is only parsed when there might be any of them.
+    """
+    if not validate and not scan_queries(query) and not _parse_hint_re.search(query):
+        return QueryAnalysis((), (), (), (), (), query)
+
+    text = query.encode('utf8') if isinstance(query, type(u'')) else query
+    key = hashlib.sha1(text).hexdigest()
+
+    analysis = extract_queries_cache.get(key)
+    if analysis is None:
+        ast = reql_parser.parse(query)
+
+        visitor = ReqlVisitor()
+        visitor.visit(ast)
+
+        names = set(q.name for q in visitor.queries)
+        indexes = find_index_columns(ast, names)
+        columns = find_used_columns(ast, names)
+        sources = find_sources(ast, query)
+        settings, edits = find_settings(ast, query)
+
+        analysis = QueryAnalysis(
+            tuple(visitor.queries),
+            tuple(sorted((k, tuple(sorted(v))) for k, v in indexes.items())),
+            tuple(sorted(
+                (k, None if v is None else frozenset(v))
+                for k, v in columns.items())),
+            tuple(sources),
+            tuple(sorted(settings.items())),
+            rewrite_query(query, sources, edits) if sources or edits else query)
+        extract_queries_cache.set(key, analysis)
+
+    return analysis
+
+
+def extract_queries(query, validate=False):
+    return list(analyze_query(query, validate).queries)
+
+
+def load_queries(user, refs, latest=True):
+    """ Loads the referenced queries checking the user can access them,
+        along with their latest results unless `latest` is false. For the
+        references asking to refresh them it's only useful as an estimate.
+
+        Everything is resolved with a couple of bulk queries, eager loading
+        the data sources and their groups. Returns a dict mapping the query
+        ids to `(query, latest_result)` tuples.
+    """
+    ids = set(q.id for q in refs)
+    queries = {}
+    if ids:
+        queries = dict((query.id, query) for query in models.Query.query.options(
+            joinedload(models.Query.data_source).subqueryload(
+                models.DataSource.data_source_groups)
+        ).filter(models.Query.id.in_(ids)))
+
+    for q in refs:
+        _check_access(user, q, queries.get(q.id))
+
+    wanted = list(queries.values()) if latest else []
+    results = _latest_results(wanted) if wanted else {}
+
+    return dict(
+        (id, (query, results.get((query.data_source_id, gen_query_hash(query.query_text)))))
+        for id, query in queries.items())
+
+
+def result_fingerprint(query, analysis, loaded, configuration=None):
+    """ Identifies the output of a query by its text, the configuration of
+        the runner and the id and retrieval time of every upstream result it
+        reads. Returns None when the output can't be reused because the
+        query refreshes upstream queries, reads ReQL sources or some of the
+        referenced queries has no result yet, or reads no results at all
+        (e.g. `SELECT datetime('now')` changes with nothing to tell it).
+    """
+    if not loaded or analysis.sources or any(q.refresh for q in analysis.queries):
+        return None
+
+    versions = []
+    for id in sorted(loaded):
+        latest = loaded[id][1]
+        if latest is None:
+            return None
+        versions.append((id, latest.id, unicode(latest.retrieved_at)))
+
+    data = json.dumps([query, versions, configuration or {}], sort_keys=True, default=unicode)
+    return hashlib.sha1(data.encode('utf8')).hexdigest()
+
+
+def estimate_size(loaded):
+    """ Estimates the bytes needed to ingest the results of the loaded
+        queries, from the size of their latest results as measured by the
+        database, so they don't need to be loaded.
+    """
+    ids = set(latest.id for _, latest in loaded.values() if latest is not None)
+    if not ids:
+        return 0
+
+    QueryResult = models.QueryResult
+    size = models.db.session.query(
+        func.sum(func.length(QueryResult.data)),
+    ).filter(QueryResult.id.in_(ids)).scalar()
+    return int(size or 0)
+
+
+def _sort_refs(refs):
+    # First the ones to refresh in case there are some dupes
+    return sorted(refs, key=lambda x: x.id * (-1 if x.refresh else 1))
+
+
+def _latest_results(queries):
+    """ Finds the most recent result for each (data source, query hash) of
+        the queries, like `QueryResult.get_latest` with no max age. Their
+        data is only loaded when accessed, cached tables don't need it.
+    """
+    QueryResult = models.QueryResult
+    hashes = set(gen_query_hash(q.query_text) for q in queries)
+    data_sources = set(q.data_source_id for q in queries)
+
+    newest = models.db.session.query(
+        QueryResult.data_source_id,
+        QueryResult.query_hash,
+        func.max(QueryResult.retrieved_at).label('retrieved_at'),
+    ).filter(
+        QueryResult.query_hash.in_(hashes),
+        QueryResult.data_source_id.in_(data_sources),
+    ).group_by(QueryResult.data_source_id, QueryResult.query_hash).subquery()
+
+    results = QueryResult.query.options(defer(QueryResult.data)).join(newest, and_(
+        QueryResult.data_source_id == newest.c.data_source_id,
+        QueryResult.query_hash == newest.c.query_hash,
+        QueryResult.retrieved_at == newest.c.retrieved_at,
+    )).order_by(QueryResult.id)
+
+    return dict(((r.data_source_id, r.query_hash), r) for r in results)
+
+
+def _results_data(ids):
+    """ The data of the query results by id, with a single query """
+    QueryResult = models.QueryResult
+    return dict(models.db.session.query(QueryResult.id, QueryResult.data).filter(
+        QueryResult.id.in_(ids)))
+
+
+def _data_source_groups(data_source):
+    # Same as `DataSource.groups` but from the eager loaded relationship
+    return dict((g.group_id, g.view_only) for g in data_source.data_source_groups)
+
+
+def _check_access(user, q, query):
+    location = '(at line {} column {})'.format(q.line, q.column)
+
+    if not query or user.org_id != query.org_id:
+        raise PermissionError(u"Query id {} not found. {}".format(q.id, location))
+
+    if not has_access(_data_source_groups(query.data_source), user, not_view_only):
+        raise PermissionError(u"You are not allowed to execute queries on {} data source (used for query id {}). {}".format(
+            query.data_source.name, query.id, location))
 
-        results = None
-        if not q.refresh:
-            latest = models.QueryResult.get_latest(query.data_source, query.query_text, max_age=-1)
-            results = latest.data if latest else None
 
-        if results is None:
+def _fetch_results(user, q, query, results):
+    if results is None:
+        def run():
             logger.info('Running query %s to get new results', query.id)
             results, error = query.data_source.query_runner.run_query(
                 query.query_text, user)
@@ -140,39 +542,634 @@ def create_tables_from_queries(user, conn, queries):
                 raise Exception(
                     u"Failed loading results for query id {0} (at line {1} column {2}).".format(
                         query.id, q.line, q.column))
+            return results
 
+        # The same text on the same data source gives the same results
+        results = single_flight.do(
+            (query.data_source_id, gen_query_hash(query.query_text)), run)
+
+    else:
+        logger.debug('Using previous results for query %s', query.id)
+
+    return results
+
+
+@contextmanager
+def _no_context():
+    yield
+
+
+def _app_context():
+    """ Returns a factory of contexts making the Flask app of the calling
+        thread, if any, the current one of another thread.
+    """
+    if flask is not None and flask.has_app_context():
+        return flask.current_app._get_current_object().app_context
+    return _no_context
+
+
+def _fetch_worker(user, jobs, done, cancelled, timings, governor, app_context):
+    # The models are bound to the app of the thread creating the tables
+    with app_context():
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+
+            # Once a fetch fails the remaining ones are useless
+            if cancelled.is_set() or governor.interrupted() is not None:
+                continue
+
+            q, query, results, _ = job
+            try:
+                with timings.phase('upstream'):
+                    results = _fetch_results(user, q, query, results)
+                done.put((q, results, None))
+            except Exception as ex:
+                cancelled.set()
+                done.put((q, None, ex))
+
+
+def _attach_table(conn, table_cache, key, name, schemas):
+    if len(schemas) >= MAX_ATTACHED:
+        return False
+
+    schema = 'reql_cache_{0}'.format(len(schemas))
+    if not table_cache.attach(conn, key, schema):
+        return False
+
+    schemas[schema] = (name, key)
+    conn.execute(u'CREATE TEMP VIEW {0} AS SELECT * FROM {1}.{2}'.format(
+        name, schema, TABLE_NAME))
+    logger.debug('Using materialized results %s for %s', key, name)
+    return True
+
+
+def create_tables_from_queries(user, conn, queries, concurrency=DEFAULT_CONCURRENCY,
+                               table_cache=None, columns=None, max_rows=None, timings=None,
+                               loaded=None, incremental=None, governor=None):
+    """ Creates a table, or a view of a materialized one, for each of the
+        query references. Returns the keys of the materialized results used
+        by the name of their views.
+    """
+    timings = timings or Timings()
+    governor = governor or Governor()
+    # Key column by query id of the tables updated from the previous result
+    incremental = dict(incremental or ())
+    if max_rows is not None:
+        # Truncated tables can't be shared with other runs
+        table_cache = None
+    if incremental and table_cache is None:
+        raise SettingError(
+            'Incremental keys need the materialized tables cache, which is disabled '
+            'or unusable with max_query_rows')
+
+    queries = _sort_refs(queries)
+
+    # Permissions and cached results are resolved upfront from this thread,
+    # the Redash models are bound to it.
+    if loaded is None:
+        with timings.phase('load_queries'):
+            loaded = load_queries(user, queries)
+
+    pending = OrderedDict()
+    attached = set()
+    # Attached databases with the name and key of their views
+    schemas = OrderedDict()
+    for q in queries:
+        if q.name in pending or q.name in attached:
+            continue
+
+        query, latest = loaded[q.id]
+
+        results = key = None
+        if not q.refresh:
+            if latest:
+                key = (query.id, latest.id, latest.retrieved_at)
+        elif table_cache is not None and query.id not in incremental:
+            table_cache.invalidate(query.id)
+
+        if key and table_cache is not None:
+            if _attach_table(conn, table_cache, key, q.name, schemas):
+                attached.add(q.name)
+                continue
+
+        if q.refresh and query.id in incremental:
+            # Refreshed results are only looked up to update them next time
+            key = (query.id, None, time.time())
+
+        pending[q.name] = (q, query, results, key)
+
+    # The stored results still needed, their data is only loaded now
+    stored = [name for name, (q, _, _, key) in pending.items() if key and not q.refresh]
+    if stored:
+        with timings.phase('load_results'):
+            data = _results_data(set(pending[name][3][1] for name in stored))
+        for name in stored:
+            q, query, _, key = pending[name]
+            pending[name] = (q, query, data[key[1]], key)
+
+    if pending:
+        _create_pending_tables(
+            user, conn, pending, concurrency, table_cache, schemas, dict(columns or ()),
+            max_rows, timings, incremental, governor)
+
+    if schemas:
+        protect_attached(conn, schemas)
+
+    return dict(schemas.values())
+
+
+def _create_pending_tables(user, conn, pending, concurrency, table_cache, schemas, columns,
+                           max_rows, timings, incremental, governor):
+    # Upstream queries are fetched by a bounded pool of worker threads,
+    # while the tables are created from this thread as soon as each one
+    # is ready since the sqlite connection can't be shared.
+    jobs, done = Queue(), Queue()
+    cancelled = threading.Event()
+
+    workers = max(1, min(int(concurrency), len(pending)))
+    app_context = _app_context()
+    for _ in range(workers):
+        thread = threading.Thread(
+            target=_fetch_worker, name=FETCH_THREAD_NAME,
+            args=(user, jobs, done, cancelled, timings, governor, app_context))
+        thread.daemon = True
+        thread.start()
+
+    for job in pending.values():
+        jobs.put(job)
+    for _ in range(workers):
+        jobs.put(None)
+
+    try:
+        for _ in range(len(pending)):
+            q, results, error = _wait_fetch(done, governor)
+            if error is not None:
+                raise error
+
+            if not isinstance(results, dict):
+                timings.incr(q.name + '.bytes', len(results))
+
+            # Materialize stored results so other runs can reuse them
+            key = pending[q.name][3]
+            # Refreshed results have no version
+            version = key if key and key[1] is not None else None
+            if key and table_cache is not None and len(schemas) < MAX_ATTACHED:
+                if key[0] in incremental:
+                    _update_materialized(table_cache, key, q.name, results,
+                                         incremental[key[0]], timings, governor, version)
+                else:
+                    def build(c):
+                        governor.watch(c)
+                        timings.incr(q.name + '.rows', create_table(
+                            c, TABLE_NAME, results, timings=timings, version=version))
+                    table_cache.store(key, build)
+                if _attach_table(conn, table_cache, key, q.name, schemas):
+                    continue
+
+            # Only the used columns, cached tables are shared so they have all
+            timings.incr(q.name + '.rows', create_table(
+                conn, q.name, results, used_columns=columns.get(q.name),
+                max_rows=max_rows, timings=timings, version=version))
+    except BaseException:
+        # Workers still running will discard their results
+        cancelled.set()
+        raise
+
+
+def _wait_fetch(done, governor):
+    # Upstream runs can't be interrupted but we can stop waiting for them
+    while True:
+        try:
+            return done.get(timeout=POLL_INTERVAL)
+        except Empty:
+            governor.check()
+
+
+def _update_materialized(table_cache, key, name, results, column, timings, governor,
+                         version=None):
+    def invalid(ex):
+        return SettingError(u'Invalid incremental key query_{0}.{1}: {2}'.format(
+            key[0], column, ex))
+
+    def build(conn):
+        governor.watch(conn)
+        try:
+            timings.incr(name + '.rows', create_table(
+                conn, TABLE_NAME, results, timings=timings, key=column, version=version))
+        except (sqlite3.IntegrityError, sqlite3.OperationalError) as ex:
+            governor.check()
+            # i.e. the key isn't unique or not a column of the results
+            raise invalid(ex)
+
+    def update(conn):
+        governor.watch(conn)
+        try:
+            changes = update_table(
+                conn, TABLE_NAME, results, column, timings=timings, version=version)
+        except ValueError as ex:
+            raise invalid(ex)
+        if changes is not None:
+            for counter, count in zip(('inserted', 'changed', 'deleted'), changes):
+                timings.incr(name + '.' + counter, count)
+        return changes
+
+    table_cache.update(key, build, update)
+
+
+_json_decoder = json.JSONDecoder()
+_json_ws = re.compile(r'[ \t\n\r]*')
+# Runs of JSON text without square brackets, other than inside strings
+_json_flat = re.compile(r'[^\[\]"]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^\[\]"]*)*')
+
+
+def _json_expect(data, idx, chars):
+    idx = _json_ws.match(data, idx).end()
+    char = data[idx:idx + 1]
+    if not char or char not in chars:
+        raise ValueError('Expecting {0!r} at char {1}'.format(chars, idx))
+    return char, idx + 1
+
+
+def _json_value(data, idx):
+    idx = _json_ws.match(data, idx).end()
+    return _json_decoder.raw_decode(data, idx)
+
+
+def _json_array(data, idx):
+    """ Generates the (value, end offset) pairs of a JSON array that starts
+        at the given offset, decoding a single element at a time.
+    """
+    _, idx = _json_expect(data, idx, '[')
+    if data[_json_ws.match(data, idx).end():].startswith(']'):
+        return
+
+    while True:
+        value, idx = _json_value(data, idx)
+        yield value, idx
+
+        char, idx = _json_expect(data, idx, ',]')
+        if char == ']':
+            return
+
+
+def _json_skip_array(data, idx):
+    """ Offset right after the JSON array that starts at the given offset,
+        found by matching its brackets without decoding the elements.
+    """
+    _, idx = _json_expect(data, idx, '[')
+    depth = 1
+    while depth:
+        idx = _json_flat.match(data, idx).end()
+        char = data[idx:idx + 1]
+        if char == '[':
+            depth += 1
+        elif char == ']':
+            depth -= 1
+        else:
+            raise ValueError('Unterminated array at char {0}'.format(idx))
+        idx += 1
+    return idx
+
+
+def read_results(results):
+    """ Obtains the columns and an iterator over the rows from a query
+        result, either already decoded or as JSON text.
+
+        When given JSON text only the columns are decoded upfront, rows are
+        decoded one by one as they are consumed so we never hold the whole
+        result set in memory.
+    """
+    if isinstance(results, dict):
+        return results['columns'], iter(results['rows'])
+
+    data = results
+    columns = rows_idx = None
+
+    _, idx = _json_expect(data, 0, '{')
+    while columns is None or rows_idx is None:
+        char, _ = _json_expect(data, idx, '"}')
+        if char == '}':
+            break
+
+        key, idx = _json_value(data, idx)
+        _, idx = _json_expect(data, idx, ':')
+
+        if key == 'rows':
+            rows_idx = idx
+            if columns is not None:
+                break
+            # Just skip over them if the columns come later in the document
+            idx = _json_skip_array(data, idx)
         else:
-            logger.debug('Using previous results for query %s', query.id)
+            value, idx = _json_value(data, idx)
+            if key == 'columns':
+                columns = value
+
+        char, idx = _json_expect(data, idx, ',}')
+        if char == '}':
+            break
+
+    if columns is None:
+        raise ValueError('Query results have no columns')
 
-        results = json.loads(results)
+    if rows_idx is None:
+        return columns, iter([])
 
-        create_table(conn, q.name, results)
-        done.add(q.name)
+    return columns, (row for row, _ in _json_array(data, rows_idx))
 
 
-def create_table(conn, table, results):
-    columns = ', '.join(
+def create_table(conn, table, results, used_columns=None, max_rows=None, timings=None,
+                 key=None, version=None):
+    """ Creates a table with the query results, restricted to the given set
+        of lowercased column names and number of rows if any.
+
+        With a `key` column the table is created WITHOUT ROWID using it as
+        the primary key, so it must be unique (and the results better
+        ordered by it).
+
+        The `version` of stored results, their `(query_id, result_id,
+        retrieved_at)`, saves hashing them again to find their encoding.
+
+        Returns the number of rows inserted.
+    """
+    # The binary encoding of the JSON text if stored, to skip decoding it
+    encoded = None if isinstance(results, dict) else result_store.get(results, version)
+    if encoded is not None:
+        logger.debug('Loading %s from its binary encoding', table)
+        results_columns = encoded.columns
+    else:
+        results_columns, results_rows = read_results(results)
+
+    indexes = range(len(results_columns))
+    if used_columns is not None:
+        indexes = [i for i, c in enumerate(results_columns) if c['name'].lower() in used_columns]
+        # A table needs at least one column
+        indexes = indexes or range(len(results_columns))[:1]
+        logger.debug('Loading %d of %d columns for %s',
+                     len(indexes), len(results_columns), table)
+    results_columns = [results_columns[i] for i in indexes]
+
+    quoted = [
         '"{}"'.format(c['name'].replace('"', '""'))
-        for c in results['columns'])
+        for c in results_columns]
 
-    ddl = u'CREATE TABLE {0} ({1})'.format(table, columns)
+    definitions = [
+        u'{0} {1}'.format(name, SQLITE_TYPES[c['type']])
+        if c.get('type') in SQLITE_TYPES else name
+        for name, c in zip(quoted, results_columns)]
+
+    if key is not None:
+        key = '"{}"'.format(key.replace('"', '""'))
+
+    ddl = create_ddl(table, definitions, key)
     logger.debug("DDL: %s", ddl)
     conn.execute(ddl)
 
-    dml = u'INSERT INTO {table} ({columns}) VALUES ({values})'.format(
-        table=table,
-        columns=columns,
-        values=', '.join(['?'] * len(results['columns'])))
-    logger.debug('DML: %s', ddl)
+    if encoded is not None:
+        rows = encoded.rows(indexes)
+    else:
+        to_tuple = row_getter([column['name'] for column in results_columns])
+        rows = (to_tuple(row) for row in results_rows)
+    if max_rows is not None:
+        rows = itertools.islice(rows, max_rows)
+    count = bulk_insert(conn, table, quoted, rows, timings)
+
+    logger.info('Inserted %d rows into %s', count, table)
+    return count
+
+
+def update_table(conn, table, results, key, timings=None, version=None):
+    """ Updates a table created with the given `key` column to match the
+        query results, writing only the rows inserted, changed or deleted
+        since it was created. The results are compared with the current
+        rows by their key without loading them into sqlite.
+
+        Returns a `(inserted, changed, deleted)` tuple, or None when the
+        table can't be updated because its columns or key differ from the
+        results. Raises ValueError if the key isn't unique in the results.
+        The `version` is the same as for `create_table`.
+    """
+    timings = timings or Timings()
+    encoded = None if isinstance(results, dict) else result_store.get(results, version)
+    if encoded is not None:
+        results_columns = encoded.columns
+    else:
+        results_columns, results_rows = read_results(results)
+
+    info = conn.execute(u'PRAGMA table_info({0})'.format(table)).fetchall()
+    if [(r[1], r[2]) for r in info] != [
+            (c['name'], SQLITE_TYPES.get(c.get('type'), '')) for c in results_columns]:
+        return None
+    # Names are case insensitive in sqlite, the key is the declared one
+    keys = [r[1] for r in info if r[5]]
+    if len(keys) != 1 or keys[0].lower() != key.lower():
+        return None
+
+    index = [r[1] for r in info].index(keys[0])
+    if encoded is not None:
+        rows = encoded.rows()
+    else:
+        to_tuple = row_getter([c['name'] for c in results_columns])
+        rows = (to_tuple(row) for row in results_rows)
+
+    start = time.time()
+    pending = {}
+    for row in rows:
+        value = row[index]
+        if value is None or value in pending:
+            raise ValueError(u'{0!r} is {1} in the results'.format(
+                value, 'null' if value is None else 'repeated'))
+        pending[value] = row
+    timings.add_time('decode', time.time() - start)
+
+    start = time.time()
+    deleted, changed = [], []
+    for row in conn.execute(u'SELECT * FROM {0}'.format(table)):
+        current = pending.pop(row[index], None)
+        if current is None:
+            deleted.append((row[index],))
+        elif current != row:
+            changed.append(current)
+    inserted = len(pending)
+
+    quoted = ['"{}"'.format(r[1].replace('"', '""')) for r in info]
+    conn.execute('BEGIN')
+    try:
+        conn.executemany(u'DELETE FROM {0} WHERE {1} = ?'.format(table, quoted[index]), deleted)
+        conn.executemany(u'INSERT OR REPLACE INTO {0} ({1}) VALUES ({2})'.format(
+            table, ', '.join(quoted), ', '.join(['?'] * len(quoted))),
+            itertools.chain(changed, pending.values()))
+    except:
+        rollback(conn)
+        raise
+    conn.execute('COMMIT')
+    timings.add_time('update', time.time() - start)
+
+    logger.info('Updated %s with %d inserted, %d changed and %d deleted rows',
+                table, inserted, len(changed), len(deleted))
+    return inserted, len(changed), len(deleted)
+
+
+def create_tables_from_sources(conn, sources):
+    """ Streams the rows of each ReQL source into its table """
+    for i, source in enumerate(sources):
+        columns, rows = evaluate_source(source)
+        create_table(conn, source_table(i), {'columns': columns, 'rows': rows})
+
+
+def declared_types(conn, query):
+    """ Obtains the Redash types of the query output columns which directly
+        reference a table column with a declared type, None for the rest.
+        It relies on sqlite resolving them for the columns of a view.
+    """
+    try:
+        conn.execute(u'CREATE TEMP VIEW _reql_output AS {0}'.format(query))
+    except (sqlite3.Error, sqlite3.Warning):
+        return None
+
+    try:
+        return [
+            REDASH_TYPES.get((row[2] or '').upper())
+            for row in conn.execute('PRAGMA table_info(_reql_output)')]
+    finally:
+        conn.execute('DROP VIEW _reql_output')
+
 
-    # Note that this method doesn't support generators
-    conn.executemany(dml, [
-        [ row.get(column['name']) for column in results['columns'] ]
-        for row in results['rows']
-        ])
+class _EncodingCursor(object):
+    """ Wraps a cursor encoding the rows fetched from it in binary, batch
+        by batch so they aren't kept.
+    """
+
+    def __init__(self, cursor, timings):
+        self.cursor = cursor
+        self.description = cursor.description
+        self.encoder = ResultsEncoder(len(cursor.description), JSONEncoder())
+        self.timings = timings
+
+    def fetchmany(self, size):
+        batch = self.cursor.fetchmany(size)
+        with self.timings.phase('binary'):
+            self.encoder.add(batch)
+        return batch
+
+
+def serialize_results(cursor, columns, known=None, max_rows=None, metadata=None,
+                      timings=None):
+    """ Encodes the rows from the cursor as JSON in batches, guessing the
+        type of the columns not `known` along the way. The columns are
+        encoded once all the rows are, so their types are final, but they
+        are placed first so readers find them without scanning the rows.
+
+        Only the first `max_rows` rows are included if given, and the
+        `metadata` dict is included as well. It can be given as a function
+        too, called once the rows are encoded.
+    """
+    timings = timings or Timings()
+    encoder = JSONEncoder()
+    names = [c['name'] for c in columns]
+
+    # Only computed columns need to be guessed from values
+    guesser = ColumnTypeGuesser(len(columns), known)
+
+    chunks = [None, u', "rows": [']
+    separator = u''
+    remaining = max_rows
+    while remaining is None or remaining > 0:
+        with timings.phase('fetch'):
+            batch = cursor.fetchmany(
+                FETCH_BATCH_SIZE if remaining is None else min(FETCH_BATCH_SIZE, remaining))
+        if not batch:
+            break
+        if remaining is not None:
+            remaining -= len(batch)
+        timings.incr('result.rows', len(batch))
+
+        with timings.phase('guess_types'):
+            guesser.update(batch)
+
+        # Encoding a batch at once avoids the per call overhead of the encoder
+        with timings.phase('encode'):
+            encoded = encoder.encode([dict(zip(names, row)) for row in batch])
+        timings.incr('result.bytes', len(encoded) - 2)
+        chunks.append(separator)
+        chunks.append(encoded[1:-1])
+        separator = u', '
+
+    for column, guess in zip(columns, guesser.types):
+        column['type'] = guess
+
+    chunks[0] = u'{"columns": ' + encoder.encode(columns)
+    chunks.append(u']')
+    if metadata is not None:
+        chunks.append(u', "metadata": ')
+        chunks.append(encoder.encode(metadata() if callable(metadata) else metadata))
+    chunks.append(u'}')
+    return u''.join(chunks)
+
+
+def create_indexes(conn, indexes):
+    """ Creates indexes for the given (table, columns) pairs, ignoring
+        the tables not loaded in the main database and unknown columns.
+    """
+    for table, columns in indexes:
+        cursor = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = ? COLLATE NOCASE",
+            (table,))
+        if cursor.fetchone() is None:
+            continue
+
+        existing = dict(
+            (row[1].lower(), row[1])
+            for row in conn.execute(u'PRAGMA table_info({0})'.format(table)))
+
+        for column in columns:
+            if column.lower() not in existing:
+                continue
+
+            column = existing[column.lower()]
+            ddl = u'CREATE INDEX IF NOT EXISTS "{0}" ON {1} ("{2}")'.format(
+                u'{0}__{1}'.format(table, column).replace('"', '""'),
+                table,
+                column.replace('"', '""'))
+            logger.debug('DDL: %s', ddl)
+            try:
+                conn.execute(ddl)
+            except sqlite3.OperationalError:
+                # Indexes are an optimization, don't fail if we run out of memory
+                logger.warning('Unable to create index on %s.%s', table, column, exc_info=True)
+                return
+
+
+# Whitespace, comments and terminators, all that's in an empty statement
+_empty_statement_re = re.compile(r'(?:\s|--[^\n]*(?:\n|$)|/\*(?:[^*]|\*(?!/))*(?:\*/|$)|;)*$')
+
+
+def split_statements(sql):
+    """ Splits the text in the statements sqlite would run one by one,
+        ignoring the empty ones, i.e. a trailing comment.
+    """
+    statements = []
+    start = 0
+    idx = sql.find(';')
+    while idx >= 0:
+        if sqlite3.complete_statement(sql[start:idx + 1]):
+            statements.append(sql[start:idx + 1])
+            start = idx + 1
+        idx = sql.find(';', idx + 1)
+    statements.append(sql[start:])
 
-    conn.commit()
-    logger.info('Inserted %d rows into %s', len(results['rows']), table)
+    return [s for s in statements if not _empty_statement_re.match(s)]
+
+
+def explain_query_plan(conn, query):
+    """ Obtains the lines of the EXPLAIN QUERY PLAN output for a query """
+    try:
+        cursor = conn.execute(u'EXPLAIN QUERY PLAN {0}'.format(query))
+    except (sqlite3.Error, sqlite3.Warning):
+        return []
+    return [row[-1] for row in cursor]
 
 
 class ReqlQueryRunner(BaseQueryRunner):
@@ -187,9 +1184,57 @@ class ReqlQueryRunner(BaseQueryRunner):
                     'type': 'string',
                     'title': 'Memory limit (in bytes)'
                 },
+                'concurrency': {
+                    'type': 'number',
+                    'title': 'Upstream queries fetched concurrently',
+                    'default': DEFAULT_CONCURRENCY
+                },
+                'spill_threshold': {
+                    'type': 'number',
+                    'title': 'Upstream results size to use a temporary file instead of memory '
+                             '(in MB, 0 disables it)',
+                    'default': DEFAULT_SPILL_THRESHOLD
+                },
+                'spill_dir': {
+                    'type': 'string',
+                    'title': 'Directory for the temporary files (system default if empty)'
+                },
+                'engine': {
+                    'type': 'string',
+                    'title': 'Execution engine (sqlite, or columnar for simple analytic queries '
+                             'over the materialized results with NumPy installed)',
+                    'default': ENGINES[0]
+                },
+                'max_execution_time': {
+                    'type': 'number',
+                    'title': 'Seconds a query can run, including the upstream queries '
+                             '(0 for no limit)'
+                },
+                'max_result_rows': {
+                    'type': 'number',
+                    'title': 'Rows returned by a query (no limit if empty)'
+                },
+                'timings_metadata': {
+                    'type': 'boolean',
+                    'title': 'Include the timings of each phase in the results metadata'
+                },
+                'profile': {
+                    'type': 'boolean',
+                    'title': 'Profile each run with cProfile (logged, slows down the runs)'
+                },
             }
         }
 
+    def __init__(self, configuration):
+        super(ReqlQueryRunner, self).__init__(configuration)
+
+        self.engine = self.configuration.get('engine') or ENGINES[0]
+        if self.engine not in ENGINES:
+            raise ValueError(u'Unknown engine {0}, expected one of: {1}'.format(
+                self.engine, ', '.join(ENGINES)))
+        if self.engine == 'columnar' and not columnar.available():
+            logger.warning('NumPy is not installed, the columnar engine is not available')
+
     @classmethod
     def annotate_query(cls):
         return False
@@ -198,66 +1243,226 @@ class ReqlQueryRunner(BaseQueryRunner):
     def name(cls):
         return "ReQL Results"
 
-    def _create_db(self):
+    def _create_db(self, settings, estimate=0):
+        """ Creates the database in memory unless the estimated size of the
+            upstream results is over the spill threshold, in that case it
+            goes to a temporary file. Returns the connection and the path of
+            the file if any.
+        """
+        threshold = self.configuration.get('spill_threshold')
+        threshold = DEFAULT_SPILL_THRESHOLD if threshold is None else float(threshold)
+        if threshold > 0 and estimate > threshold * 1024 * 1024:
+            return self._create_file_db(settings, estimate)
+
         conn = sqlite3.connect(':memory:', isolation_level=None)
 
-        if self.configuration['memory']:
+        memory = self._memory_limit(settings)
+        if memory:
             # See http://www.sqlite.org/pragma.html#pragma_page_size
             cursor = conn.execute('PRAGMA page_size')
             page_size, = cursor.fetchone()
             cursor.close()
 
-            pages = int(self.configuration['memory']) / page_size
+            pages = int(memory) // page_size
             conn.execute('PRAGMA max_page_count = {0}'.format(pages))
             conn.execute('VACUUM')
             logger.info('Restricted sqlite memory to %s bytes (page_size: %s, pages: %s)',
-                        self.configuration['memory'], page_size, pages)
+                        memory, page_size, pages)
 
             conn.commit()
 
-        return conn
+        self._tune_db(conn, settings)
+        return conn, None
+
+    def _memory_limit(self, settings):
+        """ The database size limit, queries can only lower the configured one """
+        configured = self.configuration.get('memory')
+        if 'memory' not in settings:
+            return configured
+        if not configured:
+            return settings['memory']
+        if not settings['memory']:
+            raise SettingError('The memory limit of the data source can not be removed')
+        return min(settings['memory'], int(configured))
+
+    def _create_file_db(self, settings, estimate):
+        fd, path = tempfile.mkstemp(
+            prefix='redash_reql-', suffix='.sqlite', dir=self.configuration.get('spill_dir') or None)
+        os.close(fd)
+        logger.info('Using %s for an estimated %d bytes of upstream results', path, estimate)
+
+        try:
+            conn = sqlite3.connect(path, isolation_level=None)
+            # The file is thrown away after the run, so durability is useless
+            conn.execute('PRAGMA journal_mode = OFF')
+            conn.execute('PRAGMA synchronous = OFF')
+            conn.execute('PRAGMA cache_size = {0:d}'.format(-SPILL_CACHE_SIZE // 1024))
+            conn.execute('PRAGMA mmap_size = {0:d}'.format(SPILL_MMAP_SIZE))
+            self._tune_db(conn, settings)
+        except:
+            os.unlink(path)
+            raise
+
+        return conn, path
+
+    def _tune_db(self, conn, settings):
+        if 'cache_size' in settings:
+            conn.execute('PRAGMA cache_size = {0:d}'.format(settings['cache_size']))
+        if 'temp_store' in settings:
+            conn.execute('PRAGMA temp_store = {0:d}'.format(settings['temp_store']))
+
+    def _execute(self, conn, statement, timings):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Query plan:\n%s', '\n'.join(explain_query_plan(conn, statement)))
+
+        # The time to the first row, the rest is spent when serializing
+        start = time.time()
+        cursor = conn.execute(statement)
+        elapsed = time.time() - start
+        timings.add_time('execute', elapsed)
+        return cursor, elapsed
 
     def run_query(self, query, user):
-        conn = self._create_db()
+        with profiled(bool(self.configuration.get('profile'))):
+            timings = Timings()
+            json_data, error = self._run_query(query, user, timings)
+            report(timings)
+        return json_data, error
+
+    def _run_query(self, query, user, timings):
+        governor = Governor(float(self.configuration.get('max_execution_time') or 0) or None)
+        with timings.phase('analyze'):
+            analysis = analyze_query(query)
+        settings = dict(analysis.settings)
+        # Fail early, even if the database ends up in a file
+        self._memory_limit(settings)
+
+        # Permissions and previous results are needed to choose the storage
+        refs = _sort_refs(analysis.queries)
+        with timings.phase('load_queries'):
+            loaded = load_queries(user, refs)
+
+        # Only once the permissions are checked
+        fingerprint = None
+        if result_cache.size > 0:
+            fingerprint = result_fingerprint(query, analysis, loaded, self.configuration)
+            json_data = result_cache.get(fingerprint) if fingerprint else None
+            if json_data is not None:
+                logger.info('Reusing the cached output %s', fingerprint)
+                timings.incr('result.cached')
+                return json_data, None
+
+        # The lowest of the limits of the data source and the query
+        max_result_rows = [
+            int(limit) for limit in (
+                settings.get('max_result_rows'), self.configuration.get('max_result_rows'))
+            if limit is not None]
+        max_result_rows = min(max_result_rows) if max_result_rows else None
+
+        encoding = None
+        conn, path = self._create_db(settings, estimate_size(loaded))
+        governor.watch(conn)
         try:
-            queries = extract_queries(query)
-            create_tables_from_queries(user, conn, queries)
+            logger.debug('Parse cache stats: %s', extract_queries_cache.stats())
+            materialized = create_tables_from_queries(
+                user, conn, analysis.queries,
+                concurrency=settings.get('concurrency')
+                or self.configuration.get('concurrency') or DEFAULT_CONCURRENCY,
+                table_cache=table_cache if table_cache.size > 0 else None,
+                columns=analysis.columns,
+                max_rows=settings.get('max_query_rows'),
+                timings=timings,
+                loaded=loaded,
+                incremental=settings.get('incremental_keys'),
+                governor=governor)
+            with timings.phase('sources'):
+                create_tables_from_sources(conn, analysis.sources)
+            with timings.phase('indexes'):
+                create_indexes(conn, analysis.indexes)
+
+            # Every statement but the last one just prepares the data for it,
+            # i.e. staging temporary tables and their indexes.
+            statements = split_statements(analysis.sql) or [u'']
+            statement_timings = []
+            for statement in statements[:-1]:
+                statement_timings.append(self._execute(conn, statement, timings)[1])
+
+            query = statements[-1]
+            with timings.phase('declared_types'):
+                known = declared_types(conn, query)
 
             with conn:
 
-                cursor = conn.execute(query)
+                cursor = None
+                if self.engine == 'columnar':
+                    start = time.time()
+                    with timings.phase('columnar'):
+                        # Previous statements could replace the views
+                        cursor = columnar.execute(conn, query, reql_parser.parse, keys=dict(
+                            (name.lower(), key) for name, key in materialized.items()
+                            if len(statements) == 1))
+                    elapsed = time.time() - start
+                if cursor is None:
+                    cursor, elapsed = self._execute(conn, query, timings)
+                statement_timings.append(elapsed)
+
+                metadata = {}
+                if len(statements) > 1:
+                    logger.info('Statement timings: %s', ', '.join(
+                        '{0:.3f}s'.format(t) for t in statement_timings))
+                    metadata['statements'] = [
+                        {'sql': sql.strip(), 'time': t}
+                        for sql, t in zip(statements, statement_timings)]
+
+                include_timings = self.configuration.get('timings_metadata')
+
+                def get_metadata():
+                    # Once the rows are encoded, so it covers most of the run
+                    if include_timings:
+                        metadata['timings'] = timings.as_dict()
+                    return metadata
 
                 if cursor.description is not None:
                     columns = self.fetch_columns(
                         [(i[0], None) for i in cursor.description])
 
-                    rows = []
-                    column_names = [c['name'] for c in columns]
-
-                    for i, row in enumerate(cursor):
-                        for j, col in enumerate(row):
-                            guess = _guess_type(col)
-
-                            if columns[j]['type'] is None:
-                                columns[j]['type'] = guess
-                            elif columns[j]['type'] != guess:
-                                columns[j]['type'] = TYPE_STRING
+                    if known is not None and len(known) != len(columns):
+                        known = None
 
-                        rows.append(dict(zip(column_names, row)))
+                    if result_store.size > 0:
+                        cursor = encoding = _EncodingCursor(cursor, timings)
 
-                    data = {'columns': columns, 'rows': rows}
                     error = None
-                    json_data = json.dumps(data, cls=JSONEncoder)
+                    json_data = serialize_results(
+                        cursor, columns, known, max_rows=max_result_rows,
+                        metadata=get_metadata if metadata or include_timings else None,
+                        timings=timings)
                 else:
                     error = 'Query completed but it returned no data.'
                     json_data = None
 
         except KeyboardInterrupt:
-            conn.cancel()
-            error = "Query cancelled by user."
+            governor.cancel()
+            error = governor.interrupted()
+            json_data = None
+        except (QueryInterrupted, sqlite3.OperationalError):
+            # Statements interrupted by the governor fail as well
+            error = governor.interrupted()
+            if error is None:
+                raise
+            logger.info('Run interrupted: %s', error)
             json_data = None
         finally:
             conn.close()
+            if path is not None:
+                os.unlink(path)
+
+        if fingerprint and error is None and json_data is not None:
+            result_cache.set(fingerprint, json_data, weight=len(json_data))
+
+        if encoding is not None and error is None:
+            with timings.phase('binary'):
+                result_store.put(json_data, encoding.encoder.finish(columns))
 
         return json_data, error
 
@@ -0,0 +1,108 @@
+"""
+Per query tuning knobs given with `SET name = value` statements, which are
+removed from the query before handing it to sqlite.
+"""
+import re
+from collections import OrderedDict
+
+from redash_reql.analysis import is_tree, literal_value, node_span
+
+
+class SettingError(Exception):
+    pass
+
+
+def _count(value):
+    value = int(value)
+    if value < 0:
+        raise ValueError('must not be negative')
+    return value
+
+
+def _positive(value):
+    value = int(value)
+    if value < 1:
+        raise ValueError('must be positive')
+    return value
+
+
+def _temp_store(value):
+    # See https://www.sqlite.org/pragma.html#pragma_temp_store
+    modes = ('default', 'file', 'memory')
+    if unicode(value).lower() in modes:
+        return modes.index(unicode(value).lower())
+    if int(value) in (0, 1, 2):
+        return int(value)
+    raise ValueError('must be one of {0}'.format(', '.join(modes)))
+
+
+_incremental_key_re = re.compile(r'^\s*query_(\d+)\.(\w+)\s*$', re.I)
+
+
+def _incremental_keys(value):
+    # i.e. 'query_1.id, query_7.day'
+    keys = []
+    for item in unicode(value).split(','):
+        match = _incremental_key_re.match(item)
+        if not match:
+            raise ValueError(u'expected query_N.column, got {0!r}'.format(item.strip()))
+        keys.append((int(match.group(1)), match.group(2)))
+    return tuple(keys)
+
+
+# Supported settings and the function validating their values
+SETTINGS = OrderedDict([
+    # Database size limit in bytes, can only lower the `memory` configuration
+    ('memory', _count),
+    # PRAGMA cache_size, pages or KiB when negative
+    ('cache_size', int),
+    ('temp_store', _temp_store),
+    # Upstream queries fetched concurrently
+    ('concurrency', _positive),
+    # Rows ingested from each upstream query result
+    ('max_query_rows', _count),
+    # Rows returned by the query
+    ('max_result_rows', _count),
+    # Key columns, unique and not null, of the upstream queries whose
+    # materialized tables are updated with the changes from a new result
+    # instead of being rebuilt (needs the table cache)
+    ('incremental_keys', _incremental_keys),
+])
+
+
+def find_settings(ast, text):
+    """ Obtains the settings from the SET statements in the query, as a
+        dict of validated values, and the `(start, end, replacement)` edits
+        removing those statements from the text.
+    """
+    settings = {}
+    edits = []
+    # A single statement is the root of the tree
+    stmts = [ast] if ast.data == 'stmt' else ast.children
+    for stmt in stmts:
+        if not is_tree(stmt, 'stmt') or not is_tree(stmt.children[0], 'reql_set_stmt'):
+            continue
+
+        name, value = stmt.children[0].children[1], stmt.children[0].children[-1]
+        negative = len(stmt.children[0].children) > 4
+        key = name.value.lower()
+        location = u'(at line {0} column {1})'.format(name.line, name.column)
+        if key not in SETTINGS:
+            raise SettingError(u'Unknown setting {0} {1}, expected one of: {2}'.format(
+                name.value, location, ', '.join(SETTINGS)))
+
+        try:
+            value = literal_value(value)
+            settings[key] = SETTINGS[key](-value if negative else value)
+        except (TypeError, ValueError) as ex:
+            raise SettingError(u'Invalid value for setting {0} {1}: {2}'.format(
+                name.value, location, ex))
+
+        # Remove the statement along with its terminator
+        start, end = node_span(stmt)
+        rest = text[end:]
+        if rest.lstrip().startswith(';'):
+            end += len(rest) - len(rest.lstrip()) + 1
+        edits.append((start, end, u''))
+
+    return settings, edits
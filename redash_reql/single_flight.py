@@ -0,0 +1,237 @@
+"""
+Single flight coordination of upstream query runs, so concurrent ReQL runs
+refreshing the same query wait for one of them instead of hitting the
+upstream data source repeatedly.
+
+Backends implement `do(key, func)`, calling `func` unless a run for the same
+key is in progress, in which case its result is reused. Waiting is bounded
+by the `timeout` seconds given to the backend and if the leader fails or
+takes longer the function is called anyway. Use `create` to get one by name.
+"""
+import errno
+import fcntl
+import hashlib
+import io
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from redash_reql.cache import private_dir
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for the leader before running the function anyway
+DEFAULT_TIMEOUT = 300
+
+# Interval in seconds to check the lock file while waiting
+POLL_INTERVAL = 0.1
+
+
+class NoSingleFlight(object):
+    """ Backend without any coordination """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        self.timeout = timeout
+
+    def do(self, key, func):
+        return func()
+
+
+class _Flight(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.failed = False
+
+
+class LocalSingleFlight(object):
+    """ Coordinates the threads of the current process """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, func):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if leader:
+            try:
+                flight.result = func()
+                return flight.result
+            except BaseException:
+                flight.failed = True
+                raise
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+
+        if flight.done.wait(self.timeout) and not flight.failed:
+            logger.debug('Reusing the result of a concurrent run for %s', key)
+            return flight.result
+
+        logger.warning('Concurrent run for %s failed or timed out, running it again', key)
+        return func()
+
+
+class FileSingleFlight(object):
+    """ Coordinates the processes of the host sharing a directory, by means
+        of lock files. Processes waiting for the lock leave a file telling
+        so, in that case the leader writes its result next to the lock for
+        them to read it once the lock is released, and the last one to read
+        it removes it. A leader dying releases its lock too.
+
+        Results are text (i.e. JSON) since they are written to files.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, path=None):
+        self.timeout = timeout
+        self.path = path or os.path.join(
+            tempfile.gettempdir(), 'redash_reql-flights-{0}'.format(os.getuid()))
+
+    def do(self, key, func):
+        if not private_dir(self.path):
+            logger.warning('Not coordinating runs, %s is not a private directory', self.path)
+            return func()
+
+        prefix = hashlib.sha1(repr(key).encode('utf8')).hexdigest()
+        name = os.path.join(self.path, prefix)
+        start = time.time()
+
+        fd = os.open(name + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            waited = not self._try_acquire(fd)
+            if waited:
+                waiting = self._wait_file(prefix)
+                acquired = self._acquire(fd, start + self.timeout)
+                if waiting is not None:
+                    self._remove(waiting)
+                if not acquired:
+                    logger.warning(
+                        'Timed out waiting for a concurrent run of %s, running it again', key)
+                    return func()
+
+            try:
+                if waited:
+                    # A result written since we started comes from a run we waited for
+                    result = self._read(name + '.result', start)
+                    if not self._waiters(prefix):
+                        self._remove(name + '.result')
+                    if result is not None:
+                        logger.debug('Reusing the result of a concurrent run for %s', key)
+                        return result
+
+                result = func()
+                if self._waiters(prefix):
+                    self._write(name + '.result', result)
+                else:
+                    # Left by followers that timed out
+                    self._remove(name + '.result')
+                return result
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def _wait_file(self, prefix):
+        try:
+            fd, fname = tempfile.mkstemp(prefix=prefix + '.', suffix='.wait', dir=self.path)
+        except (IOError, OSError):
+            logger.warning('Unable to wait for a result in %s', self.path, exc_info=True)
+            return None
+        os.close(fd)
+        return fname
+
+    def _waiters(self, prefix):
+        """ Whether other processes wait for the key, ignoring the files
+            left by those that died while waiting.
+        """
+        stale = time.time() - self.timeout
+        found = False
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return False
+
+        for fname in names:
+            if not (fname.startswith(prefix + '.') and fname.endswith('.wait')):
+                continue
+            fname = os.path.join(self.path, fname)
+            try:
+                if os.stat(fname).st_mtime >= stale:
+                    found = True
+                    continue
+            except OSError:
+                continue
+            self._remove(fname)
+        return found
+
+    def _remove(self, fname):
+        try:
+            os.unlink(fname)
+        except OSError:
+            pass
+
+    def _try_acquire(self, fd):
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except (IOError, OSError) as ex:
+            if ex.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+        return False
+
+    def _acquire(self, fd, deadline):
+        while not self._try_acquire(fd):
+            if time.time() >= deadline:
+                return False
+            time.sleep(POLL_INTERVAL)
+        return True
+
+    def _read(self, fname, since):
+        try:
+            with io.open(fname, encoding='utf8') as fd:
+                finished = float(fd.readline())
+                if finished < since:
+                    return None
+                return fd.read()
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write(self, fname, result):
+        if not isinstance(result, type(u'')):
+            result = result.decode('utf8')
+        try:
+            fd, tmpname = tempfile.mkstemp(dir=self.path)
+            with io.open(fd, 'w', encoding='utf8') as fobj:
+                fobj.write(u'{0!r}\n'.format(time.time()))
+                fobj.write(result)
+            os.rename(tmpname, fname)
+        except (IOError, OSError):
+            logger.warning('Unable to share the result in %s', fname, exc_info=True)
+
+
+BACKENDS = {
+    'none': NoSingleFlight,
+    'local': LocalSingleFlight,
+    'file': FileSingleFlight,
+}
+
+
+def create(name, timeout=DEFAULT_TIMEOUT):
+    """ Creates the backend with the given name, raises ValueError if
+        there is none.
+    """
+    if name not in BACKENDS:
+        raise ValueError(u'Unknown dedup backend {0}, expected one of: {1}'.format(
+            name, ', '.join(sorted(BACKENDS))))
+    return BACKENDS[name](timeout)
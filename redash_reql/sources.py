@@ -0,0 +1,242 @@
+"""
+ReQL table sources, the `name[params]::mapper[params]` expressions found in
+a FROM or WITH clause.
+
+Sources are evaluated by a provider registered for their name, returning the
+columns and an iterator of rows, and each mapper stage is a registered
+transform receiving and returning them as well. Rows are pulled on demand
+through the whole chain while they are streamed into a temporary table,
+which replaces the expression in the query executed by sqlite.
+"""
+import csv
+import io
+import itertools
+import json
+import sys
+import textwrap
+
+from collections import namedtuple
+
+from redash_reql.analysis import is_tree, literal_value, node_span
+
+
+ReqlSource = namedtuple('ReqlSource', 'name args kwargs mappers line column start end cte')
+ReqlMapper = namedtuple('ReqlMapper', 'name args kwargs')
+
+
+class SourceError(Exception):
+    pass
+
+
+_providers = {}
+_mappers = {}
+
+
+def register_source(name, provider=None):
+    """ Registers a provider for a source name, it's called with the source
+        params and must return a list of columns (dicts with `name` and
+        optionally `type`) and an iterable of row dicts.
+
+        Can be used as a decorator.
+    """
+    def decorator(func):
+        _providers[name.lower()] = func
+        return func
+    return decorator(provider) if provider else decorator
+
+
+def register_mapper(name, mapper=None):
+    """ Registers a mapper stage, it's called with the columns and rows
+        produced by the previous stage followed by its params and must
+        return the new columns and rows.
+
+        Can be used as a decorator.
+    """
+    def decorator(func):
+        _mappers[name.lower()] = func
+        return func
+    return decorator(mapper) if mapper else decorator
+
+
+def _block_text(node):
+    text = node.children[0].value[2:-2]
+
+    if node.data == 'reql_block_verbatim':
+        # Only drop the lines of the delimiters
+        first, sep, rest = text.partition('\n')
+        if sep and not first.strip():
+            text = rest
+        head, sep, last = text.rpartition('\n')
+        if sep and not last.strip():
+            text = head
+        return text
+
+    text = textwrap.dedent(text).strip()
+    if node.data == 'reql_block_folded':
+        text = ' '.join(line.strip() for line in text.splitlines())
+    return text
+
+
+def _param_value(node):
+    if is_tree(node) and node.data in ('reql_block', 'reql_block_verbatim', 'reql_block_folded'):
+        return _block_text(node)
+    if is_tree(node, 'parameter'):
+        node = node.children[0]
+    if not is_tree(node) and node.type == 'PARAMETER':
+        raise SourceError(u'Unsupported ReQL param {0} (at line {1} column {2})'.format(
+            node.value, node.line, node.column))
+
+    try:
+        return literal_value(node)
+    except ValueError as ex:
+        raise SourceError(u'Unsupported ReQL param: {0}'.format(ex))
+
+
+def _params(node):
+    args, kwargs = [], {}
+    if node is None:
+        return args, kwargs
+
+    for child in node.children:
+        if not is_tree(child):
+            continue  # brackets and commas
+        if child.data == 'reql_pair':
+            kwargs[child.children[0].value] = _param_value(child.children[1])
+        else:
+            args.append(_param_value(child))
+
+    return args, kwargs
+
+
+def find_sources(ast, text):
+    """ Obtains the ReQL sources used in the query ordered by position """
+    sources = []
+    for node in ast.iter_subtrees():
+        if node.data not in ('table_ref', 'reql_cte'):
+            continue
+
+        for expr in node.children:
+            if not is_tree(expr, 'reql_expr'):
+                continue
+
+            name = expr.children[0]
+            params = expr.children[1] if len(expr.children) > 1 else None
+            args, kwargs = _params(params)
+
+            mappers = []
+            for mapper in expr.children[2:]:
+                m_args, m_kwargs = _params(mapper.children[1] if len(mapper.children) > 1 else None)
+                mappers.append(ReqlMapper(mapper.children[0].value, tuple(m_args), m_kwargs))
+
+            start, end = node_span(expr)
+            sources.append(ReqlSource(
+                name.value, tuple(args), kwargs, tuple(mappers),
+                name.line, name.column, start, end, node.data == 'reql_cte'))
+
+    return sorted(sources, key=lambda s: s.start)
+
+
+def source_table(index):
+    return 'reql_source_{0}'.format(index)
+
+
+def rewrite_query(text, sources, edits=()):
+    """ Replaces the source expressions in the query with their tables,
+        applying as well any other `(start, end, replacement)` edits.
+    """
+    edits = list(edits)
+    for i, source in enumerate(sources):
+        table = source_table(i)
+        if not source.cte:
+            replacement = table
+        elif text[:source.start].rstrip().endswith('('):
+            replacement = u'SELECT * FROM {0}'.format(table)
+        else:
+            # CTE bodies without parens around the expression
+            replacement = u'(SELECT * FROM {0})'.format(table)
+        edits.append((source.start, source.end, replacement))
+
+    chunks = []
+    offset = 0
+    for start, end, replacement in sorted(edits):
+        chunks.append(text[offset:start])
+        chunks.append(replacement)
+        offset = end
+    chunks.append(text[offset:])
+    return u''.join(chunks)
+
+
+def evaluate_source(source):
+    """ Runs the provider and mappers for a source, obtaining the columns
+        and a lazy iterator over the rows.
+    """
+    location = u'(at line {0} column {1})'.format(source.line, source.column)
+
+    provider = _providers.get(source.name.lower())
+    if provider is None:
+        raise SourceError(u'Unknown ReQL source {0} {1}'.format(source.name, location))
+
+    columns, rows = provider(*source.args, **source.kwargs)
+    for mapper in source.mappers:
+        func = _mappers.get(mapper.name.lower())
+        if func is None:
+            raise SourceError(u'Unknown ReQL mapper {0} {1}'.format(mapper.name, location))
+        columns, rows = func(columns, rows, *mapper.args, **mapper.kwargs)
+
+    return columns, rows
+
+
+@register_source('json')
+def json_source(data):
+    """ Rows from a JSON document, either an array of objects or a Redash
+        result with `columns` and `rows`.
+    """
+    data = json.loads(data)
+    if isinstance(data, dict):
+        return data['columns'], iter(data['rows'])
+
+    names = []
+    for row in data:
+        names.extend(k for k in row if k not in names)
+    return [{'name': n} for n in names], iter(data)
+
+
+@register_source('csv')
+def csv_source(data, delimiter=','):
+    """ Rows from CSV text, the first line having the column names """
+    return _csv_rows(io.StringIO(data if isinstance(data, type(u'')) else data.decode('utf8')),
+                     delimiter)
+
+
+def _csv_rows(fd, delimiter=','):
+    if sys.version_info[0] < 3:
+        lines = (line.encode('utf8') for line in fd)
+        reader = (
+            [cell.decode('utf8') for cell in row]
+            for row in csv.reader(lines, delimiter=str(delimiter)))
+    else:
+        reader = csv.reader(fd, delimiter=delimiter)
+
+    try:
+        names = next(reader)
+    except StopIteration:
+        raise SourceError(u'CSV data without a header')
+
+    columns = [{'name': n} for n in names]
+    return columns, (dict(zip(names, row)) for row in reader)
+
+
+@register_mapper('limit')
+def limit_mapper(columns, rows, count, offset=0):
+    return columns, itertools.islice(rows, offset, offset + count)
+
+
+@register_mapper('columns')
+def columns_mapper(columns, rows, *names):
+    """ Keeps only the given columns in that order """
+    by_name = dict((c['name'].lower(), c) for c in columns)
+    try:
+        selected = [by_name[n.lower()] for n in names]
+    except KeyError as ex:
+        raise SourceError(u'Unknown column {0}'.format(ex.args[0]))
+    return selected, rows
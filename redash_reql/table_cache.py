@@ -0,0 +1,188 @@
+import atexit
+import io
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+
+from redash_reql.cache import LRUCache
+
+
+logger = logging.getLogger(__name__)
+
+# Name of the table holding the results in each materialized database
+TABLE_NAME = 'results'
+
+# Authorizer actions modifying the database they target (4th argument)
+_WRITE_ACTIONS = frozenset([
+    sqlite3.SQLITE_ALTER_TABLE, sqlite3.SQLITE_CREATE_INDEX,
+    sqlite3.SQLITE_CREATE_TABLE, sqlite3.SQLITE_CREATE_TRIGGER,
+    sqlite3.SQLITE_CREATE_VIEW, sqlite3.SQLITE_DELETE,
+    sqlite3.SQLITE_DROP_INDEX, sqlite3.SQLITE_DROP_TABLE,
+    sqlite3.SQLITE_DROP_TRIGGER, sqlite3.SQLITE_DROP_VIEW,
+    sqlite3.SQLITE_INSERT, sqlite3.SQLITE_UPDATE,
+])
+
+
+class TableCache(object):
+    """ Process wide cache of upstream results materialized as sqlite
+        database files, so later runs referencing the same result can
+        attach them instead of ingesting it again.
+
+        Entries are keyed by `(query_id, result_id, retrieved_at)` and the
+        cache is bounded to `size` bytes on disk, evicting the least
+        recently used files. Storing a new result for a query invalidates
+        the previous ones, although it can be derived from them with
+        `update`.
+    """
+
+    def __init__(self, size=0, path=None):
+        self.path = path
+        self._tmpdir = None
+        self._lock = threading.RLock()
+        self._files = LRUCache(size, on_evict=self._remove_file)
+
+    @property
+    def size(self):
+        return self._files.size
+
+    def resize(self, size):
+        self._files.resize(size)
+
+    def stats(self):
+        stats = self._files.stats()
+        stats['bytes'] = self._files.weight
+        return stats
+
+    def __contains__(self, key):
+        return key in self._files
+
+    def invalidate(self, query_id):
+        with self._lock:
+            for key in self._files.keys():
+                if key[0] == query_id:
+                    self._remove_file(key, self._files.pop(key))
+
+    def attach(self, conn, key, schema):
+        """ Attaches the database for the key under the given schema name,
+            returns False if it's not available.
+        """
+        with self._lock:
+            fname = self._files.get(key)
+            if fname is None:
+                return False
+
+            conn.execute('ATTACH DATABASE ? AS {0}'.format(schema), (fname,))
+            return True
+
+    def store(self, key, build):
+        """ Materializes a new entry by calling `build` with a connection
+            to a new database where it must create the TABLE_NAME table.
+        """
+        if self.size <= 0:
+            return False
+
+        fname = self._new_file()
+        self._materialize(fname, build)
+        return self._set(key, fname)
+
+    def update(self, key, build, update):
+        """ Materializes a new entry from a copy of the database of the
+            previous entry for the same query, calling `update` with a
+            connection to it. When there is no previous entry or `update`
+            returns None the entry is built from scratch as with `store`.
+
+            The copy keeps the previous database untouched while other runs
+            may still have it attached.
+        """
+        if self.size <= 0:
+            return False
+
+        with self._lock:
+            previous = [k for k in self._files.keys() if k[0] == key[0]]
+            try:
+                # Opened right away, it's removed if invalidated meanwhile
+                source = io.open(self._files.get(previous[-1]), 'rb') if previous else None
+            except (IOError, OSError):
+                source = None
+
+        if source is None:
+            return self.store(key, build)
+
+        fname = self._new_file()
+        try:
+            with source, io.open(fname, 'wb') as target:
+                shutil.copyfileobj(source, target)
+        except:
+            os.unlink(fname)
+            raise
+
+        if self._materialize(fname, update) is None:
+            logger.info('Unable to update the results of %s, materializing them again', key)
+            os.unlink(fname)
+            return self.store(key, build)
+        return self._set(key, fname)
+
+    def _new_file(self):
+        fd, fname = tempfile.mkstemp(suffix='.sqlite', dir=self._dir())
+        os.close(fd)
+        return fname
+
+    def _materialize(self, fname, func):
+        try:
+            conn = sqlite3.connect(fname, isolation_level=None)
+            try:
+                # The file is useless if we crash, so don't bother with safety
+                conn.execute('PRAGMA journal_mode = OFF')
+                conn.execute('PRAGMA synchronous = OFF')
+                return func(conn)
+            finally:
+                conn.close()
+        except:
+            os.unlink(fname)
+            raise
+
+    def _set(self, key, fname):
+        with self._lock:
+            self.invalidate(key[0])
+            self._files.set(key, fname, weight=os.path.getsize(fname))
+
+        logger.info('Materialized results %s in %s', key, fname)
+        return key in self._files
+
+    def clear(self):
+        with self._lock:
+            self._files.clear()
+
+    def _dir(self):
+        with self._lock:
+            if self.path:
+                return self.path
+
+            if self._tmpdir is None:
+                self._tmpdir = tempfile.mkdtemp(prefix='redash_reql-tables-')
+                atexit.register(shutil.rmtree, self._tmpdir, True)
+            return self._tmpdir
+
+    def _remove_file(self, key, fname):
+        # Databases still attached elsewhere keep working until detached
+        try:
+            os.unlink(fname)
+        except OSError:
+            pass
+
+
+def protect_attached(conn, schemas):
+    """ Prevents the statements on the connection from modifying the given
+        attached databases.
+    """
+    schemas = frozenset(schemas)
+
+    def authorizer(action, arg1, arg2, dbname, source):
+        if action in _WRITE_ACTIONS and dbname in schemas:
+            return sqlite3.SQLITE_DENY
+        return sqlite3.SQLITE_OK
+
+    conn.set_authorizer(authorizer)
@@ -0,0 +1,120 @@
+"""
+Per phase timings and counters of a query run, reported to the registered
+hooks once the run completes.
+"""
+import cProfile
+import io
+import logging
+import pstats
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+_hooks = []
+
+
+class Timings(object):
+    """ Accumulates the seconds spent on each phase of a run and counters
+        for the referenced queries, i.e. `query_1.rows`.
+
+        Phases might run on several threads at once (fetching the upstream
+        queries), in that case their time is the sum of all of them.
+    """
+
+    def __init__(self):
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def incr(self, name, count=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'phases': OrderedDict(self.phases),
+                'counters': OrderedDict(self.counters),
+            }
+
+    def __str__(self):
+        with self._lock:
+            return ', '.join(
+                ['{0}={1:.3f}s'.format(k, v) for k, v in self.phases.items()] +
+                ['{0}={1}'.format(k, v) for k, v in self.counters.items()])
+
+
+def register_hook(hook):
+    """ Registers a function called with the `Timings` of every run """
+    _hooks.append(hook)
+    return hook
+
+
+def unregister_hook(hook):
+    _hooks.remove(hook)
+
+
+def report(timings):
+    logger.info('Run timings: %s', timings)
+    for hook in _hooks:
+        try:
+            hook(timings)
+        except Exception:
+            logger.exception('Failed reporting timings to %r', hook)
+
+
+def statsd_hook(client, prefix='reql'):
+    """ Creates a hook sending the timings to a statsd client, phases as
+        `<prefix>.<phase>` timers in milliseconds and counters as they are.
+
+        Counters of the referenced queries are sent as `<prefix>.query.*`
+        so they aggregate for all of them.
+    """
+    def hook(timings):
+        data = timings.as_dict()
+        for name, seconds in data['phases'].items():
+            client.timing('{0}.{1}'.format(prefix, name), seconds * 1000)
+        for name, count in data['counters'].items():
+            table, _, counter = name.rpartition('.')
+            client.incr('{0}.{1}.{2}'.format(
+                prefix, 'result' if table == 'result' else 'query', counter), count)
+    return hook
+
+
+@contextmanager
+def profiled(enabled=True, limit=30):
+    """ Profiles the block with cProfile, logging the top functions by
+        cumulative time.
+    """
+    if not enabled:
+        yield
+        return
+
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+
+        out = io.BytesIO() if str is bytes else io.StringIO()
+        stats = pstats.Stats(profile, stream=out)
+        stats.sort_stats('cumulative').print_stats(limit)
+        logger.info('Run profile:\n%s', out.getvalue())
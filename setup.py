@@ -49,6 +49,9 @@ setup(
         "lark-parser==0.6.4",
     ],
     extras_require={
+        "columnar": [
+            "numpy",
+        ],
         "dev": [
             "pytest",
             "pytest-runner",
@@ -0,0 +1,45 @@
+import pytest
+
+from parser import ReqlParser
+from redash_reql.analysis import find_index_columns, find_used_columns
+
+
+@pytest.fixture(scope='module')
+def parser():
+    return ReqlParser(cache_dir=False)
+
+
+@pytest.mark.parametrize('sql, expected', [
+    ('SELECT * FROM query_1 WHERE a > 1', {}),
+    ('SELECT * FROM query_1 WHERE a = 1', {'query_1': {'a'}}),
+    ('SELECT * FROM query_1 q JOIN query_2 USING (id)', {'query_1': {'id'}, 'query_2': {'id'}}),
+    ('SELECT * FROM query_1 a JOIN "query_2" b ON a.x = b.y', {'query_1': {'x'}, 'query_2': {'y'}}),
+    ('SELECT a.x = 1 FROM query_1 a GROUP BY a.y', {}),
+    ('SELECT * FROM query_1 a, foo WHERE a.x == foo.y', {'query_1': {'x'}}),
+    ('SELECT * FROM query_1 a WHERE EXISTS (SELECT 1 FROM query_2 b WHERE b.k = a.k)',
+     {'query_1': {'k'}, 'query_2': {'k'}}),
+    ('WITH x AS (SELECT * FROM query_1 WHERE id = 1) SELECT * FROM x WHERE x.id = 2',
+     {'query_1': {'id'}}),
+])
+def test_find_index_columns(parser, sql, expected):
+    assert find_index_columns(parser.parse(sql), ['query_1', 'query_2']) == expected
+
+
+@pytest.mark.parametrize('sql, expected', [
+    ('SELECT a, B FROM query_1 WHERE c > 1', {'query_1': {'a', 'b', 'c'}, 'query_2': None}),
+    ('SELECT count(*) FROM query_1', {'query_1': set(), 'query_2': None}),
+    ('SELECT upper(a) AS x FROM query_1 ORDER BY x', {'query_1': {'a', 'x'}, 'query_2': None}),
+    ('SELECT * FROM query_1 JOIN query_2 USING (id)', {'query_1': None, 'query_2': None}),
+    ('SELECT b.*, a.x FROM query_1 a JOIN query_2 b ON a.id = b.id',
+     {'query_1': {'id', 'x'}, 'query_2': None}),
+    ('SELECT x FROM query_1 NATURAL JOIN query_2', {'query_1': None, 'query_2': None}),
+    ('SELECT x FROM (SELECT * FROM query_1) JOIN query_2 q ON q.y = x',
+     {'query_1': None, 'query_2': {'x', 'y'}}),
+    ('SELECT a FROM query_1 WHERE EXISTS (SELECT 1 FROM query_2 q WHERE q.k = query_1.k)',
+     {'query_1': {'a', 'k'}, 'query_2': {'k'}}),
+    ('SELECT v FROM query_1, json_each(query_1.w)', {'query_1': {'v', 'w'}, 'query_2': None}),
+    ("SELECT j.value FROM query_1 q JOIN json_each(q.w, '$.a') AS j",
+     {'query_1': {'w'}, 'query_2': None}),
+])
+def test_find_used_columns(parser, sql, expected):
+    assert find_used_columns(parser.parse(sql), ['query_1', 'query_2']) == expected
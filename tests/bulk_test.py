@@ -0,0 +1,71 @@
+import sqlite3
+
+import pytest
+
+from redash_reql.bulk import bulk_insert, load_pragmas, row_getter
+from redash_reql.query_runner import create_table
+
+
+@pytest.fixture
+def conn():
+    return sqlite3.connect(':memory:', isolation_level=None)
+
+
+def pragmas(conn):
+    return [conn.execute('PRAGMA {0}'.format(p)).fetchone()[0] for p in ('synchronous', 'cache_size')]
+
+
+def test_load_pragmas_restored(conn):
+    conn.execute('PRAGMA cache_size = 100')
+    before = pragmas(conn)
+    with load_pragmas(conn):
+        assert pragmas(conn) != before
+    assert pragmas(conn) == before
+
+
+def test_load_pragmas_keep_bigger_cache(conn):
+    conn.execute('PRAGMA cache_size = -1000000')
+    with load_pragmas(conn):
+        assert pragmas(conn)[1] == -1000000
+
+
+@pytest.mark.parametrize('names, row, expected', [
+    (['a'], {'a': 1}, (1,)),
+    (['a'], {}, (None,)),
+    (['a', 'b'], {'b': 2, 'a': 1, 'c': 3}, (1, 2)),
+    (['a', 'b'], {'b': 2}, (None, 2)),
+])
+def test_row_getter(names, row, expected):
+    assert row_getter(names)(row) == expected
+
+
+def test_failed_load_rolls_back(conn):
+    conn.execute('CREATE TABLE t (a INTEGER PRIMARY KEY)')
+    with pytest.raises(sqlite3.IntegrityError):
+        bulk_insert(conn, 't', ['a'], iter([(1,), (2,), (1,)]))
+    assert conn.execute('SELECT COUNT(*) FROM t').fetchone() == (0,)
+    # Fails if the transaction is still open
+    conn.execute('BEGIN')
+    conn.execute('ROLLBACK')
+
+
+def test_full_database(conn):
+    conn.execute('PRAGMA max_page_count = 20')
+    conn.execute('CREATE TABLE t (a)')
+    # sqlite rolls the transaction back itself, its error must remain
+    with pytest.raises(sqlite3.OperationalError) as exc:
+        bulk_insert(conn, 't', ['a'], ((u'x' * 100,) for _ in range(10000)))
+    assert 'full' in str(exc.value)
+    assert conn.execute('SELECT COUNT(*) FROM t').fetchone() == (0,)
+
+
+def test_create_table_without_rowid(conn):
+    results = {
+        'columns': [{'name': 'id', 'type': 'integer'}, {'name': 'v'}],
+        'rows': [{'id': i, 'v': i * 2} for i in range(10)],
+    }
+    assert create_table(conn, 'query_1', results, key='id') == 10
+
+    ddl, = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'query_1'").fetchone()
+    assert ddl.endswith('WITHOUT ROWID')
+    assert conn.execute('SELECT v FROM query_1 WHERE id = 3').fetchone() == (6,)
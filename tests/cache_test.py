@@ -0,0 +1,39 @@
+from redash_reql.cache import LRUCache, size_from_env
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+
+    assert 'b' not in cache
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_lru_counters():
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.get('a')
+    cache.get('b')
+
+    assert cache.stats() == {'size': 2, 'entries': 1, 'hits': 1, 'misses': 1}
+
+
+def test_lru_resize():
+    cache = LRUCache(3)
+    for key in 'abc':
+        cache.set(key, key)
+
+    cache.resize(1)
+    assert len(cache) == 1
+    assert 'c' in cache
+
+
+def test_size_from_env(monkeypatch):
+    monkeypatch.delenv('REDASH_REQL_TEST_SIZE', raising=False)
+    assert size_from_env('REDASH_REQL_TEST_SIZE', 256) == 256
+    monkeypatch.setenv('REDASH_REQL_TEST_SIZE', '1.5')
+    assert size_from_env('REDASH_REQL_TEST_SIZE', 256, 1024) == 1536
@@ -0,0 +1,138 @@
+import random
+import sqlite3
+
+import pytest
+
+from redash_reql import columnar
+from redash_reql.parser import ReqlParser
+
+pytest.importorskip('numpy')
+
+
+@pytest.fixture(scope='module')
+def conn():
+    rnd = random.Random(7)
+
+    def maybe(value):
+        return None if rnd.random() < 0.1 else value
+
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE t (id INTEGER, g TEXT, v REAL, n INTEGER, e TEXT)')
+    conn.executemany('INSERT INTO t VALUES (?, ?, ?, ?, ?)', [
+        # Multiples of 1/4 so sums are exact regardless of their order
+        (i, maybe(rnd.choice(['a', 'b', 'c', u'\xe9'])), maybe(rnd.randint(-40, 40) / 4.0),
+         maybe(rnd.randint(-3, 3)), None)
+        for i in range(500)])
+    conn.execute('CREATE TABLE u (id INTEGER, w TEXT)')
+    conn.executemany('INSERT INTO u VALUES (?, ?)', [
+        (maybe(rnd.randint(0, 600)), rnd.choice(['x', 'y'])) for _ in range(400)])
+    conn.execute('CREATE TABLE mixed (a)')
+    conn.executemany('INSERT INTO mixed VALUES (?)', [(1,), ('1',), (1.5,)])
+    conn.execute('CREATE TABLE other (a)')
+    conn.execute('CREATE TABLE big (id INTEGER)')
+    conn.executemany('INSERT INTO big VALUES (?)', [(1,), (2 ** 53 + 1,)])
+    conn.execute('CREATE TABLE reals (g TEXT, x REAL)')
+    conn.executemany('INSERT INTO reals VALUES (?, ?)', [
+        ('a', 0.1), ('a', 1.1), ('a', 0.2), ('b', 0.5), ('b', 2.25), ('b', None)])
+    return conn
+
+
+# Tables whose contents don't change, the columns are cached
+KEYS = {'t': (1, 1, 't'), 'u': (2, 1, 'u'), 'mixed': (3, 1, 'm'), 'reals': (4, 1, 'r'),
+        'big': (5, 1, 'b')}
+
+
+QUERIES = [
+    'SELECT * FROM t',
+    'SELECT id, g AS label, 1, NULL FROM t WHERE v > 2.5',
+    "SELECT id FROM t WHERE v > 3 AND NOT g = 'a' OR n IS NULL",
+    "SELECT id FROM t WHERE NOT (n >= 0 OR g <> 'b')",
+    'SELECT id FROM t WHERE n != -1 AND v <= - 2',
+    'SELECT id FROM t WHERE n IS NOT 1 AND e IS NULL',
+    'SELECT id FROM t WHERE g IS NULL OR n NOTNULL AND v NOT NULL',
+    'SELECT id FROM t WHERE v BETWEEN -2 AND 2.5 AND id NOT BETWEEN 10 AND 20',
+    "SELECT id FROM t WHERE g IN ('a', 'c') AND n NOT IN (1, 2)",
+    'SELECT id FROM t WHERE e = 1 OR e > n',
+    'SELECT g, COUNT(*), COUNT(v), SUM(v), AVG(v), MIN(v), MAX(v) FROM t GROUP BY g',
+    'SELECT g, n, SUM(n), AVG(n), MIN(g), MAX(g), COUNT(e) FROM t GROUP BY g, n',
+    'SELECT COUNT(*), SUM(n), AVG(v), MIN(e), SUM(e) FROM t',
+    'SELECT COUNT(*), SUM(n), MAX(g) FROM t WHERE id < 0',
+    'SELECT g, COUNT(*) FROM t WHERE id < 0 GROUP BY g',
+    'SELECT id FROM t ORDER BY v DESC, id LIMIT 10',
+    'SELECT id, v FROM t ORDER BY v, 1 DESC LIMIT 7 OFFSET 3',
+    'SELECT id FROM t ORDER BY g, n DESC, id LIMIT 5, 20',
+    'SELECT g AS n, id FROM t ORDER BY n DESC, id',
+    "SELECT g AS 'x' FROM t ORDER BY x, id",
+    'SELECT g, COUNT(*) AS c FROM t GROUP BY g ORDER BY c DESC, g',
+    'SELECT g FROM t GROUP BY g, n ORDER BY n DESC, g LIMIT 3',
+    'SELECT g, SUM(n) FROM t GROUP BY g ORDER BY COUNT(*), AVG(v) DESC',
+    'SELECT t.g, u.w, COUNT(*) AS c FROM t JOIN u ON t.id = u.id GROUP BY t.g, u.w',
+    'SELECT t.id, w, v FROM t AS t INNER JOIN u x ON x.id = t.id WHERE v > 0',
+    'SELECT x.w, SUM(t.v) FROM u x JOIN t ON t.id = x.id GROUP BY x.w ORDER BY 2',
+    'SELECT COUNT(*) FROM t JOIN u ON t.n = u.id',
+    'SELECT id FROM t WHERE id = 3.0 OR v > id',
+    'SELECT id FROM big WHERE id = 9007199254740993',
+    # Exact sums of REAL values
+    "SELECT g, SUM(x), AVG(x) FROM reals WHERE g = 'b' GROUP BY g",
+]
+
+UNSUPPORTED = [
+    "SELECT g || 'x' FROM t",
+    'SELECT * FROM t, u',
+    'SELECT * FROM t LEFT JOIN u ON t.id = u.id',
+    "SELECT id FROM t WHERE g = 1",
+    "SELECT id FROM t WHERE n = '1'",
+    'SELECT DISTINCT g FROM t',
+    'SELECT id, COUNT(*) FROM t',
+    'SELECT g, COUNT(*) FROM t GROUP BY g HAVING COUNT(*) > 1',
+    'SELECT COUNT(DISTINCT g) FROM t',
+    'SELECT SUM(g) FROM t',
+    'SELECT id FROM t WHERE n IN (SELECT id FROM u)',
+    'SELECT id FROM t WHERE n',
+    'SELECT a FROM mixed',
+    'SELECT abs(v) FROM t',
+    'SELECT * FROM (SELECT id FROM t)',
+    'WITH x AS (SELECT 1) SELECT * FROM x',
+    'SELECT 1 UNION SELECT 2',
+    # Both tables have an id column so sqlite names them apart
+    'SELECT * FROM t JOIN u ON t.id = u.id',
+    'SELECT * FROM missing',
+    'SELECT * FROM other',
+    # 2 ** 53 + 1 is 2 ** 53 as a float
+    'SELECT id FROM big WHERE id = 9007199254740992.0',
+    'SELECT id FROM big WHERE id > 1.5',
+    # Sums of 0.1 and 1.1 depend on the order of the additions
+    'SELECT SUM(x) FROM reals',
+    'SELECT g, AVG(x) FROM reals GROUP BY g',
+]
+
+
+@pytest.mark.parametrize('cached', [False, True])
+@pytest.mark.parametrize('query', QUERIES)
+def test_same_as_sqlite(conn, query, cached):
+    if not cached:
+        columnar.column_cache.clear()
+    cursor = columnar.execute(conn, query, ReqlParser().parse, KEYS)
+    assert cursor is not None
+
+    expected = conn.execute(query)
+    assert cursor.description == expected.description
+
+    rows, expected = cursor.fetchmany(10000), expected.fetchall()
+    if 'ORDER BY' not in query:
+        # Without an order it's up to the query plan
+        rows, expected = sorted(rows, key=repr), sorted(expected, key=repr)
+    assert rows == expected
+    assert [[type(v) for v in r] for r in rows] == [[type(v) for v in r] for r in expected]
+
+
+@pytest.mark.parametrize('query', UNSUPPORTED)
+def test_unsupported(conn, query):
+    assert columnar.execute(conn, query, ReqlParser().parse, KEYS) is None
+
+
+def test_fetchmany():
+    cursor = columnar.ResultCursor([('a',)], [(1,), (2,), (3,)])
+    assert cursor.fetchmany(2) == [(1,), (2,)]
+    assert cursor.fetchmany(2) == [(3,)]
+    assert cursor.fetchmany(2) == []
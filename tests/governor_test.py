@@ -0,0 +1,44 @@
+import sqlite3
+import time
+
+import pytest
+
+from redash_reql.governor import Governor, QueryInterrupted
+
+
+RUNAWAY = '''
+    WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n)
+    SELECT COUNT(*) FROM n
+'''
+
+
+def test_no_limits():
+    governor = Governor()
+    assert governor.interrupted() is None
+    governor.check()
+
+
+def test_timeout():
+    conn = sqlite3.connect(':memory:')
+    governor = Governor(0.1)
+    governor.watch(conn)
+
+    start = time.time()
+    with pytest.raises(sqlite3.OperationalError):
+        conn.execute(RUNAWAY).fetchall()
+    assert time.time() - start < 5
+    assert 'maximum execution time of 0.1 seconds' in governor.interrupted()
+    with pytest.raises(QueryInterrupted):
+        governor.check()
+
+
+def test_cancel():
+    conn = sqlite3.connect(':memory:')
+    governor = Governor()
+    governor.watch(conn)
+    assert conn.execute('SELECT 1').fetchall() == [(1,)]
+
+    governor.cancel()
+    with pytest.raises(sqlite3.OperationalError):
+        conn.execute(RUNAWAY).fetchall()
+    assert governor.interrupted() == 'Query cancelled by user.'
@@ -0,0 +1,145 @@
+import json
+import os
+
+import pytest
+
+from redash_reql.interchange import EncodedResults, ResultStore, ResultsEncoder, encode
+
+
+COLUMNS = [
+    {'name': 'i', 'type': 'integer'},
+    {'name': 'f', 'type': 'float'},
+    {'name': 's', 'type': 'string'},
+    {'name': 'b', 'type': 'boolean'},
+    {'name': 'm', 'type': None},
+]
+
+ROWS = [
+    (1, 0.5, u'a', True, 1),
+    (None, None, None, None, u'x'),
+    (-2 ** 63, 1e300, u'\xf1and\xfa', False, 1.5),
+    (3, float('-inf'), u'a', None, None),
+]
+
+
+def test_round_trip():
+    encoded = EncodedResults(encode(COLUMNS, ROWS))
+    assert encoded.columns == COLUMNS
+    assert encoded.count == len(ROWS)
+    assert list(encoded.rows()) == ROWS
+
+
+@pytest.mark.parametrize('indexes', [[0], [2, 0], [4, 3, 1]])
+def test_selected_columns(indexes):
+    encoded = EncodedResults(encode(COLUMNS, ROWS))
+    assert list(encoded.rows(indexes)) == [tuple(row[i] for i in indexes) for row in ROWS]
+
+
+@pytest.mark.parametrize('values', [
+    [2 ** 64, 1],
+    [1, 2.5],
+    [u'a', 1],
+    [None, None],
+    [],
+])
+def test_column_kinds(values):
+    encoded = EncodedResults(encode([{'name': 'a'}], [(v,) for v in values]))
+    assert list(encoded.values(0)) == values
+
+
+@pytest.mark.parametrize('batches', [
+    [[1, None], [2]],
+    [[None], [None, 1.5]],
+    [[None, None], []],
+    [[u'a', None], [u'b', u'a']],
+    [[1, 2], [2.5]],
+    [[None, 1], [2 ** 64]],
+    [[2 ** 64], [None, 1]],
+    [[1.5], [u'a', None], [3]],
+    [[u'a'], [None], [True]],
+])
+def test_batches(batches):
+    results = ResultsEncoder(1)
+    for values in batches:
+        results.add([(v,) for v in values])
+    encoded = EncodedResults(results.finish([{'name': 'a'}]))
+    assert list(encoded.values(0)) == [v for values in batches for v in values]
+
+
+def test_no_columns():
+    encoded = EncodedResults(encode([], [(), ()]))
+    assert list(encoded.rows()) == [(), ()]
+
+
+def test_smaller_than_json():
+    rows = [(i, i * 0.25, u'value {0}'.format(i % 10)) for i in range(1000)]
+    text = json.dumps({'columns': COLUMNS[:3], 'rows': [
+        dict(zip(['i', 'f', 's'], row)) for row in rows]})
+    assert len(encode(COLUMNS[:3], rows)) < len(text) / 1.5
+
+
+@pytest.mark.parametrize('data', [b'', b'{"rows": []}', b'RQLB\x01\x02\x00\x00\x00{}'])
+def test_invalid(data):
+    with pytest.raises((ValueError, KeyError)):
+        EncodedResults(data)
+
+
+@pytest.fixture
+def store(tmpdir):
+    return ResultStore(1024 * 1024, path=str(tmpdir))
+
+
+def test_store(store):
+    data = encode(COLUMNS, ROWS)
+    assert store.get(u'{"rows": []}') is None
+    assert store.put(u'{"rows": []}', data)
+    assert list(store.get(u'{"rows": []}').rows()) == ROWS
+    assert store.get(u'{"rows": [] }') is None
+
+
+def test_store_versions(store, monkeypatch):
+    store.put(u'text', encode(COLUMNS, ROWS))
+    assert list(store.get(u'text', (1, 2, 'at')).rows()) == ROWS
+
+    # The version is enough to find it again without hashing the text
+    hashed = []
+    monkeypatch.setattr('hashlib.sha1', lambda text: hashed.append(text))
+    assert list(store.get(u'text', (1, 2, 'at')).rows()) == ROWS
+    assert hashed == []
+
+
+def test_store_disabled(tmpdir):
+    store = ResultStore(0, path=str(tmpdir))
+    assert not store.put(u'text', encode(COLUMNS, ROWS))
+    assert store.get(u'text') is None
+    assert tmpdir.listdir() == []
+
+
+def test_store_evicts_least_recently_used(store, tmpdir):
+    data = encode(COLUMNS, ROWS)
+    store.resize(len(data) * 2)
+    store.put(u'1', data)
+    store.put(u'2', data)
+    # Reading marks it as recently used
+    past = os.path.getmtime(store._fname(u'1')) - 10
+    os.utime(store._fname(u'2'), (past, past))
+    store.put(u'3', data)
+
+    assert store.get(u'1') is not None
+    assert store.get(u'2') is None
+    assert store.get(u'3') is not None
+    assert len(tmpdir.listdir()) == 2
+
+    assert not store.put(u'4', data * 3)
+
+
+def test_store_ignores_invalid_files(store, tmpdir):
+    with open(store._fname(u'text'), 'wb') as fd:
+        fd.write(b'garbage')
+    assert store.get(u'text') is None
+
+
+def test_store_needs_private_dir(tmpdir):
+    tmpdir.chmod(0o777)
+    store = ResultStore(1024 * 1024, path=str(tmpdir))
+    assert not store.put(u'text', encode(COLUMNS, ROWS))
@@ -0,0 +1,249 @@
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import pytest
+
+import stub_models
+from redash_reql import query_runner
+from redash_reql import single_flight
+from redash_reql.query_runner import (
+    PermissionError, ReqlVisitor, create_tables_from_queries, estimate_size, load_queries)
+
+
+class User(object):
+    org_id = 1
+    group_ids = [1]
+    permissions = []
+
+
+class Runner(object):
+
+    def __init__(self):
+        self.runs = []
+
+    def run_query(self, text, user):
+        self.runs.append(text)
+        return json.dumps({'columns': [{'name': 'v'}], 'rows': [{'v': text}]}), None
+
+
+@pytest.fixture
+def models(monkeypatch):
+    stub_models.reset()
+    monkeypatch.setattr(query_runner, 'models', stub_models)
+    return stub_models
+
+
+def ref(id, refresh=False, line=1, column=1):
+    return ReqlVisitor.QueryRef(
+        'query_{0}{1}'.format(id, '_refresh' if refresh else ''), id, refresh, line, column)
+
+
+def test_bulk_loading(models):
+    new = json.dumps({'columns': [{'name': 'v'}], 'rows': [{'v': 'new'}]})
+    for ds in (1, 2):
+        models.add_data_source(ds, Runner(), groups={1: False, 2: True})
+    for id in range(1, 21):
+        models.add_query(id, id % 2 + 1, 'SELECT {0}'.format(id))
+        models.add_result(id * 10, id % 2 + 1, 'SELECT {0}'.format(id), 'old',
+                          retrieved_at=datetime(2018, 1, 1))
+        models.add_result(id * 10 + 1, id % 2 + 1, 'SELECT {0}'.format(id), new,
+                          retrieved_at=datetime(2018, 1, 2))
+    models.db.session.expunge_all()
+    del models.statements[:]
+
+    refs = [ref(i) for i in range(1, 21)] + [ref(3, refresh=True)]
+    loaded = load_queries(User(), refs)
+
+    # queries + groups + latest results, regardless of the references
+    assert len(models.statements) == 3
+    assert sorted(loaded) == list(range(1, 21))
+    assert loaded[4][1].id == 41
+
+    # The data of every result needed at once
+    del models.statements[:]
+    conn = sqlite3.connect(':memory:', isolation_level=None)
+    create_tables_from_queries(User(), conn, refs, loaded=loaded)
+    assert len(models.statements) == 1
+    assert conn.execute('SELECT * FROM query_7').fetchall() == [('new',)]
+    assert all(latest.data == new for _, latest in loaded.values())
+
+
+def test_estimate_size_without_data(models):
+    models.add_data_source(1, Runner())
+    for id in (1, 2, 3):
+        models.add_query(id, 1, 'SELECT {0}'.format(id))
+    models.add_query(4, 1, 'SELECT 1')
+    models.add_result(1, 1, 'SELECT 1', 'x' * 100)
+    models.add_result(2, 1, 'SELECT 2', 'x' * 20)
+    models.db.session.expunge_all()
+
+    loaded = load_queries(User(), [ref(i) for i in range(1, 5)])
+    # The results are only measured, shared ones once
+    assert estimate_size(loaded) == 120
+    assert not any('data' in vars(latest) for _, latest in loaded.values() if latest)
+    assert loaded[1][1].data == 'x' * 100
+
+    assert estimate_size({}) == 0
+
+
+def test_latest_matches_get_latest(models):
+    models.add_data_source(1, Runner())
+    models.add_data_source(2, Runner())
+    models.add_query(1, 1, 'SELECT  1')
+    models.add_query(2, 2, 'SELECT 1')
+    models.add_query(3, 1, 'SELECT 3')
+    models.add_result(1, 1, 'select 1', 'a', retrieved_at=datetime(2018, 1, 3))
+    models.add_result(2, 2, 'SELECT 1', 'b', retrieved_at=datetime(2018, 1, 1))
+
+    loaded = load_queries(User(), [ref(1), ref(2), ref(3)])
+    for id in (1, 2, 3):
+        query, latest = loaded[id]
+        assert latest is models.QueryResult.get_latest(query.data_source, query.query_text)
+
+
+@pytest.mark.parametrize('setup, message', [
+    (lambda m: None, 'Query id 1 not found. (at line 2 column 3)'),
+    (lambda m: m.add_query(1, 1, 'SELECT 1', org_id=2), 'Query id 1 not found. (at line 2 column 3)'),
+    (lambda m: m.add_query(1, 2, 'SELECT 1'),
+     'You are not allowed to execute queries on ds2 data source (used for query id 1). '
+     '(at line 2 column 3)'),
+    (lambda m: m.add_query(1, 3, 'SELECT 1'),
+     'You are not allowed to execute queries on ds3 data source (used for query id 1). '
+     '(at line 2 column 3)'),
+])
+def test_permission_errors(models, setup, message):
+    models.add_data_source(1, Runner())
+    models.add_data_source(2, Runner(), groups={1: True})
+    models.add_data_source(3, Runner(), groups={5: False})
+    setup(models)
+
+    with pytest.raises(PermissionError) as ex:
+        load_queries(User(), [ref(1, line=2, column=3)])
+    assert str(ex.value) == message
+
+
+def test_create_tables(models):
+    runner = Runner()
+    models.add_data_source(1, runner)
+    models.add_query(1, 1, 'SELECT 1')
+    models.add_query(2, 1, 'SELECT 2')
+    models.add_result(1, 1, 'SELECT 1', json.dumps({'columns': [{'name': 'v'}], 'rows': [{'v': 'cached'}]}))
+
+    conn = sqlite3.connect(':memory:', isolation_level=None)
+    create_tables_from_queries(User(), conn, [ref(1), ref(2), ref(1, refresh=True)])
+
+    assert conn.execute('SELECT v FROM query_1').fetchall() == [('cached',)]
+    assert conn.execute('SELECT v FROM query_2').fetchall() == [('SELECT 2',)]
+    assert conn.execute('SELECT v FROM query_1_refresh').fetchall() == [('SELECT 1',)]
+    assert sorted(runner.runs) == ['SELECT 1', 'SELECT 2']
+
+
+class SlowRunner(object):
+    """ Takes longer for the first queries, so they finish in reverse order,
+        and fails for the texts in `failing`.
+    """
+
+    def __init__(self, failing=()):
+        self.failing = failing
+        self.runs = []
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def run_query(self, text, user):
+        with self.lock:
+            self.runs.append(text)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            if text in self.failing:
+                return None, 'Failed'
+            time.sleep(0.05 * (5 - int(text.split()[1])))
+            return json.dumps({'columns': [{'name': 'v'}], 'rows': [{'v': text}]}), None
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+@pytest.fixture
+def slow_models(models, monkeypatch):
+    monkeypatch.setattr(query_runner, 'single_flight', single_flight.NoSingleFlight())
+    for id in range(1, 5):
+        models.add_query(id, 1, 'SELECT {0}'.format(id))
+    return models
+
+
+def join_fetch_threads():
+    for thread in threading.enumerate():
+        if thread.name == query_runner.FETCH_THREAD_NAME:
+            thread.join()
+
+
+@pytest.mark.parametrize('concurrency', [1, 2, 4])
+def test_concurrent_fetch(slow_models, concurrency):
+    runner = SlowRunner()
+    slow_models.add_data_source(1, runner)
+
+    conn = sqlite3.connect(':memory:', isolation_level=None)
+    create_tables_from_queries(
+        User(), conn, [ref(i) for i in range(1, 5)], concurrency=concurrency)
+
+    # Each table gets the results of its query whatever the completion order
+    for id in range(1, 5):
+        assert conn.execute('SELECT v FROM query_{0}'.format(id)).fetchall() == [
+            ('SELECT {0}'.format(id),)]
+    assert sorted(runner.runs) == ['SELECT {0}'.format(i) for i in range(1, 5)]
+    assert runner.max_running == concurrency
+
+
+class FakeFlask(object):
+    """ Records the threads where the app context is pushed """
+
+    def __init__(self):
+        self.current_app = self
+        self.threads = []
+
+    def has_app_context(self):
+        return True
+
+    def _get_current_object(self):
+        return self
+
+    @contextmanager
+    def app_context(self):
+        self.threads.append(threading.current_thread().name)
+        yield
+
+
+def test_concurrent_fetch_app_context(slow_models, monkeypatch):
+    flask = FakeFlask()
+    monkeypatch.setattr(query_runner, 'flask', flask)
+    slow_models.add_data_source(1, SlowRunner())
+
+    conn = sqlite3.connect(':memory:', isolation_level=None)
+    create_tables_from_queries(User(), conn, [ref(i) for i in range(1, 5)], concurrency=2)
+    join_fetch_threads()
+    assert flask.threads == [query_runner.FETCH_THREAD_NAME] * 2
+
+
+@pytest.mark.parametrize('concurrency', [1, 2])
+def test_concurrent_fetch_failure(slow_models, concurrency):
+    runner = SlowRunner(failing=['SELECT 1'])
+    slow_models.add_data_source(1, runner)
+
+    conn = sqlite3.connect(':memory:', isolation_level=None)
+    with pytest.raises(Exception) as ex:
+        create_tables_from_queries(
+            User(), conn, [ref(i, line=i) for i in range(1, 5)], concurrency=concurrency)
+    assert str(ex.value) == 'Failed loading results for query id 1 (at line 1 column 1).'
+
+    # The fetches queued after the failure are skipped
+    join_fetch_threads()
+    assert runner.runs[0] == 'SELECT 1'
+    assert 'SELECT 3' not in runner.runs
+    assert 'SELECT 4' not in runner.runs
+    assert conn.execute("SELECT name FROM sqlite_master WHERE name LIKE 'query_%'").fetchall() == []
@@ -0,0 +1,291 @@
+import json
+import random
+import sqlite3
+
+import pytest
+
+from lark.exceptions import LarkError
+
+from conftest import load_fixtures
+from redash_reql.query_runner import (
+    TYPE_INTEGER, TYPE_STRING, ColumnTypeGuesser, _guess_type,
+    analyze_query, create_indexes, create_table, declared_types,
+    explain_query_plan, extract_queries, read_results, scan_queries,
+    serialize_results, split_statements, update_table)
+
+
+QUERIES = [
+    'SELECT 1',
+    'SELECT * FROM query_1',
+    'SELECT * FROM QUERY_12_REFRESH AS q',
+    'SELECT * FROM "query_3" JOIN "query_4_refresh" USING (id)',
+    'SELECT * FROM "query""5"',
+    'SELECT query_1.a FROM query_1',
+    'SELECT query_6 FROM foo',
+    'SELECT * FROM foo -- FROM query_7\n',
+    'SELECT * FROM foo /* FROM query_8 */',
+    "SELECT * FROM foo WHERE a = 'query_9'",
+    "SELECT * FROM foo WHERE a = 'it''s query_10'",
+    'SELECT * FROM [query_11]',
+    'SELECT * FROM main.query_12',
+    'SELECT * FROM query_13x',
+    'SELECT * FROM xquery_14',
+    'WITH q AS (SELECT * FROM query_15) SELECT * FROM q, query_16',
+    'SELECT * FROM (SELECT * FROM query_17 WHERE x IN (SELECT y FROM query_18))',
+]
+
+
+def full_refs(sql):
+    try:
+        return set(q.name for q in extract_queries(sql, validate=True))
+    except LarkError:
+        pytest.skip('Not supported by the grammar')
+
+
+def check_scan(sql):
+    refs = full_refs(sql)
+    candidates = scan_queries(sql)
+
+    assert refs <= candidates
+    if not candidates:
+        assert extract_queries(sql) == []
+
+
+@pytest.mark.parametrize('sql', QUERIES)
+def test_scan_queries(sql):
+    check_scan(sql)
+
+
+@pytest.mark.parametrize('location, sql', load_fixtures('fixtures.reql'))
+def test_scan_queries_reql(location, sql):
+    check_scan(sql)
+
+
+@pytest.mark.parametrize('location, sql', load_fixtures('fixtures.sqlite'))
+def test_scan_queries_sqlite(location, sql):
+    check_scan(sql)
+
+
+def test_extract_queries_skips_parsing():
+    assert extract_queries('SELECT * FROM ((') == []
+
+    with pytest.raises(LarkError):
+        extract_queries('SELECT * FROM ((', validate=True)
+
+
+VALUES = [
+    None, '', 0, 1, -5, 1.5, True, u'1', u'12', u'true', u'FALSE', u'foo',
+    u'March', u'2018-01-01', u'2018-02-30', u'2018-01-01T10:20:30Z',
+    u'2018-01-01 10:20:30.123+05:30', u'2018-01-01T25:00', u'2018-1-1',
+    u'01/02/2018', u'10:20', u'0000-01-01', u'2018-01-01T10:20+99:00',
+]
+
+
+def guess_per_cell(values):
+    guessed = None
+    for value in values:
+        guess = _guess_type(value)
+        if guessed is None:
+            guessed = guess
+        elif guessed != guess:
+            guessed = TYPE_STRING
+    return guessed
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_column_type_guesser(seed):
+    rnd = random.Random(seed)
+    columns = [
+        [rnd.choice(VALUES[:i + 1]) for _ in range(rnd.randint(0, 6))]
+        for i in range(len(VALUES))
+    ] + [[value] * 3 for value in VALUES]
+
+    rows_count = max(len(c) for c in columns)
+    rows = [
+        tuple(c[i % len(c)] if c else None for c in columns)
+        for i in range(rows_count)
+    ]
+
+    guesser = ColumnTypeGuesser(len(columns))
+    guesser.update(rows[:2])
+    guesser.update(rows[2:])
+
+    assert guesser.types == [
+        guess_per_cell([row[j] for row in rows]) for j in range(len(columns))]
+
+
+def test_declared_types():
+    conn = sqlite3.connect(':memory:', isolation_level=None)
+    create_table(conn, 'query_1', json.dumps({
+        'columns': [
+            {'name': 'a', 'type': 'integer'},
+            {'name': 'd', 'type': 'datetime'},
+            {'name': 's', 'type': None},
+        ],
+        'rows': [{'a': '1', 'd': '2018-01-01', 's': 'x'}],
+    }))
+
+    assert conn.execute('SELECT typeof(a) FROM query_1').fetchall() == [('integer',)]
+    assert declared_types(conn, 'SELECT a, d AS x, s, a + 1 FROM query_1') == [
+        TYPE_INTEGER, None, None, None]
+    assert declared_types(conn, 'SELECT 1; SELECT 2') is None
+
+
+def test_create_table_string_affinity():
+    # Redash types as string any column with nulls, numbers must stay so
+    conn = sqlite3.connect(':memory:', isolation_level=None)
+    create_table(conn, 'query_1', json.dumps({
+        'columns': [{'name': 'x', 'type': 'string'}, {'name': 'd', 'type': 'date'}],
+        'rows': [{'x': 10, 'd': '2018'}, {'x': 5, 'd': '2018-01-01'}, {'x': None, 'd': None}],
+    }))
+
+    assert conn.execute('SELECT x FROM query_1 WHERE x > 7').fetchall() == [(10,)]
+    assert conn.execute('SELECT x FROM query_1 ORDER BY x').fetchall() == [(None,), (5,), (10,)]
+    assert conn.execute('SELECT typeof(d) FROM query_1').fetchall() == [
+        ('text',), ('text',), ('null',)]
+
+
+def test_create_indexes():
+    conn = sqlite3.connect(':memory:', isolation_level=None)
+    for table in ('query_1', 'query_2'):
+        create_table(conn, table, {
+            'columns': [{'name': 'id'}, {'name': 'Value'}],
+            'rows': [{'id': i, 'Value': i} for i in range(100)],
+        })
+
+    # Unknown columns are ignored
+    create_indexes(conn, analyze_query('SELECT * FROM query_1 WHERE missing = 1').indexes)
+
+    query = 'SELECT * FROM query_1 a JOIN query_2 b ON a.id = b.value'
+    create_indexes(conn, analyze_query(query).indexes)
+
+    plan = ' '.join(explain_query_plan(conn, query))
+    assert 'query_2__Value' in plan
+
+
+def test_serialize_results(monkeypatch):
+    monkeypatch.setattr('redash_reql.query_runner.FETCH_BATCH_SIZE', 3)
+
+    conn = sqlite3.connect(':memory:')
+    cursor = conn.execute(
+        "SELECT 1 AS a, 'x' AS b UNION ALL SELECT 2, 'y' UNION ALL SELECT 3, NULL "
+        "UNION ALL SELECT 4, 'z'")
+    columns = [{'name': 'a', 'type': None}, {'name': 'b', 'type': None}]
+
+    data = serialize_results(cursor, columns)
+    assert json.loads(data) == {
+        'columns': [{'name': 'a', 'type': TYPE_INTEGER}, {'name': 'b', 'type': TYPE_STRING}],
+        'rows': [{'a': 1, 'b': 'x'}, {'a': 2, 'b': 'y'}, {'a': 3, 'b': None}, {'a': 4, 'b': 'z'}],
+    }
+
+    # Columns come first so readers don't have to scan the rows
+    assert data.startswith('{"columns": ')
+    result_columns, rows = read_results(data)
+    assert result_columns == columns
+    assert len(list(rows)) == 4
+
+
+@pytest.mark.parametrize('rows', [
+    '[]',
+    '[{"a": 1}, {"a": "]"}]',
+    '[{"a": [1, [2]]}, {"a": "\\"]["}, {"a": "[\\"]"}]',
+])
+def test_read_results_rows_first(rows):
+    data = '{"rows": ' + rows + ', "columns": [{"name": "a"}], "x": 1}'
+    columns, result_rows = read_results(data)
+    assert columns == [{'name': 'a'}]
+    assert list(result_rows) == json.loads(rows)
+
+
+def test_read_results_columns_first():
+    # Rows are only decoded as they are consumed
+    data = '{"columns": [{"name": "a"}], "rows": [{"a": 1}, {"a": 2}, !'
+    columns, rows = read_results(data)
+    assert columns == [{'name': 'a'}]
+    assert next(rows) == {'a': 1}
+
+
+def test_create_table_used_columns():
+    conn = sqlite3.connect(':memory:', isolation_level=None)
+    results = {
+        'columns': [{'name': 'a'}, {'name': 'B'}, {'name': 'c'}],
+        'rows': [{'a': 1, 'B': 2, 'c': 3}],
+    }
+
+    create_table(conn, 'query_1', results, used_columns={'c', 'b'})
+    assert conn.execute('SELECT * FROM query_1').fetchall() == [(2, 3)]
+
+    create_table(conn, 'query_2', results, used_columns=set())
+    assert conn.execute('SELECT * FROM query_2').fetchall() == [(1,)]
+
+
+def test_update_table():
+    conn = sqlite3.connect(':memory:', isolation_level=None)
+    columns = [{'name': 'id', 'type': TYPE_INTEGER}, {'name': 'v', 'type': TYPE_STRING}]
+
+    def results(*rows):
+        return json.dumps({'columns': columns, 'rows': [{'id': i, 'v': v} for i, v in rows]})
+
+    create_table(conn, 't', results((1, 'a'), (2, 'b'), (3, 'c')), key='id')
+    changes = update_table(conn, 't', results((1, 'a'), (3, 'x'), (4, 'd')), 'id')
+    assert changes == (1, 1, 1)
+    assert conn.execute('SELECT * FROM t').fetchall() == [(1, 'a'), (3, 'x'), (4, 'd')]
+    assert conn.execute("SELECT name FROM temp.sqlite_master").fetchall() == []
+
+    # Duplicated or null keys
+    with pytest.raises(ValueError) as exc:
+        update_table(conn, 't', results((1, 'a'), (1, 'b')), 'id')
+    assert str(exc.value) == '1 is repeated in the results'
+    with pytest.raises(ValueError) as exc:
+        update_table(conn, 't', results((None, 'a')), 'id')
+    assert str(exc.value) == 'None is null in the results'
+
+    # A different key or different columns
+    assert update_table(conn, 't', results((1, 'a')), 'v') is None
+    columns.append({'name': 'w'})
+    assert update_table(conn, 't', results((1, 'a')), 'id') is None
+    assert conn.execute('SELECT * FROM t').fetchall() == [(1, 'a'), (3, 'x'), (4, 'd')]
+
+    # A full database keeps its error
+    columns.pop()
+    pages, = conn.execute('PRAGMA page_count').fetchone()
+    conn.execute('PRAGMA max_page_count = {0}'.format(pages + 2))
+    with pytest.raises(sqlite3.OperationalError) as exc:
+        update_table(conn, 't', results(*[(i, 'x' * 100) for i in range(5000)]), 'id')
+    assert 'full' in str(exc.value)
+    assert conn.execute('SELECT * FROM t').fetchall() == [(1, 'a'), (3, 'x'), (4, 'd')]
+
+
+@pytest.mark.parametrize('max_rows, expected', [(0, 0), (2, 2), (4, 4), (10, 4)])
+def test_serialize_results_max_rows(monkeypatch, max_rows, expected):
+    monkeypatch.setattr('redash_reql.query_runner.FETCH_BATCH_SIZE', 3)
+
+    conn = sqlite3.connect(':memory:')
+    cursor = conn.execute('SELECT 1 UNION ALL SELECT 2 UNION ALL SELECT 3 UNION ALL SELECT 4')
+    data = serialize_results(cursor, [{'name': 'a', 'type': None}], max_rows=max_rows)
+    assert [r['a'] for r in json.loads(data)['rows']] == list(range(1, expected + 1))
+
+
+def test_analyze_query_settings():
+    analysis = analyze_query('SET max_result_rows = 10;\nset temp_store=memory; SELECT 1')
+    assert dict(analysis.settings) == {'max_result_rows': 10, 'temp_store': 2}
+    assert analysis.sql.strip() == 'SELECT 1'
+
+    analysis = analyze_query("SET incremental_keys = 'query_1.id, QUERY_7.day'; SELECT 1")
+    assert dict(analysis.settings) == {'incremental_keys': ((1, 'id'), (7, 'day'))}
+
+
+@pytest.mark.parametrize('sql, expected', [
+    ('SELECT 1', ['SELECT 1']),
+    ('SELECT 1;', ['SELECT 1;']),
+    ("SELECT ';'; SELECT 2 -- ;\n", ["SELECT ';';", ' SELECT 2 -- ;\n']),
+    ('CREATE TEMP TABLE t AS SELECT 1;\n;\n  SELECT * FROM t', [
+        'CREATE TEMP TABLE t AS SELECT 1;', '\n  SELECT * FROM t']),
+    (' ; ', []),
+    ('SELECT 1; -- note', ['SELECT 1;']),
+    ('SELECT 1;\n/* a */ -- b\n /* c', ['SELECT 1;']),
+    ('SELECT 1; /* a */ SELECT 2', ['SELECT 1;', ' /* a */ SELECT 2']),
+    ("SELECT 1; -- a\nSELECT '--'", ['SELECT 1;', " -- a\nSELECT '--'"]),
+])
+def test_split_statements(sql, expected):
+    assert split_statements(sql) == expected
@@ -4,15 +4,12 @@ import sys
 import pytest
 
 from conftest import load_fixtures, get_test_parser
+from redash_reql import parser as parser_module
 
 
 @pytest.fixture(scope='module')
 def parser_sqlite_reql():
-    return get_test_parser(['sqlite', 'reql'])
-
-@pytest.fixture(scope='module')
-def parser_pgql_reql():
-    return get_test_parser(['pgsql', 'reql'])
+    return get_test_parser()
 
 
 def test_lark_user_aliases_state_bug():
@@ -38,8 +35,81 @@ def test_reql(location, sql, parser_sqlite_reql):
 def test_sqlite_reql(location, sql, parser_sqlite_reql):
     assert parser_sqlite_reql.parse(sql)
 
-# Let's make sure we don't break postgresql
-@pytest.mark.parametrize('location, sql', load_fixtures('fixtures.pgsql', skip=['reql']))
-def test_pgsql_reql(location, sql, parser_pgql_reql):
-    assert parser_pgql_reql.parse(sql)
+
+@pytest.fixture
+def cache_dir(tmpdir, monkeypatch):
+    # Neither a module generated at build time
+    monkeypatch.setattr(parser_module, 'generated_module', lambda: None)
+    return tmpdir.join('cache')
+
+
+def count_builds(monkeypatch):
+    builds = []
+    build_lark = parser_module.build_lark
+
+    def counting(*args):
+        builds.append(args)
+        return build_lark(*args)
+    monkeypatch.setattr(parser_module, 'build_lark', counting)
+    return builds
+
+
+def test_disk_cache(cache_dir, monkeypatch):
+    builds = count_builds(monkeypatch)
+    tree = parser_module.ReqlParser(cache_dir=str(cache_dir)).parse('SELECT 1')
+    assert cache_dir.join('parser-{0}.pickle'.format(parser_module.GRAMMAR_HASH)).check()
+    assert oct(cache_dir.stat().mode & 0o777) == oct(0o700)
+
+    # Other parsers load the stored tables
+    assert parser_module.ReqlParser(cache_dir=str(cache_dir)).parse('SELECT 1') == tree
+    assert len(builds) == 1
+
+
+def test_disk_cache_grammar_change(cache_dir, monkeypatch):
+    builds = count_builds(monkeypatch)
+    parser_module.ReqlParser(cache_dir=str(cache_dir)).parse('SELECT 1')
+
+    monkeypatch.setattr(parser_module, 'GRAMMAR_HASH', 'other')
+    parser_module.ReqlParser(cache_dir=str(cache_dir)).parse('SELECT 1')
+    assert len(builds) == 2
+    assert cache_dir.join('parser-other.pickle').check()
+
+
+@pytest.mark.parametrize('data', [b'garbage', b'\x80\x02cos\nsystem\nq\x00.'])
+def test_disk_cache_corrupted(cache_dir, monkeypatch, data):
+    cache_dir.ensure(dir=True).chmod(0o700)
+    fname = cache_dir.join('parser-{0}.pickle'.format(parser_module.GRAMMAR_HASH))
+    fname.write_binary(data)
+    builds = count_builds(monkeypatch)
+
+    assert parser_module.ReqlParser(cache_dir=str(cache_dir)).parse('SELECT 1')
+    assert len(builds) == 1
+    # Replaced with valid tables
+    assert fname.read_binary() != data
+
+
+def test_disk_cache_unsafe_dir(cache_dir, monkeypatch):
+    cache_dir.ensure(dir=True).chmod(0o777)
+    fname = cache_dir.join('parser-{0}.pickle'.format(parser_module.GRAMMAR_HASH))
+    fname.write_binary(b'planted')
+
+    def load_lark(data):
+        raise AssertionError('Loaded a file from an unsafe directory')
+    monkeypatch.setattr(parser_module, 'load_lark', load_lark)
+    builds = count_builds(monkeypatch)
+
+    assert parser_module.ReqlParser(cache_dir=str(cache_dir)).parse('SELECT 1')
+    assert len(builds) == 1
+    # Nothing is stored there either
+    assert fname.read_binary() == b'planted'
+
+
+def test_outdated_module(monkeypatch):
+    class module(object):
+        __name__ = 'parser_gen'
+        GRAMMAR_HASH = 'other'
+        PARSER_DATA = ''
+
+    with pytest.raises(ValueError):
+        parser_module.ReqlParser(module=module).parse('SELECT 1')
 
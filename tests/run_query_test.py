@@ -0,0 +1,345 @@
+import json
+import os
+import time
+
+import pytest
+
+from load_queries_test import User, models  # noqa: F401 (fixture)
+from redash_reql import query_runner
+from redash_reql.single_flight import NoSingleFlight
+from redash_reql.query_runner import (
+    ReqlQueryRunner, extract_queries_cache, result_cache, result_store, table_cache)
+from redash_reql.settings import SettingError
+from redash_reql.timings import register_hook, unregister_hook
+
+
+class RowsRunner(object):
+
+    def __init__(self, count):
+        self.count = count
+
+    def run_query(self, text, user):
+        return json.dumps({
+            'columns': [{'name': 'id', 'type': 'integer'}, {'name': 'name', 'type': 'string'}],
+            'rows': [{'id': i, 'name': 'row {0}'.format(i)} for i in range(self.count)],
+        }), None
+
+
+@pytest.fixture
+def runner_for(models, tmpdir):
+    models.add_data_source(1, RowsRunner(1000))
+    models.add_query(1, 1, 'SELECT rows')
+    models.add_result(1, 1, 'SELECT rows', RowsRunner(1000).run_query(None, None)[0])
+
+    def create(**config):
+        config.setdefault('memory', None)
+        config.setdefault('spill_dir', str(tmpdir))
+        runner = ReqlQueryRunner(config)
+        runner.created = []
+
+        create_file_db = runner._create_file_db
+
+        def spy(settings, estimate):
+            conn, path = create_file_db(settings, estimate)
+            runner.created.append((path, conn.execute('PRAGMA journal_mode').fetchone()[0]))
+            return conn, path
+
+        runner._create_file_db = spy
+        return runner
+    return create
+
+
+QUERY = 'SELECT COUNT(*) AS c FROM query_1 a JOIN query_1_refresh b USING (id)'
+
+
+def test_small_workload_in_memory(runner_for, tmpdir):
+    runner = runner_for()
+    data, error = runner.run_query(QUERY, User())
+    assert error is None
+    assert json.loads(data)['rows'] == [{'c': 1000}]
+    assert runner.created == []
+
+
+def test_spill_to_file(runner_for, tmpdir):
+    # A threshold of a few bytes, the stored result is way bigger
+    runner = runner_for(spill_threshold=0.00001)
+    data, error = runner.run_query(QUERY, User())
+    assert error is None
+    assert json.loads(data)['rows'] == [{'c': 1000}]
+
+    (path, journal_mode), = runner.created
+    assert os.path.dirname(path) == str(tmpdir)
+    assert journal_mode == 'off'
+    # Cleaned up after the run
+    assert not os.path.exists(path)
+
+
+def test_spill_disabled(runner_for):
+    runner = runner_for(spill_threshold=0)
+    runner.run_query(QUERY, User())
+    assert runner.created == []
+
+
+@pytest.mark.parametrize('configured, setting, expected', [
+    (None, None, None),
+    (None, 1024, 1024),
+    (None, 0, 0),
+    (4096, None, 4096),
+    (4096, 1024, 1024),
+    (4096, 8192, 4096),
+])
+def test_memory_limit(configured, setting, expected):
+    runner = ReqlQueryRunner({'memory': configured})
+    settings = {} if setting is None else {'memory': setting}
+    assert runner._memory_limit(settings) == expected
+
+
+def test_memory_limit_not_removable(runner_for):
+    runner = runner_for(memory=64 * 1024 * 1024)
+    with pytest.raises(SettingError) as exc:
+        runner.run_query('SET memory = 0; ' + QUERY, User())
+    assert 'can not be removed' in str(exc.value)
+
+
+@pytest.mark.parametrize('query', [
+    'SELECT id FROM query_3 WHERE name > 1 ORDER BY id',
+    'SELECT w FROM query_3 ORDER BY id DESC',
+    'SELECT value FROM query_3, json_each(query_3.w) ORDER BY 1',
+    'SELECT q.id, j.value FROM query_3 q JOIN json_each(q.w) j WHERE q.id > 0 ORDER BY 1, 2',
+    'SELECT (SELECT COUNT(*) FROM json_each(q.w)) AS c FROM query_3 q ORDER BY c',
+    'SELECT * FROM query_3 a JOIN query_3 b USING (id) ORDER BY id',
+])
+def test_used_columns_differential(runner_for, models, monkeypatch, query):
+    models.add_query(3, 1, 'SELECT json')
+    models.add_result(3, 1, 'SELECT json', json.dumps({
+        'columns': [{'name': 'id'}, {'name': 'name'}, {'name': 'w'}, {'name': 'unused'}],
+        'rows': [{'id': i, 'name': 'n{0}'.format(i), 'w': json.dumps(list(range(i))),
+                  'unused': i} for i in range(5)],
+    }))
+    runner = runner_for()
+    pruned = runner.run_query(query, User())
+    assert pruned[1] is None
+
+    # Loading every column gives the same output
+    extract_queries_cache.clear()
+    monkeypatch.setattr(query_runner, 'find_used_columns',
+                        lambda ast, names: dict((n, None) for n in names))
+    try:
+        assert runner.run_query(query, User()) == pruned
+    finally:
+        extract_queries_cache.clear()
+
+
+class ChangingRunner(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def run_query(self, text, user):
+        return json.dumps({
+            'columns': [{'name': 'id', 'type': 'integer'}, {'name': 'v', 'type': 'string'}],
+            'rows': [{'id': i, 'v': v} for i, v in sorted(self.rows.items())],
+        }), None
+
+
+@pytest.fixture
+def cached_tables():
+    table_cache.resize(10 * 1024 * 1024)
+    yield
+    table_cache.resize(0)
+    table_cache.clear()
+
+
+@pytest.fixture
+def cached_outputs():
+    result_cache.resize(1024 * 1024)
+    yield
+    result_cache.resize(0)
+    result_cache.clear()
+
+
+def test_runners_share_the_caches(cached_tables):
+    # Data sources can't resize the caches used by the others
+    ReqlQueryRunner({'memory': None})
+    assert table_cache.size == 10 * 1024 * 1024
+
+
+@pytest.fixture
+def no_flights(monkeypatch):
+    monkeypatch.setattr(query_runner, 'single_flight', NoSingleFlight())
+
+
+# Column names are case insensitive
+@pytest.mark.parametrize('key', ['id', 'ID'])
+def test_incremental_refresh(models, cached_tables, no_flights, key):
+    upstream = ChangingRunner(dict((i, 'v{0}'.format(i)) for i in range(100)))
+    models.add_data_source(1, upstream)
+    models.add_query(1, 1, 'SELECT rows')
+    runner = ReqlQueryRunner({'memory': None})
+    query = ("SET incremental_keys = 'query_1.{0}';\n"
+             "SELECT COUNT(*) AS c, SUM(v = 'x') AS x FROM query_1_refresh").format(key)
+
+    data, error = runner.run_query(query, User())
+    assert error is None
+    assert json.loads(data)['rows'] == [{'c': 100, 'x': 0}]
+
+    del upstream.rows[0]
+    upstream.rows[1] = 'x'
+    upstream.rows[100] = 'x'
+    counters = []
+    hook = register_hook(lambda timings: counters.append(timings.as_dict()['counters']))
+    try:
+        data, error = runner.run_query(query, User())
+    finally:
+        unregister_hook(hook)
+    assert error is None
+    assert json.loads(data)['rows'] == [{'c': 100, 'x': 2}]
+    assert counters[0]['query_1_refresh.inserted'] == 1
+    assert counters[0]['query_1_refresh.changed'] == 1
+    assert counters[0]['query_1_refresh.deleted'] == 1
+
+
+@pytest.mark.parametrize('key, message', [
+    ('v', 'Invalid incremental key query_1.v: UNIQUE constraint failed'),
+    ('nope', 'Invalid incremental key query_1.nope:'),
+])
+def test_incremental_invalid_key(models, cached_tables, no_flights, key, message):
+    models.add_data_source(1, ChangingRunner({1: 'a', 2: 'a'}))
+    models.add_query(1, 1, 'SELECT rows')
+    runner = ReqlQueryRunner({'memory': None})
+    query = "SET incremental_keys = 'query_1.{0}'; SELECT * FROM query_1_refresh".format(key)
+    with pytest.raises(SettingError) as exc:
+        runner.run_query(query, User())
+    assert str(exc.value).startswith(message)
+
+
+def test_incremental_without_table_cache(models, no_flights):
+    models.add_data_source(1, ChangingRunner({1: 'a'}))
+    models.add_query(1, 1, 'SELECT rows')
+    runner = ReqlQueryRunner({'memory': None})
+    with pytest.raises(SettingError) as exc:
+        runner.run_query("SET incremental_keys = 'query_1.id'; SELECT * FROM query_1", User())
+    assert 'need the materialized tables cache' in str(exc.value)
+
+
+def test_cached_outputs(runner_for, models, cached_outputs):
+    runner = runner_for()
+    counters = []
+    hook = register_hook(lambda timings: counters.append(timings.as_dict()['counters']))
+    try:
+        for _ in range(2):
+            data, error = runner.run_query(QUERY.replace('_refresh', ''), User())
+            assert json.loads(data)['rows'] == [{'c': 1000}]
+        assert 'result.cached' not in counters[0]
+        assert counters[1]['result.cached'] == 1
+
+        # A new upstream result changes the fingerprint
+        models.add_result(2, 1, 'SELECT rows', RowsRunner(10).run_query(None, None)[0])
+        data, error = runner.run_query(QUERY.replace('_refresh', ''), User())
+        assert json.loads(data)['rows'] == [{'c': 10}]
+        assert 'result.cached' not in counters[2]
+
+        # Refreshing an upstream query is never cached
+        runner.run_query(QUERY, User())
+        runner.run_query(QUERY, User())
+        assert 'result.cached' not in counters[4]
+
+        # Nor are queries without upstream results, they may change anyway
+        runner.run_query("SELECT random() AS r", User())
+        runner.run_query("SELECT random() AS r", User())
+        assert 'result.cached' not in counters[6]
+    finally:
+        unregister_hook(hook)
+
+
+@pytest.fixture
+def binary_results(tmpdir):
+    path = result_store.path
+    result_store.path = str(tmpdir.join('binary'))
+    result_store.resize(1024 * 1024)
+    yield
+    result_store.resize(0)
+    result_store.path = path
+
+
+def test_binary_results(runner_for, models, binary_results, tmpdir, monkeypatch):
+    runner = runner_for()
+    query = ("SELECT id, name, id * 0.5 AS half, CASE WHEN id % 2 THEN id END AS odd "
+             "FROM query_1 ORDER BY id")
+    data, error = runner.run_query(query, User())
+    assert error is None
+    assert len(tmpdir.join('binary').listdir()) == 1
+
+    # A ReQL query reading the output of the previous one loads its encoding
+    models.add_data_source(2, runner)
+    models.add_query(2, 2, query)
+    models.add_result(2, 2, query, data)
+
+    result_store.resize(0)
+    expected, error = runner.run_query('SELECT * FROM query_2', User())
+    assert error is None
+    result_store.resize(1024 * 1024)
+
+    def read_results(results):
+        raise AssertionError('Decoded the JSON text')
+    monkeypatch.setattr(query_runner, 'read_results', read_results)
+
+    chained, error = runner.run_query('SELECT * FROM query_2', User())
+    assert error is None
+    assert chained == expected
+    assert json.loads(chained)['rows'][:2] == [
+        {'id': 0, 'name': 'row 0', 'half': 0.0, 'odd': None},
+        {'id': 1, 'name': 'row 1', 'half': 0.5, 'odd': 1}]
+
+
+class SlowRunner(object):
+
+    def run_query(self, text, user):
+        time.sleep(5)
+        return RowsRunner(1).run_query(text, user)
+
+
+def test_max_execution_time(runner_for):
+    runner = runner_for(max_execution_time=0.2)
+    start = time.time()
+    data, error = runner.run_query(
+        'SELECT COUNT(*) FROM query_1 a, query_1 b, query_1 c, query_1 d', User())
+    assert data is None
+    assert error == 'Query exceeded the maximum execution time of 0.2 seconds.'
+    assert time.time() - start < 2
+
+
+def test_max_execution_time_upstream(runner_for, models, no_flights):
+    models.add_data_source(2, SlowRunner())
+    models.add_query(2, 2, 'SELECT slowly')
+    runner = runner_for(max_execution_time=0.2)
+    start = time.time()
+    data, error = runner.run_query('SELECT * FROM query_2_refresh', User())
+    assert error == 'Query exceeded the maximum execution time of 0.2 seconds.'
+    assert time.time() - start < 2
+
+
+@pytest.mark.parametrize('setting, expected', [('', 5), ('SET max_result_rows = 2;', 2),
+                                               ('SET max_result_rows = 20;', 5)])
+def test_max_result_rows(runner_for, setting, expected):
+    runner = runner_for(max_result_rows=5)
+    data, error = runner.run_query(setting + 'SELECT * FROM query_1', User())
+    assert len(json.loads(data)['rows']) == expected
+
+
+@pytest.mark.parametrize('query', [
+    'SELECT name, COUNT(*) AS c, SUM(id) FROM query_1 WHERE id % 3 = 0 GROUP BY name',
+    'SELECT id, name FROM query_1 WHERE id > 900 ORDER BY id DESC LIMIT 5',
+    'SELECT COUNT(*) FROM query_1 a JOIN query_1 b ON a.id = b.id',
+])
+def test_columnar_engine(runner_for, cached_tables, query):
+    pytest.importorskip('numpy')
+    expected = runner_for().run_query(query, User())
+    runner = runner_for(engine='columnar')
+    assert runner.run_query(query, User()) == expected
+    assert runner.run_query(query, User()) == expected
+
+
+def test_unknown_engine():
+    with pytest.raises(ValueError):
+        ReqlQueryRunner({'engine': 'gpu'})
@@ -0,0 +1,43 @@
+import pytest
+
+from redash_reql.parser import ReqlParser
+from redash_reql.settings import SettingError, find_settings
+
+
+@pytest.fixture(scope='module')
+def parser():
+    return ReqlParser(cache_dir=False)
+
+
+def settings(parser, sql):
+    return find_settings(parser.parse(sql), sql)
+
+
+@pytest.mark.parametrize('sql, expected', [
+    ('SELECT 1', {}),
+    ('SET memory = 1024; SELECT 1', {'memory': 1024}),
+    ("SET temp_store = 'FILE'; SET cache_size = -2000", {'temp_store': 1, 'cache_size': -2000}),
+    ('SET concurrency = 1; SET concurrency = 2', {'concurrency': 2}),
+    ('SET max_query_rows = 10; SET max_result_rows = 0', {'max_query_rows': 10, 'max_result_rows': 0}),
+])
+def test_find_settings(parser, sql, expected):
+    assert settings(parser, sql)[0] == expected
+
+
+def test_strip_statements(parser):
+    sql = 'SET memory = 1024 ;\nSELECT 1;\nset concurrency = 2'
+    _, edits = settings(parser, sql)
+    assert [sql[start:end] for start, end, _ in edits] == [
+        'SET memory = 1024 ;', 'set concurrency = 2']
+
+
+@pytest.mark.parametrize('sql, message', [
+    ('SET nope = 1', 'Unknown setting nope'),
+    ('SET concurrency = 0', 'Invalid value for setting concurrency'),
+    ('SET temp_store = disk', 'Invalid value for setting temp_store'),
+    ("SET memory = 'lots'", 'Invalid value for setting memory'),
+])
+def test_invalid_settings(parser, sql, message):
+    with pytest.raises(SettingError) as ex:
+        settings(parser, sql)
+    assert message in str(ex.value)
@@ -0,0 +1,121 @@
+import os
+import threading
+import time
+
+import pytest
+
+from redash_reql.single_flight import (
+    FileSingleFlight, LocalSingleFlight, NoSingleFlight, create)
+
+
+@pytest.fixture(params=['local', 'file'])
+def backend(request, tmpdir):
+    def create(timeout=5):
+        if request.param == 'local':
+            return LocalSingleFlight(timeout)
+        return FileSingleFlight(timeout, path=str(tmpdir.join('flights')))
+    return create
+
+
+def run_concurrently(flight, func, count=5, key='k'):
+    results, errors = [], []
+
+    def worker():
+        try:
+            results.append(flight.do(key, func))
+        except Exception as ex:
+            errors.append(ex)
+
+    threads = [threading.Thread(target=worker) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+        # Let the first one lead
+        time.sleep(0.05)
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+def test_single_run(backend):
+    calls = []
+
+    def func():
+        calls.append(1)
+        time.sleep(0.5)
+        return u'result'
+
+    results, errors = run_concurrently(backend(), func)
+    assert results == [u'result'] * 5 and not errors
+    assert len(calls) == 1
+
+
+def test_leader_failure_falls_back(backend):
+    calls = []
+
+    def func():
+        calls.append(1)
+        time.sleep(0.3)
+        if len(calls) == 1:
+            raise ValueError('boom')
+        return u'result'
+
+    results, errors = run_concurrently(backend(), func, count=3)
+    assert len(errors) == 1
+    assert results == [u'result'] * 2
+    assert len(calls) >= 2
+
+
+def test_timeout_falls_back(backend):
+    calls = []
+
+    def func():
+        calls.append(1)
+        time.sleep(0.6)
+        return u'result'
+
+    results, errors = run_concurrently(backend(timeout=0.1), func, count=2)
+    assert results == [u'result'] * 2 and not errors
+    assert len(calls) == 2
+
+
+def test_sequential_runs_not_reused(backend):
+    flight = backend()
+    assert flight.do('k', lambda: u'first') == u'first'
+    assert flight.do('k', lambda: u'second') == u'second'
+
+
+def test_file_results_only_for_followers(tmpdir):
+    path = str(tmpdir.join('flights'))
+    flight = FileSingleFlight(5, path=path)
+    assert flight.do('k', lambda: u'alone') == u'alone'
+    assert not [n for n in os.listdir(path) if not n.endswith('.lock')]
+
+    def func():
+        time.sleep(0.5)
+        return u'result'
+
+    results, errors = run_concurrently(flight, func, count=3)
+    assert results == [u'result'] * 3 and not errors
+    # The last follower removed the result
+    assert not [n for n in os.listdir(path) if not n.endswith('.lock')]
+
+
+def test_file_stale_waiters_ignored(tmpdir):
+    path = str(tmpdir.join('flights'))
+    flight = FileSingleFlight(5, path=path)
+    flight.do('k', lambda: u'first')
+    name, = os.listdir(path)
+    stale = os.path.join(path, name.replace('.lock', '.dead.wait'))
+    open(stale, 'w').close()
+    os.utime(stale, (time.time() - 10, time.time() - 10))
+
+    assert flight.do('k', lambda: u'second') == u'second'
+    assert os.listdir(path) == [name]
+
+
+def test_create():
+    flight = create('none', 3)
+    assert isinstance(flight, NoSingleFlight) and flight.timeout == 3
+    with pytest.raises(ValueError) as exc:
+        create('nope')
+    assert str(exc.value) == 'Unknown dedup backend nope, expected one of: file, local, none'
@@ -0,0 +1,108 @@
+import io
+import itertools
+import sqlite3
+
+import pytest
+
+from redash_reql.parser import ReqlParser
+from redash_reql.query_runner import analyze_query, create_tables_from_sources
+from redash_reql.sources import (
+    SourceError, evaluate_source, find_sources, register_source, rewrite_query,
+    _csv_rows)
+
+
+@pytest.fixture(scope='module')
+def parser():
+    return ReqlParser(cache_dir=False)
+
+
+@pytest.fixture
+def csv_file(tmpdir):
+    fname = tmpdir.join('people.csv')
+    fname.write(u'id,name\n1,Ann\n2,Bob\n3,Carl\n')
+
+    @register_source('csvfile')
+    def csvfile(path, delimiter=','):
+        fd = io.open(path, encoding='utf8')
+        return _csv_rows(fd, delimiter)
+
+    return str(fname)
+
+
+def sources(parser, sql):
+    return find_sources(parser.parse(sql), sql)
+
+
+@pytest.mark.parametrize('sql, expected', [
+    ('SELECT * FROM json[: [] :] AS x', 'SELECT * FROM reql_source_0 AS x'),
+    ("SELECT * FROM csv['a']::limit[5] x JOIN t USING (a)",
+     'SELECT * FROM reql_source_0 x JOIN t USING (a)'),
+    ("WITH x AS csv['a'] SELECT * FROM x", 'WITH x AS (SELECT * FROM reql_source_0) SELECT * FROM x'),
+    ("WITH x AS ( csv['a'] ) SELECT * FROM x, json['[]']",
+     'WITH x AS ( SELECT * FROM reql_source_0 ) SELECT * FROM x, reql_source_1'),
+])
+def test_rewrite_query(parser, sql, expected):
+    assert rewrite_query(sql, sources(parser, sql)) == expected
+
+
+def test_find_sources_params(parser):
+    source, = sources(parser, "SELECT * FROM csv[1, 'it''s', b, delimiter: ';']::columns[a, b]::limit[2]")
+    assert source.name == 'csv'
+    assert source.args == (1, "it's", 'b')
+    assert source.kwargs == {'delimiter': ';'}
+    assert [(m.name, m.args) for m in source.mappers] == [('columns', ('a', 'b')), ('limit', (2,))]
+
+
+@pytest.mark.parametrize('block, expected', [
+    ('[:\n    a\n      b\n  :]', 'a\n  b'),
+    ('[=\n    a\n      b\n=]', '    a\n      b'),
+    ('[<\n    a\n      b\n  >]', 'a b'),
+])
+def test_blocks(parser, block, expected):
+    source, = sources(parser, 'SELECT * FROM csv' + block)
+    assert source.args == (expected,)
+
+
+def test_json_inline_block():
+    sql = '''
+        SELECT name FROM json[:
+            [{"id": 1, "name": "Ann"}, {"id": 2, "name": "Bob"}]
+        :] WHERE id > 1
+    '''
+    analysis = analyze_query(sql)
+    conn = sqlite3.connect(':memory:')
+    create_tables_from_sources(conn, analysis.sources)
+    assert conn.execute(analysis.sql).fetchall() == [('Bob',)]
+
+
+def test_csv_file_provider(csv_file):
+    sql = u"SELECT a.name FROM csvfile['{0}']::columns[name]::limit[2] a".format(csv_file)
+    analysis = analyze_query(sql)
+    conn = sqlite3.connect(':memory:')
+    create_tables_from_sources(conn, analysis.sources)
+    assert conn.execute(analysis.sql).fetchall() == [('Ann',), ('Bob',)]
+
+
+def test_streaming(parser):
+    pulled = []
+
+    @register_source('counter')
+    def counter():
+        def rows():
+            for i in itertools.count():
+                pulled.append(i)
+                yield {'n': i}
+        return [{'name': 'n'}], rows()
+
+    source, = sources(parser, 'SELECT * FROM counter[]::limit[3]')
+    columns, rows = evaluate_source(source)
+    assert pulled == []
+    assert list(rows) == [{'n': 0}, {'n': 1}, {'n': 2}]
+    assert pulled == [0, 1, 2]
+
+
+def test_unknown_source(parser):
+    source, = sources(parser, 'SELECT * FROM\n  nope[1]')
+    with pytest.raises(SourceError) as ex:
+        evaluate_source(source)
+    assert 'nope' in str(ex.value) and 'line 2' in str(ex.value)
@@ -8,7 +8,7 @@ from conftest import load_fixtures, get_test_parser
 
 @pytest.fixture(scope='module')
 def parser():
-    return get_test_parser(['sqlite'])
+    return get_test_parser()
 
 
 @pytest.mark.parametrize('location, sql', load_fixtures('fixtures.sqlite'))
@@ -0,0 +1,140 @@
+"""
+SQLite backed stand-in for the parts of `redash.models` used by the query
+runner, mapping the same tables, columns and relationships.
+
+Statements sent to the database are counted in `statements`.
+"""
+from datetime import datetime
+
+from sqlalchemy import (
+    Boolean, Column, DateTime, ForeignKey, Integer, String, Text, create_engine, event)
+from sqlalchemy.orm import relationship, scoped_session, sessionmaker
+
+try:
+    from sqlalchemy.orm import declarative_base
+except ImportError:
+    from sqlalchemy.ext.declarative import declarative_base
+
+from redash.utils import gen_query_hash
+
+
+engine = create_engine('sqlite://')
+
+
+class db(object):
+    session = scoped_session(sessionmaker(bind=engine))
+
+
+Model = declarative_base()
+Model.query = db.session.query_property()
+
+statements = []
+
+# Query runners by data source id, they aren't stored in the database
+runners = {}
+
+
+@event.listens_for(engine, 'before_cursor_execute')
+def _count(conn, cursor, statement, parameters, context, executemany):
+    statements.append(statement)
+
+
+class DataSource(Model):
+    __tablename__ = 'data_sources'
+
+    id = Column(Integer, primary_key=True)
+    org_id = Column(Integer)
+    name = Column(String(255))
+    data_source_groups = relationship('DataSourceGroup', back_populates='data_source')
+
+    @property
+    def groups(self):
+        groups = db.session.query(DataSourceGroup).filter(DataSourceGroup.data_source == self)
+        return dict((g.group_id, g.view_only) for g in groups)
+
+    @property
+    def query_runner(self):
+        return runners[self.id]
+
+
+class DataSourceGroup(Model):
+    __tablename__ = 'data_source_groups'
+
+    id = Column(Integer, primary_key=True)
+    data_source_id = Column(Integer, ForeignKey('data_sources.id'))
+    data_source = relationship(DataSource, back_populates='data_source_groups')
+    group_id = Column(Integer)
+    view_only = Column(Boolean, default=False)
+
+
+class QueryResult(Model):
+    __tablename__ = 'query_results'
+
+    id = Column(Integer, primary_key=True)
+    org_id = Column(Integer)
+    data_source_id = Column(Integer, ForeignKey('data_sources.id'))
+    data_source = relationship(DataSource)
+    query_hash = Column(String(32), index=True)
+    query_text = Column('query', Text)
+    data = Column(Text)
+    retrieved_at = Column(DateTime)
+
+    @classmethod
+    def get_latest(cls, data_source, query, max_age=0):
+        return cls.query.filter(
+            cls.query_hash == gen_query_hash(query),
+            cls.data_source == data_source,
+        ).order_by(cls.retrieved_at.desc()).first()
+
+
+class Query(Model):
+    __tablename__ = 'queries'
+
+    id = Column(Integer, primary_key=True)
+    org_id = Column(Integer)
+    data_source_id = Column(Integer, ForeignKey('data_sources.id'))
+    data_source = relationship(DataSource)
+    query_text = Column('query', Text)
+    query_hash = Column(String(32))
+
+    @classmethod
+    def get_by_id(cls, id):
+        return cls.query.filter(cls.id == id).one()
+
+
+def reset():
+    db.session.remove()
+    Model.metadata.drop_all(engine)
+    Model.metadata.create_all(engine)
+    runners.clear()
+    del statements[:]
+
+
+def add_data_source(id, runner, groups=None, org_id=1):
+    data_source = DataSource(id=id, org_id=org_id, name='ds{0}'.format(id))
+    db.session.add(data_source)
+    for group_id, view_only in (groups or {1: False}).items():
+        db.session.add(DataSourceGroup(
+            data_source=data_source, group_id=group_id, view_only=view_only))
+    runners[id] = runner
+    db.session.commit()
+    return data_source
+
+
+def add_query(id, data_source_id, text, org_id=1):
+    query = Query(
+        id=id, org_id=org_id, data_source_id=data_source_id,
+        query_text=text, query_hash=gen_query_hash(text))
+    db.session.add(query)
+    db.session.commit()
+    return query
+
+
+def add_result(id, data_source_id, text, data, retrieved_at=None, org_id=1):
+    result = QueryResult(
+        id=id, org_id=org_id, data_source_id=data_source_id,
+        query_hash=gen_query_hash(text), query_text=text, data=data,
+        retrieved_at=retrieved_at or datetime(2018, 1, 1))
+    db.session.add(result)
+    db.session.commit()
+    return result
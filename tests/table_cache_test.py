@@ -0,0 +1,93 @@
+import os
+import sqlite3
+
+import pytest
+
+from redash_reql.table_cache import TABLE_NAME, TableCache, protect_attached
+
+
+def build(rows):
+    def builder(conn):
+        conn.execute('CREATE TABLE {0} (a INTEGER)'.format(TABLE_NAME))
+        conn.executemany(
+            'INSERT INTO {0} VALUES (?)'.format(TABLE_NAME), [(i,) for i in range(rows)])
+    return builder
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return TableCache(1024 * 1024, path=str(tmpdir))
+
+
+def test_attach(cache):
+    conn = sqlite3.connect(':memory:')
+    assert not cache.attach(conn, (1, 1, 't1'), 'cached')
+
+    assert cache.store((1, 1, 't1'), build(10))
+    assert cache.attach(conn, (1, 1, 't1'), 'cached')
+    assert conn.execute('SELECT count(*) FROM results').fetchone() == (10,)
+
+
+def test_newer_result_invalidates(cache, tmpdir):
+    cache.store((1, 1, 't1'), build(10))
+    cache.store((2, 5, 't1'), build(10))
+    cache.store((1, 2, 't2'), build(10))
+
+    assert (1, 1, 't1') not in cache
+    assert (1, 2, 't2') in cache
+    assert len(os.listdir(str(tmpdir))) == 2
+
+    cache.invalidate(1)
+    assert (1, 2, 't2') not in cache
+    assert (2, 5, 't1') in cache
+
+
+def test_evicts_by_size(tmpdir):
+    cache = TableCache(100 * 1024, path=str(tmpdir))
+    for i in range(10):
+        cache.store((i, i, 't'), build(2000))
+
+    assert cache.stats()['bytes'] <= 100 * 1024
+    assert (9, 9, 't') in cache
+    assert (0, 0, 't') not in cache
+    assert len(os.listdir(str(tmpdir))) == cache.stats()['entries']
+
+
+def test_protect_attached(cache):
+    cache.store((1, 1, 't1'), build(10))
+    conn = sqlite3.connect(':memory:')
+    cache.attach(conn, (1, 1, 't1'), 'cached')
+    protect_attached(conn, ['cached'])
+
+    with pytest.raises(sqlite3.DatabaseError):
+        conn.execute('DELETE FROM cached.results')
+
+    conn.execute('CREATE TEMP TABLE copy AS SELECT * FROM cached.results')
+
+
+def test_update(cache, tmpdir):
+    def add(rows):
+        def updater(conn):
+            conn.executemany(
+                'INSERT INTO {0} VALUES (?)'.format(TABLE_NAME), [(i,) for i in range(rows)])
+            return rows
+        return updater
+
+    # Built from scratch without a previous entry
+    assert cache.update((1, 1, 't1'), build(10), add(5))
+    conn = sqlite3.connect(':memory:')
+    cache.attach(conn, (1, 1, 't1'), 'old')
+
+    assert cache.update((1, 2, 't2'), build(10), add(5))
+    cache.attach(conn, (1, 2, 't2'), 'new')
+    assert conn.execute('SELECT count(*) FROM new.results').fetchone() == (15,)
+    # The previous database isn't modified while attached elsewhere
+    assert conn.execute('SELECT count(*) FROM old.results').fetchone() == (10,)
+    assert (1, 1, 't1') not in cache
+    assert len(os.listdir(str(tmpdir))) == 1
+
+    # Rebuilt when it can't be updated
+    assert cache.update((1, 3, 't3'), build(3), lambda conn: None)
+    cache.attach(conn, (1, 3, 't3'), 'rebuilt')
+    assert conn.execute('SELECT count(*) FROM rebuilt.results').fetchone() == (3,)
+    assert len(os.listdir(str(tmpdir))) == 1
@@ -0,0 +1,67 @@
+import json
+import sqlite3
+
+from redash_reql.query_runner import create_table, serialize_results
+from redash_reql.timings import Timings, report, register_hook, statsd_hook, unregister_hook
+
+
+class FakeStatsd(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def timing(self, name, ms):
+        self.sent.append(('timing', name))
+
+    def incr(self, name, count):
+        self.sent.append(('incr', name, count))
+
+
+def test_timings_accumulate():
+    timings = Timings()
+    with timings.phase('a'):
+        pass
+    timings.add_time('a', 1.0)
+    timings.incr('query_1.rows', 5)
+    timings.incr('query_1.rows', 2)
+
+    data = timings.as_dict()
+    assert list(data['phases']) == ['a']
+    assert data['phases']['a'] >= 1.0
+    assert data['counters'] == {'query_1.rows': 7}
+
+
+def test_instrumented_ingestion_and_output():
+    timings = Timings()
+    conn = sqlite3.connect(':memory:', isolation_level=None)
+    count = create_table(conn, 'query_1', {
+        'columns': [{'name': 'a'}],
+        'rows': [{'a': i} for i in range(10)],
+    }, timings=timings)
+    assert count == 10
+
+    cursor = conn.execute('SELECT a FROM query_1')
+    data = serialize_results(
+        cursor, [{'name': 'a', 'type': None}], timings=timings,
+        metadata=lambda: {'timings': timings.as_dict()})
+
+    data = json.loads(data)
+    phases = data['metadata']['timings']['phases']
+    assert set(phases) == {'decode', 'insert', 'fetch', 'guess_types', 'encode'}
+    assert data['metadata']['timings']['counters']['result.rows'] == 10
+
+
+def test_statsd_hook():
+    client = FakeStatsd()
+    hook = register_hook(statsd_hook(client, prefix='x'))
+    try:
+        timings = Timings()
+        timings.add_time('execute', 0.5)
+        timings.incr('query_1.rows', 3)
+        timings.incr('result.rows', 1)
+        report(timings)
+    finally:
+        unregister_hook(hook)
+
+    assert client.sent == [
+        ('timing', 'x.execute'), ('incr', 'x.query.rows', 3), ('incr', 'x.result.rows', 1)]